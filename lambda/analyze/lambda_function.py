@@ -3,12 +3,27 @@ import pandas as pd
 
 import datetime as dt
 from dateutil.parser import parse as parse_date
-import boto3, json, io
+import json
+from botocore.exceptions import ClientError
 
 from operator import itemgetter, attrgetter
+from flowbalance import health, manifest
+from flowbalance.balance import Incidence, window_bounds
+from flowbalance.diagnosis import calibrate, implicate, requested_engine, unknown
+from flowbalance.flows import CHUNK_ROWS, accumulate, chunks, unobserved
+from flowbalance.metrics import Metrics
+from flowbalance.plots import pack_plots, plot_key, index_key
+from flowbalance.storage import get_df, put_df, get_str, put_str, get_cfatv, get_adjacency
 import logging
 logger = logging.getLogger(__name__)
 
+# Times of day diagnosed apart from the whole day, both ends inclusive:
+# every hour, then the AM and PM peaks
+WINDOWS = [('{:02d}:00'.format(hour), '{:02d}:59'.format(hour)) for hour in range(24)] + [
+	('06:00', '09:59'),
+	('15:00', '18:59'),
+]
+
 def lambda_handler(event, context):
 	"""
 	Diagnose detectors based on the recorded data in 'data/detectors' so they can be colored.
@@ -19,81 +34,91 @@ def lambda_handler(event, context):
 	key = record['s3']['object']['key']
 	key = key.split('/')[-1]
 
-	date = parse_date(key).date()
+	metrics = Metrics('fb-analyze', date = key)
+	try:
+		with metrics.profiled(event, 'data/balance/' + key):
+			analyze(key, metrics = metrics, engine = requested_engine(event))
+	finally:
+		metrics.emit()
 
-	df_meta = get_df('data/detectors/{}'.format(key))
-	df_day = get_df('data/raw/{}'.format(key))
+def load_shared():
+	"""
+	Inputs that do not change from day to day, loaded once per backfill
+	"""
+	return {
+		'cfatv': get_cfatv(),
+		'adjacency': get_adjacency(),
+		'tracked': json.loads(get_str('info/tracked.json')), # Detectors that appear in the model
+		'incidence': {}, # By the stations of the day's pivot
+	}
 
-	df_piv = df_day.pivot('Timestamp', 'Station', 'Flow')
+def get_flows(key, date, metrics):
+	"""
+	The day's flows pivoted by station, blank where not observed enough, and the
+	stations not observed enough. Days recorded before data/observed are pivoted
+	from data/raw.
+	"""
+	try:
+		obv = metrics.timed('read observed', get_df, 'data/observed/{}'.format(key))['Observed']
+	except ClientError as e:
+		logger.info("No data/observed/{}, pivoting data/raw".format(key))
+		df_day = metrics.timed('read raw', get_df, 'data/raw/{}'.format(key))
+		_, df_piv, obv = metrics.timed('accumulate', accumulate, chunks(df_day, CHUNK_ROWS), np.unique(df_day['Station']), date)
+		unobv = unobserved(obv)
+		df_piv[unobv] = np.nan
+		return df_piv, unobv
+	return metrics.timed('read flows', get_df, 'data/flows/{}'.format(key)), unobserved(obv)
+
+def analyze(key, shared = None, record_shared = True, metrics = None, engine = None):
+	"""
+	Diagnose the detectors of one day, `key` being its date as YYYY-MM-DD, with
+	`engine` or that of the environment. Unless told not to, also update the
+	records shared between days: detector health and the manifest of available
+	dates. Stages are recorded to `metrics`, or logged on their own if not given.
+	"""
+	if metrics is None:
+		metrics = Metrics('fb-analyze', date = key)
+		try:
+			return analyze(key, shared, record_shared, metrics, engine)
+		finally:
+			metrics.emit()
+	if engine is None:
+		engine = requested_engine()
+	if shared is None:
+		shared = metrics.timed('load shared', load_shared)
 
-	# Only work with detectors with >50% mean observation
-	obv = df_day.pivot('Timestamp', 'Station', 'Observed').mean() > 50
-	unobv = obv[~obv].index
-	df_piv[unobv] = np.nan
+	date = parse_date(key).date()
 
-	df_cfatv = get_cfatv()
-	
-	# Record error and volume per fatv
-	df_cfatv['ERR'] = np.nan
-	df_cfatv['VOL'] = np.nan
-	df_cfatv['DIF'] = np.nan
-	missing = lambda ser: ser.isna().sum() / float(len(ser))
-	for idx in df_cfatv.index:
-		ins, outs = df_cfatv.loc[idx, ['IN', 'OUT']]
-		try:
-			ins = df_piv[ins].sum(axis = 1, skipna = False)
-			outs = df_piv[outs].sum(axis = 1, skipna = False)
+	df_meta = metrics.timed('read detectors', get_df, 'data/detectors/{}'.format(key))
+	df_piv, unobv = get_flows(key, date, metrics) # Only work with detectors with >50% mean observation
 
-			# Don't allow more than 5% NaN
-			if missing(ins) < 0.05 and missing(outs) < 0.05:
-				vol = (ins + outs).sum()
-				dif = (ins - outs).sum()
-			else:
-				vol = np.nan
-				dif = np.nan
-
-			df_cfatv.loc[idx, 'DIF'] = dif
-			df_cfatv.loc[idx, 'VOL'] = vol
-			df_cfatv.loc[idx, 'ERR'] = abs(dif) / float(vol)
-		except KeyError as e:
-			logger.debug("Cannot account FATV {}, illformed FATV or bad meta?".format(idx))
-			df_cfatv.loc[idx, 'DIF'] = np.nan
-			df_cfatv.loc[idx, 'VOL'] = np.nan
-			df_cfatv.loc[idx, 'ERR'] = np.nan
-	
+	df_cfatv = shared['cfatv'].copy()
+	adjacency = shared['adjacency']
 	
-	# Identify implicated detectors, start at 2.5% error
-	singleton = set()
-	imp1, imp2 = [], []
-	for idx, fatv in df_cfatv[df_cfatv['ERR'] > 0.025].iterrows(): # TODO: magic
-		neighbors = {}
-		for det in fatv['IN']:
-			nidx = df_cfatv[df_cfatv['OUT'].map(lambda ds: det in ds)].index
-			if not nidx.empty:
-				neighbors[det] = nidx[0]
-			else:
-				singleton.add(det)
-		for det in fatv['OUT']:
-			nidx = df_cfatv[df_cfatv['IN'].map(lambda ds: det in ds)].index
-			if not nidx.empty:
-				neighbors[det] = nidx[0]
-			else:
-				singleton.add(det)
-	
-		for det, neighbor in neighbors.items():
-			pair = df_cfatv.loc[[idx, neighbor]]
-			# Ignore fatvs with low error, unlikely to be the fault of multiple
-			if pair.loc[neighbor]['ERR'] < 0.01: # TODO: magic
-				continue
-			temp = pair.sum()
-			temp['ERR'] = abs(temp['DIF'])/temp['VOL']
-			# If combining FATVs reduces error by >85%, blame the mutual neighbor
-			if temp['ERR'] < 0.15 * fatv['ERR']: # TODO: magic
-				if det in imp1:
-					imp2.append(det)
-					singleton -= set(temp['IN']) | set(temp['OUT'])
-				imp1.append(det)
-				logger.info("{} implicates {} from {}".format(neighbor, det, idx))
+	# Record error and volume per fatv
+	stations = tuple(df_piv.columns)
+	if stations not in shared['incidence']:
+		shared['incidence'][stations] = metrics.timed('incidence', Incidence, df_cfatv, df_piv.columns)
+	incidence = shared['incidence'][stations]
+	with metrics.stage('balance'):
+		running = incidence.running(df_piv)
+		df_cfatv = df_cfatv.join(running.account(0, len(df_piv.index)))
+
+	# Record every FATV's plot so fb-proxy can pass them through
+	with metrics.stage('plots'):
+		ins, outs = incidence.series(df_piv)
+		blob, index = pack_plots(df_cfatv, ins, outs)
+		put_str(blob, plot_key(key))
+		put_str(index, index_key(key)) # After the blob it points into
+
+	bounds = window_bounds(df_piv.index, WINDOWS)
+	if engine == 'calibrate':
+		# Member flows of the whole day, then of each window
+		totals = metrics.timed('member totals', incidence.member_totals, df_piv, running, [(0, len(df_piv.index))] + bounds)
+		imp2, singleton, factors = metrics.timed('calibrate', calibrate, df_cfatv, totals[0], incidence.stations)
+		spans, df_factors = ['Day'], [factors]
+	else:
+		imp2, singleton = metrics.timed('implicate', implicate, df_cfatv, adjacency)
 
 	# Record miscount for each fatv
 	infatvs = df_meta.loc[imp2, 'FATV IN']
@@ -103,50 +128,41 @@ def lambda_handler(event, context):
 	miscount = outvals - invals
 
 	# Report findings to s3
-	tracked = json.loads(get_str('info/tracked.json')) # Detectors that appear in the model
+	tracked = shared['tracked']
 
-	unknown = set(df_cfatv[df_cfatv['ERR'].isnull()][['IN', 'OUT']].sum().sum())
 	diagnosis = {
 		'error': imp2, # Diagnosed to be in error
-		'unobv': list(df_meta.index & unobv), # Not providing sufficient data
-		'unknown': list(unknown), # Neighbors not providing sufficient data
+		'unobv': list(df_meta.index.intersection(unobv)), # Not providing sufficient data
+		'unknown': list(unknown(df_cfatv)), # Neighbors not providing sufficient data
 		'untracked': list(set(df_meta.index) - set(tracked)), # Appear in PeMS but not model
 		'singleton': list(singleton), # Belong only to one FATV
 	}
 
-	put_str(json.dumps(diagnosis), 'data/balance/{}'.format(key))
-
-def put_str(s, key):
-	s3 = boto3.client('s3')
-	store = io.BytesIO(s)
-	s3.upload_fileobj(store, 'flow-balance', key)
-
-def get_str(key):
-	s3 = boto3.client('s3')
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', key, store)
-	store.seek(0)
-	return store.getvalue()
-
-def get_df(key):
-	s3 = boto3.client('s3')
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', key, store)
-	store.seek(0)
-	df_store = pd.read_csv(store, index_col = 0)
-	return df_store
-
-def put_df(df, key):
-	s3 = boto3.client('s3')
-	store = io.BytesIO()
-	df.to_csv(store)
-	store.seek(0)
-	s3.upload_fileobj(store, 'flow-balance', key)
-
-def get_cfatv():
-	s3 = boto3.client('s3')
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', 'info/fatvs.json', store)
-	store.seek(0)
-	df_cfatv = pd.read_json(store, orient = 'index').sort_index()
-	return df_cfatv
+	metrics.timed('upload diagnosis', put_str, json.dumps(diagnosis), 'data/balance/{}'.format(key))
+
+	# Diagnose each window of the day alone, to catch what the whole day hides
+	windows = {}
+	with metrics.stage('windows'):
+		for n, ((start, stop), (first, last)) in enumerate(zip(WINDOWS, bounds)):
+			df_window = df_cfatv[['IN', 'OUT']].join(running.account(first, last))
+			if engine == 'calibrate':
+				error, _, factors = calibrate(df_window, totals[n + 1], incidence.stations)
+				spans.append('{}-{}'.format(start, stop))
+				df_factors.append(factors)
+			else:
+				error, _ = implicate(df_window, adjacency)
+			windows['{}-{}'.format(start, stop)] = {
+				'error': error,
+				'unknown': sorted(unknown(df_window)),
+			}
+
+	metrics.timed('upload windows', put_str, json.dumps(windows), 'data/windows/{}'.format(key))
+	if engine == 'calibrate':
+		# Blank where a detector has no flow in an accounted FATV
+		df_factors = pd.concat(df_factors, axis = 1, keys = spans)
+		metrics.timed('upload factors', put_df, df_factors, 'data/factors/{}'.format(key), dtype = np.float32)
+
+	# Records shared between days
+	if record_shared:
+		metrics.timed('health', health.record, date, df_meta.index, diagnosis)
+		metrics.timed('manifest', manifest.record, date, 'analyze')
@@ -3,11 +3,22 @@ import pandas as pd
 
 import datetime as dt
 from dateutil.parser import parse as parse_date
+from multiprocessing.pool import ThreadPool
 
 from pems.download import PemsDownloader as PDR
 from pems.util import revise_meta, rename_locations, fwys 
 
-import boto3, io, json
+import json, os
+
+from flowbalance import history, manifest
+from flowbalance.flows import CHUNK_ROWS, accumulate, chunks, unobserved
+from flowbalance.metrics import Metrics
+from flowbalance.storage import get_df, put_df, put_str, get_adjacency
+import logging
+logger = logging.getLogger(__name__)
+
+# Downloads and uploads in flight at once during an ingest
+THREADS = 4
 
 def lambda_handler(event, context):
 	"""
@@ -26,28 +37,92 @@ def lambda_handler(event, context):
 	else:
 		raise ValueError("Bad invocation event")
 	
-	pdr = PDR()
-	# data/detectors update
-	# Get the active station_meta from pems
-	pdr.update_meta('meta', years = [date.year, date.year - 1]) # Look for entries with same and previous year
-	rdate = max(filter(lambda d: d < date, pdr.meta['meta'].keys())) # Choose the latest meta
-	day, df_meta = pdr.download('meta', date = rdate)
-	
-	# Only one source for locations
-	df_locations = get_df('info/locations.csv')
+	# The meta index and the shared inputs are fetched side by side
+	metrics = Metrics('fb-daily', date = '{:%Y-%m-%d}'.format(date))
+	pool = ThreadPool(THREADS)
+	try:
+		with metrics.profiled(event, 'data/raw/{:%Y-%m-%d}'.format(date)):
+			pdr = pool.apply_async(metrics.timed, ('downloader', downloader, [date]))
+			shared = metrics.timed('load shared', load_shared, pool)
+			ingest(date, pdr.get(), shared, pool = pool, metrics = metrics)
+	finally:
+		pool.close()
+		pool.join()
+		metrics.emit()
+
+	body = json.dumps({'message': 'data retrieved'})
+	return {
+		'statusCode': 200,
+		'headers': {'access-control-allow-origin': '*'}, # Not handled by api gateway integrations??
+		'body': body
+	}
+
+def downloader(dates):
+	"""
+	A PeMS downloader aware of the station_meta releases that apply to dates,
+	or a directory backed stand-in if FLOW_BALANCE_PEMS is set
+	"""
+	root = os.environ.get('FLOW_BALANCE_PEMS')
+	if root:
+		from flowbalance.local import LocalPems
+		pdr = LocalPems(root)
+	else:
+		pdr = PDR()
+	years = sorted({year for date in dates for year in (date.year, date.year - 1)})
+	pdr.update_meta('meta', years = years) # Look for entries with same and previous year
+	return pdr
+
+def load_shared(pool = None):
+	"""
+	Inputs that do not change from day to day, loaded once per backfill.
+	Given a thread pool they are fetched concurrently.
+	"""
+	if pool is None:
+		pool = ThreadPool(2)
+		try:
+			return load_shared(pool)
+		finally:
+			pool.close()
+			pool.join()
+
+	locations = pool.apply_async(get_df, ('info/locations.csv',)) # Only one source for locations
+	adjacency = pool.apply_async(get_adjacency) # Only one source for fatv membership
+	return {
+		'locations': locations.get(),
+		'adjacency': adjacency.get(),
+		'metas': {}, # Revised station_meta by release date
+	}
+
+# Postmile range of each freeway of interest
+RANGES = pd.DataFrame.from_dict(
+	dict((fwy, info['range']) for fwy, info in fwys.items()), orient = 'index', columns = ['Min', 'Max']
+)
 
-	# Only one source for fatvs
-	df_cfatv = get_cfatv()
+def in_corridor(df_meta):
+	"""
+	Mask of the detectors on a freeway of interest and within its postmile range.
+	Detectors without a postmile are not ruled out.
+	"""
+	bounds = RANGES.reindex(df_meta['Fwy'].values)
+	pm = df_meta['Abs PM']
+	return (df_meta['Fwy'].isin(RANGES.index)
+		& ~pm.lt(bounds['Min'].values)
+		& ~pm.gt(bounds['Max'].values)).values
+
+def get_meta(pdr, rdate, shared):
+	"""
+	Revised station_meta released on rdate, restricted to the corridor
+	"""
+	if rdate in shared['metas']:
+		return shared['metas'][rdate].copy()
+
+	day, df_meta = pdr.download('meta', date = rdate)
+	df_locations = shared['locations'].copy()
+	adjacency = shared['adjacency']
 
 	df_meta = revise_meta(df_meta) # Reorient and drop useless cols
 	rename_locations(df_meta) # Fill in location names from numeric codes
-	for fwy, info in fwys.items(): # Filter only detectors in useful corridor
-		range_min, range_max = info['range']
-		df_meta.drop(df_meta[(df_meta['Fwy'] == fwy) & (df_meta['Abs PM'] < range_min)].index, inplace = True)
-		df_meta.drop(df_meta[(df_meta['Fwy'] == fwy) & (df_meta['Abs PM'] > range_max)].index, inplace = True)
-
-	# Remove detectors that do not belong to a freeway of interest
-	df_meta.drop(df_meta[~df_meta['Fwy'].isin(fwys.keys())].index, inplace = True)
+	df_meta = df_meta.drop(df_meta.index[~in_corridor(df_meta)]) # Filter only detectors in useful corridor
 
 	# Update the meta to include hand located latlons, record exactness
 	df_meta['Exact'] = False
@@ -55,52 +130,78 @@ def lambda_handler(event, context):
 	df_meta.update(df_locations)
 
 	# Update df_meta to include fatv data
-	df_meta['FATV IN'] = None
-	df_meta['FATV OUT'] = None
-	for fid, fatv in df_cfatv.iterrows():
-			df_meta.loc[df_meta.index & fatv['IN'], 'FATV IN'] = fid
-			df_meta.loc[df_meta.index & fatv['OUT'], 'FATV OUT'] = fid
-
-	put_df(df_meta, 'data/detectors/{:%Y-%m-%d}'.format(date))
-
-	# data/raw update
-	day, df_day = pdr.download('station_5min', date = date)
-	put_df(df_day, 'data/raw/{:%Y-%m-%d}'.format(date))
-
-	# data/flows update
-	df_piv = df_day.pivot('Timestamp', 'Station', 'Flow')
-	obv = df_day.pivot('Timestamp', 'Station', 'Observed').mean() > 50
-	unobv = obv[~obv].index
-	df_piv[unobv] = np.nan
-	df_piv = df_piv[df_meta.index]
-	put_df(df_piv, 'data/flows/{:%Y-%m-%d}'.format(date))
+	membership = adjacency.frame().reindex(df_meta.index)
+	df_meta['FATV IN'] = membership['FATV IN']
+	df_meta['FATV OUT'] = membership['FATV OUT']
 
-	body = json.dumps({'message': 'data retrieved'})
-	return {
-		'statusCode': 200,
-		'headers': {'access-control-allow-origin': '*'}, # Not handled by api gateway integrations??
-		'body': body
-	}
+	shared['metas'][rdate] = df_meta
+	return df_meta.copy()
 
-def get_df(key):
-	s3 = boto3.client('s3')
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', key, store)
-	store.seek(0)
-	df_store = pd.read_csv(store, index_col = 0)
-	return df_store
-
-def put_df(df, key):
-	s3 = boto3.client('s3')
-	store = io.BytesIO()
-	df.to_csv(store)
-	store.seek(0)
-	s3.upload_fileobj(store, 'flow-balance', key)
-
-def get_cfatv():
-	s3 = boto3.client('s3')
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', 'info/fatvs.json', store)
-	store.seek(0)
-	df_cfatv = pd.read_json(store, orient = 'index').sort_index()
-	return df_cfatv
+def ingest(date, pdr, shared, record_shared = True, pool = None, metrics = None):
+	"""
+	Record data/detectors, data/raw, data/flows and data/observed for one day,
+	each keeping only the stations of the corridor and the FATVs. Unless told not
+	to, also append to the records shared between days: the flow history and
+	the manifest of available dates.
+
+	The day's counts download while the meta is revised, and each output
+	uploads while the next is computed, on `pool` if given. Stages are
+	recorded to `metrics`, or logged on their own if not given. Returns the
+	seconds spent in each stage, which overlap.
+	"""
+	if metrics is None:
+		metrics = Metrics('fb-daily', date = '{:%Y-%m-%d}'.format(date))
+		try:
+			return ingest(date, pdr, shared, record_shared, pool, metrics)
+		finally:
+			metrics.emit()
+	if pool is None:
+		pool = ThreadPool(THREADS)
+		try:
+			return ingest(date, pdr, shared, record_shared, pool, metrics)
+		finally:
+			pool.close()
+			pool.join()
+
+	# Get the active station_meta from pems
+	rdate = max(filter(lambda d: d < date, pdr.meta['meta'].keys())) # Choose the latest meta
+	day = pool.apply_async(metrics.timed, ('download station_5min', pdr.download, 'station_5min'), {'date': date})
+	df_meta = metrics.timed('meta', get_meta, pdr, rdate, shared)
+
+	# data/detectors update, with a JSON copy fb-proxy can serve without pandas
+	uploads = [pool.apply_async(metrics.timed, ('upload detectors', put_df, df_meta, 'data/detectors/{:%Y-%m-%d}'.format(date)))]
+	uploads.append(pool.apply_async(metrics.timed, ('upload detectors json', put_str,
+		df_meta.to_json(orient = 'index'), 'data/detectors/{:%Y-%m-%d}.json'.format(date))))
+
+	# Only the corridor and the FATV members are of use downstream
+	adjacency = shared['adjacency']
+	stations = df_meta.index.append(pd.Index(sorted(set(adjacency.detectors) - set(df_meta.index))))
+	_, df_day = day.get()
+	day = None # Let the full download go once accumulated
+	df_raw, df_piv, obv = metrics.timed('accumulate', accumulate, chunks(df_day, CHUNK_ROWS), stations, date)
+	del df_day
+
+	# data/flows update, with the observation behind it
+	df_piv[unobserved(obv)] = np.nan
+	uploads.append(pool.apply_async(metrics.timed, ('upload flows', put_df, df_piv, 'data/flows/{:%Y-%m-%d}'.format(date)),
+		{'format': 'arrow', 'dtype': np.float32})) # Counts are exact in float32
+	uploads.append(pool.apply_async(metrics.timed, ('upload observed', put_df,
+		obv.to_frame('Observed'), 'data/observed/{:%Y-%m-%d}'.format(date))))
+
+	for upload in uploads:
+		upload.get()
+
+	# data/raw update, last as fb-analyze starts on it and reads the rest
+	metrics.timed('upload raw', put_df, df_raw, 'data/raw/{:%Y-%m-%d}'.format(date))
+
+	# Records shared between days
+	if record_shared:
+		# The history only serves fb-proxy, the day stands without it
+		try:
+			metrics.timed('history', history.append, df_piv)
+		except Exception as e:
+			logger.exception("History of {:%Y-%m-%d} not recorded".format(date))
+		metrics.timed('manifest', manifest.record, date, 'daily') # Once the day is all there
+
+	logger.info("Ingested {:%Y-%m-%d}".format(date))
+	return metrics.seconds()
@@ -1,12 +1,16 @@
 import numpy as np
 import pandas as pd
-import networkx as nx
 
-import boto3, json, re
+import hashlib, ijson, json, re
+from array import array
 from zipfile import ZipFile
 from tempfile import TemporaryFile
 from collections import defaultdict
-from operator import itemgetter
+from flowbalance.adjacency import Adjacency
+from flowbalance.graph import Graph
+from flowbalance.metrics import Metrics
+from flowbalance.storage import get_file, get_str, put_str
+from botocore.exceptions import ClientError
 
 import logging
 logger = logging.getLogger(__name__)
@@ -27,120 +31,260 @@ logger = logging.getLogger(__name__)
 def lambda_handler(event, context):
 	"""
 	Parse and record Aimsun model features for later use in graph style analyses.
+	Only the parts of the model that changed since the last run are recomputed,
+	unless the event asks for a 'full' rebuild.
 	"""
+	metrics = Metrics('fb-model', full = bool(event.get('full')))
+	try:
+		with metrics.profiled(event, 'info/fatvs.json'):
+			update_model(event, metrics)
+	finally:
+		metrics.emit()
+
+def update_model(event, metrics):
 	# Retrieve extracted model data, model.zip must have
-	s3 = boto3.client('s3')
 	with TemporaryFile() as model:
-		s3.download_fileobj('flow-balance', 'info/model.zip', model)
+		metrics.timed('download model', get_file, 'info/model.zip', model)
 		model.seek(0)
-		detectors, junctions, sections = get_djs(model)
+		detectors, junctions, sections = metrics.timed('parse', get_djs, model)
 	
 	# Record which detectors appear at all in the model
-	with TemporaryFile('w+') as file:
-		json.dump(list(detectors), file)
-		file.seek(0)
-		s3.upload_fileobj(file, 'flow-balance', 'info/tracked.json')
+	metrics.timed('upload tracked', put_str, json.dumps(detectors.index.tolist()), 'info/tracked.json')
+
+	# Start from the previously recorded model, if any
+	state = None
+	if not event.get('full'):
+		try:
+			state = metrics.timed('load state', lambda: load_state(get_str('info/model-state.json')))
+		except ClientError as e:
+			logger.info("No previous model state, rebuilding all FATVs")
 
 	# Record which detectors form closed FATVs
-	df_cfatv = get_fatvs(detectors, junctions, sections)
-	with TemporaryFile('w+') as file:
-		df_cfatv.to_json(file, orient = 'index')
-		file.seek(0)
-		s3.upload_fileobj(file, 'flow-balance', 'info/fatvs.json')
+	df_cfatv, state, changes = metrics.timed('fatvs', update_fatvs, state, detectors, junctions, sections)
+	metrics.timed('upload fatvs', put_str, df_cfatv.to_json(orient = 'index'), 'info/fatvs.json')
+
+	# Record detector and FATV neighborhoods so consumers need not search for them
+	adjacency = metrics.timed('adjacency', Adjacency.from_fatvs, df_cfatv)
+	metrics.timed('upload adjacency', put_str, adjacency.to_json(), 'info/adjacency.json')
 
-def get_djs(model):
+	# Record what changed, so that only affected FATVs need another look
+	with metrics.stage('upload state'):
+		put_str(dump_state(state), 'info/model-state.json')
+		put_str(json.dumps(changes), 'info/changelog.json')
+	logger.info("FATVs added: {}, removed: {}".format(len(changes['added']), len(changes['removed'])))
+
+# Fields kept from each dump, with the typecode of the array they are kept in.
+# Anything else (descriptions, junction turns, ...) is dropped unless asked for.
+FIELDS = {
+	'detectors.json': {
+		'Section ID': 'l', 'First Lane': 'i', 'Last Lane': 'i',
+		'Start Position': 'd', 'External ID': 'l'
+	},
+	'junctions.json': {},
+	'sections.json': {'Origin': 'l', 'Destination': 'l'},
+}
+# Sections to or from the edge of the model have no Origin or Destination
+EXTERIOR = -1
+
+def get_djs(model, extra = None):
+	"""
+	Stream the detectors, junctions and sections from model.zip, each as a frame
+	indexed by id. `extra` maps dump names to further fields to keep.
+	"""
 	good_ptn = re.compile(r'^7\d+$')
 	bad_ptn = re.compile(r'^7131')
 	good_det = lambda id: re.match(good_ptn, id) and not re.match(bad_ptn, id)
+	extra = extra or {}
 	with ZipFile(model) as zm:
-		with zm.open('detectors.json') as dets:
-			detectors = json.load(dets)
-			detectors = {int(id): det for id, det in detectors.items() if good_det(id)}
-
-		with zm.open('junctions.json') as junctions:
-			junctions = json.load(junctions)
-			junctions = {int(id): j for id, j in junctions.items()}
-
-		with zm.open('sections.json') as sections:
-			sections = json.load(sections)
-			sections = {int(id): s for id, s in sections.items()}
+		detectors = read_dump(zm, 'detectors.json', extra.get('detectors.json', ()), good_det)
+		junctions = read_dump(zm, 'junctions.json', extra.get('junctions.json', ()))
+		sections = read_dump(zm, 'sections.json', extra.get('sections.json', ()))
 	
 	return detectors, junctions, sections
 
+def read_dump(zm, name, extra = (), keep = None):
+	"""
+	Incrementally parse an {id: feature} dump, so that only the kept fields of
+	each feature are ever held at once. Missing values become EXTERIOR.
+	"""
+	cast = {'l': int, 'i': int, 'd': float}
+	fields = FIELDS[name]
+	ids = array('l')
+	columns = {field: array(code) for field, code in fields.items()}
+	others = {field: [] for field in extra}
+	with zm.open(name) as dump:
+		for id, feature in ijson.kvitems(dump, ''):
+			if keep and not keep(id):
+				continue
+			ids.append(int(id))
+			for field, column in columns.items():
+				value = feature[field]
+				column.append(EXTERIOR if value is None else cast[column.typecode](value))
+			for field, column in others.items():
+				column.append(feature.get(field))
 
-def get_fatvs(detectors, junctions, sections):
-	# We need to be able to find detectors by their associated sections
-	s2det = defaultdict(list)
-	for pid, det in detectors.items():
-		s2det[det['Section ID']].append(det)
+	df = pd.DataFrame({field: np.asarray(column) for field, column in columns.items()}, index = np.asarray(ids))
+	for field, column in others.items():
+		df[field] = column
+	return df
 
+def get_dsets(detectors):
+	"""
+	Map sections to their lists of spanning detector sets, in the order they
+	appear to a vehicle in transit.
+	"""
 	# Sections are not the same as edges in the graph,
 	# because there may be more than one detector per section.
 	# Detectors may be adjacent or in sequence. Adjacent detectors are NOT
 	# considered to preserve flow-balance, and will belong to the same FATV.
-	sfatvs = {'IN': [], 'OUT': []}
-	get_track = itemgetter('First Lane', 'Last Lane')
-	get_pid = itemgetter('External ID')
-	for s, dets in s2det.items():
-		# In the order detectors appear to a vehicle in transit
-		ds = sorted(dets, key = itemgetter('Start Position'))
-		
-		# Detectors are sorted by 'tracks' (lanes spanned)
-		tracks = defaultdict(list)
-		for d in ds:
-			track = get_track(d)
-			tracks[track].append(d)
-
-		# If each 'track' spans the section, they are split into spanning sets
-		dsets = zip(*tracks.values())
-		# We only need the pems id from each
-		dsets = [map(get_pid, dset) for dset in dsets]
-		# Re-record detectors per section as a list of equivalent detector sets
-		s2det[s] = dsets
-
-		# For each spanning set, match with the following spanning set to form a FATV
-		for fin, fout in zip(dsets, dsets[1:]):
-			sfatvs['IN'].append(fin)
-			sfatvs['OUT'].append(fout)
-
-	# Represent the network as a graph
-	G = nx.DiGraph()
-	# Junctions are the nodes
-	G.add_nodes_from(junctions.keys())
-	# Sections are the edges
-	edges = [
-		(s['Origin'], s['Destination'], {'ID': mid, 'detectors': s2det[mid]})
-		for mid, s, in sections.items()
-	]
-
-	# Start only with sections that have NO detectors
-	G.add_edges_from( e for e in edges if not e[2]['detectors'] )
-	# Find groups of detectors that have unmetered routes via weakly connected components
-	wccs = list(nx.weakly_connected_components(G))
-	# Exclude groups that contain unmetered routes to the exterior
-	groups = [wcc for wcc in wccs if None not in wcc]
-	
-	# Complete the graph and extract FATVs
-	G.add_edges_from(edges)
 
-	# Locus of final detector sets for each incoming section per group
-	fatv_ins = [[G.edges[start, end]['detectors'][-1] for start, end in G.in_edges(group) if start not in group] for group in groups]
+	# In the order detectors appear to a vehicle in transit
+	ds = detectors.sort_values('Start Position', kind = 'mergesort')
+
+	# Detectors are sorted per section by 'tracks' (lanes spanned)
+	tracks = defaultdict(lambda: defaultdict(list))
+	columns = ['Section ID', 'First Lane', 'Last Lane', 'External ID']
+	for sid, first, last, pid in zip(*(ds[c].tolist() for c in columns)):
+		tracks[sid][first, last].append(pid)
+
+	# If each 'track' spans the section, they are split into spanning sets
+	return {sid: [list(dset) for dset in zip(*t.values())] for sid, t in tracks.items()}
 
-	# Locus of initial detector sets for each incoming section per group
-	fatv_outs = [[G.edges[start, end]['detectors'][0] for start, end in G.out_edges(group) if end not in group] for group in groups]
+def fatv_id(ins, outs):
+	"""
+	Content derived FATV id, stable for as long as the FATV's detectors are
+	"""
+	key = '{}|{}'.format(','.join(map(str, sorted(ins))), ','.join(map(str, sorted(outs))))
+	return int(hashlib.sha1(key.encode('ascii')).hexdigest()[:12], 16) # Exact in a javascript number
+
+def get_components(nodes, edges):
+	"""
+	Weakly connected components of the graph given by nodes and directed edges
+	"""
+	return Graph(edges, nodes).components()
+
+def group_fatvs(groups, sections):
+	"""
+	FATVs bounded by each group of junctions. `sections` maps section ids to
+	(Origin, Destination, spanning detector sets).
+	"""
+	# Sections are the edges. Parallel sections are one edge, that of the last
+	# section listed, as they always were when the graph was built in networkx.
+	edges = {}
+	for sid, (o, d, dsets) in sections.items():
+		edges[o, d] = dsets
+	G = Graph(edges)
+	dsets = list(edges.values())
+
+	member = np.full(len(G.nodes), -1, dtype = np.intp)
+	for n, group in enumerate(groups):
+		member[[G.index[j] for j in group if j in G.index]] = n
+	ins, outs = G.boundary(member, len(groups))
+
+	fatvs = []
+	for fin, fout in zip(ins, outs):
+		# Locus of final detector sets for each incoming section,
+		# and of initial detector sets for each outgoing section
+		fatvs.append(([dsets[e][-1] for e in fin], [dsets[e][0] for e in fout]))
+	return fatvs
+
+def update_fatvs(state, detectors, junctions, sections):
+	"""
+	Bring the FATVs recorded in `state` up to date with the model, recomputing
+	components only where sections or junctions changed. With no state every
+	FATV is built afresh.
+
+	Returns the FATVs, the new state and a changelog of FATVs added and removed.
+	"""
+	if state is None:
+		state = {'sections': {}, 'labels': {}, 'fatvs': {}}
+
+	s2det = get_dsets(detectors)
+	node = lambda j: None if j == EXTERIOR else j
+	ends = zip(sections.index.tolist(), sections['Origin'].tolist(), sections['Destination'].tolist())
+	current = {sid: (node(o), node(d), s2det.get(sid, [])) for sid, o, d in ends}
+	previous = state['sections']
+
+	# Junctions are the nodes, and so are the ends of unmetered sections
+	universe = set(junctions.index.tolist())
+	for o, d, dsets in current.values():
+		if not dsets:
+			universe.update([o, d])
+
+	# Nodes at either end of a changed section, before or after the change
+	changed = {sid for sid in set(current) | set(previous) if current.get(sid) != previous.get(sid)}
+	affected = universe ^ set(state['labels'])
+	for sid in changed:
+		for o, d, dsets in filter(None, [current.get(sid), previous.get(sid)]):
+			affected.update([o, d])
+
+	# Components touching an affected node are dirty, the rest stand.
+	# Unmetered sections never join two components that were apart unless they
+	# changed, so components are only recomputed within the dirty ones.
+	labels = state['labels']
+	dirty = {labels[j] for j in affected if j in labels}
+	nodes = {j for j, label in labels.items() if label in dirty} | affected
+	nodes &= universe
+	edges = [(o, d) for o, d, dsets in current.values() if not dsets and o in nodes and d in nodes]
+
+	labels = {j: label for j, label in labels.items() if label not in dirty and j in universe}
+	groups = []
+	for wcc in get_components(nodes, edges):
+		# Exclude groups that contain unmetered routes to the exterior
+		label = None if None in wcc else min(wcc)
+		labels.update(dict.fromkeys(wcc, label))
+		if label is not None:
+			groups.append((label, wcc))
+
+	# FATVs of untouched groups and sections carry over
+	fatvs = {
+		fid: fatv for fid, fatv in state['fatvs'].items()
+		if (fatv[2] is not None and fatv[2] not in dirty) or (fatv[3] is not None and fatv[3] not in changed)
+	}
 
 	# Match incoming with outgoing
-	df_cfatv = pd.DataFrame({
-		'IN': fatv_ins,
-		'OUT': fatv_outs
-	})
+	for (label, group), (fatv_in, fatv_out) in zip(groups, group_fatvs([g for l, g in groups], current)):
+		ins = [n for dset in fatv_in for n in dset]
+		outs = [n for dset in fatv_out for n in dset]
+		fatvs[fatv_id(ins, outs)] = (ins, outs, label, None)
 
-	# Append trivial FATVs contained in each section
-	df_cfatv = df_cfatv.append(pd.DataFrame(sfatvs).applymap(lambda g: [g]), ignore_index = True)
+	# Trivial FATVs between successive spanning sets within changed sections
+	for sid in changed & set(current):
+		dsets = current[sid][2]
+		for fin, fout in zip(dsets, dsets[1:]):
+			fatvs[fatv_id(fin, fout)] = (list(fin), list(fout), None, sid)
+
+	changes = {
+		'added': sorted(set(fatvs) - set(state['fatvs'])),
+		'removed': sorted(set(state['fatvs']) - set(fatvs)),
+	}
+	state = {'sections': current, 'labels': labels, 'fatvs': fatvs}
 
-	# Flatten each group of incoming detectors into list of peers with int values
-	flat1 = lambda L: [n for s in L for n in s]
-	df_cfatv = df_cfatv.applymap(flat1)
-	df_cfatv = df_cfatv.applymap(lambda L: map(int, L))
+	df_cfatv = pd.DataFrame.from_dict(
+		{fid: fatv[:2] for fid, fatv in fatvs.items()}, orient = 'index', columns = ['IN', 'OUT']
+	).sort_index()
+	return df_cfatv, state, changes
 
+def get_fatvs(detectors, junctions, sections):
+	"""
+	Build every FATV in the model
+	"""
+	df_cfatv, state, changes = update_fatvs(None, detectors, junctions, sections)
 	return df_cfatv
+
+def dump_state(state):
+	null = lambda k: 'null' if k is None else str(k)
+	return json.dumps({
+		'sections': {str(sid): section for sid, section in state['sections'].items()},
+		'labels': {null(j): label for j, label in state['labels'].items()},
+		'fatvs': {str(fid): fatv for fid, fatv in state['fatvs'].items()},
+	})
+
+def load_state(s):
+	raw = json.loads(s)
+	null = lambda k: None if k == 'null' else int(k)
+	return {
+		'sections': {int(sid): (o, d, dsets) for sid, (o, d, dsets) in raw['sections'].items()},
+		'labels': {null(j): label for j, label in raw['labels'].items()},
+		'fatvs': {int(fid): tuple(fatv) for fid, fatv in raw['fatvs'].items()},
+	}
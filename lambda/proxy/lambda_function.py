@@ -1,15 +1,24 @@
-import numpy as np
-import pandas as pd
-
 import datetime as dt
-from dateutil.parser import parse as parse_date
-import boto3, json, io
+import base64, gzip, io, json
+from botocore.exceptions import ClientError
 
 from operator import itemgetter, attrgetter
+from flowbalance.storage import get_df, get_str, get_json, get_range, get_cfatv
+from flowbalance import manifest
+from flowbalance.metrics import Metrics
+from flowbalance.plots import plot_body, plot_key, index_key, trace
 import logging
 logger = logging.getLogger(__name__)
 
-s3 = boto3.client('s3')
+# Nothing imported at load needs numpy or pandas, so that a cold start
+# serving stored objects (latest, dates, detectors, diagnosis, plot) skips
+# them. Routes that handle frames import them on first use.
+
+# Response bodies smaller than this are never compressed
+GZIP_MIN_BYTES = 1024
+
+# Most days a range request may cover, each day costs a read per detector or FATV
+MAX_DAYS = 31
 
 def lambda_handler(event, context):
 	"""
@@ -18,47 +27,99 @@ def lambda_handler(event, context):
 	proxy = event['pathParameters']['proxy']
 	method = event['requestContext']['httpMethod']
 	query = event['queryStringParameters'] or {}
+	headers = event.get('headers') or {}
 	logger.info("Handling {} {}".format(method, proxy))
 
 	path = proxy.split('/')
+	metrics = Metrics('fb-proxy', route = path[0])
+	try:
+		# Profiles are keyed by the request and when it came
+		with metrics.profiled(event, 'proxy/{}/{:%Y-%m-%dT%H%M%S.%f}'.format(proxy, dt.datetime.utcnow())):
+			response = metrics.timed('handle', route, path, query)
+			if response is None:
+				return None
+			return metrics.timed('encode', encode_response, response, headers)
+	finally:
+		metrics.emit()
+
+def route(path, query):
+	"""
+	The response to the request for `path`, None if there is no such route
+	"""
 	if path[0] == 'detectors':
-		return handle_detectors(path, query)
+		response = handle_detectors(path, query)
 	elif path[0] == 'latest':
-		return handle_latest(path, query)
+		response = handle_latest(path, query)
+	elif path[0] == 'dates':
+		response = handle_dates(path, query)
+	elif path[0] == 'diagnosis' and 'start' in query:
+		response = handle_diagnoses(path, query)
 	elif path[0] == 'diagnosis':
-		return handle_diagnosis(path, query)
+		response = handle_diagnosis(path, query)
+	elif path[0] == 'plot' and 'fatvs' in query:
+		response = handle_plots(path, query)
 	elif path[0] == 'plot':
-		return handle_plot(path, query)
+		response = handle_plot(path, query)
+	elif path[0] == 'history':
+		response = handle_history(path, query)
+	elif path[0] == 'health':
+		response = handle_health(path, query)
+	else:
+		return None
+	return response
 
 def handle_latest(path, query):
 	"""
 	Return the latest cached date of data
 	"""
-	latest = sorted(ls_key('data/detectors'))[-1]
-	date = latest.split('/')[-1]
+	date = manifest.latest('daily')
 	return proxy_response(json.dumps({'date': date}))
 
+def handle_dates(path, query):
+	"""
+	Return the manifest of dates available, and when each stage finished them
+	"""
+	return proxy_response(json.dumps(manifest.load()))
+
+# Detector columns as named for the page
+RENAMES = {
+	'FATV IN': 'fatv_in',
+	'FATV OUT': 'fatv_out',
+	'Latitude': 'lat',
+	'Longitude': 'lon'
+}
+
 def handle_detectors(path, query):
 	"""
-	Return the requested date of detector data if it is available
+	Return the requested date of detector data if it is available, from the
+	JSON copy fb-daily records beside it if there is one
 	"""
 	if query.get("date", ""):
 		date = query['date']
-		target = 'data/detectors/' + date
 	else:
-		latest = sorted(ls_key('data/detectors/'))[-1]
-		target = latest
-	
-	df_meta = get_df(target)
-	df_meta.rename(
-		columns =  {
-			'FATV IN': 'fatv_in',
-			'FATV OUT': 'fatv_out',
-			'Latitude': 'lat',
-			'Longitude': 'lon'
-		},
-		inplace = True
-	)
+		date = manifest.latest('daily')
+	fields = [field for field in query.get("fields", "").split(',') if field]
+
+	try:
+		detectors = get_json('data/detectors/{}.json'.format(date))
+	except ClientError as e:
+		logger.info("No JSON detectors for {}, converting data/detectors".format(date))
+	else:
+		records = {}
+		for det, record in detectors.items():
+			record = dict((RENAMES.get(column, column), value) for column, value in record.items())
+			if fields:
+				# Only the requested columns, by their names as returned
+				record = dict((field, record[field]) for field in fields if field in record)
+			records[det] = record
+		return proxy_response(json.dumps(records))
+
+	df_meta = get_df('data/detectors/' + date)
+	df_meta.rename(columns = RENAMES, inplace = True)
+
+	# Only the requested columns, by their names as returned
+	if fields:
+		df_meta = df_meta[[field for field in fields if field in df_meta.columns]]
 		
 	body = df_meta.to_json(orient = 'index')
 	return proxy_response(body)
@@ -71,13 +132,9 @@ def handle_diagnosis(path, query):
 		date = query['date']
 		target = 'data/balance/' + date
 	else:
-		latest = sorted(ls_key('data/balance/'))[-1]
-		target = latest
+		target = 'data/balance/' + manifest.latest('analyze')
 	
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', target, store)
-
-	body = store.getvalue()
+	body = get_str(target)
 	return proxy_response(body)
 
 def handle_plot(path, query):
@@ -86,87 +143,207 @@ def handle_plot(path, query):
 	"""
 	if query.get("date", ""):
 		date = query['date']
-		target = 'data/flows/' + date
 	else:
-		latest = sorted(ls_key('data/flows/'))[-1]
-		target = latest
-	
-	df_piv = get_df(target)
-	df_piv.columns = pd.to_numeric(df_piv.columns) # df_piv has ids as cols
-	df_piv.index = pd.to_datetime(df_piv.index) # df_piv has timestamp as index
-
+		date = manifest.latest('daily')
 	fatv = int(path[1])
-	df_cfatv = get_cfatv()
 
+	# Plots recorded by fb-analyze are passed through
+	try:
+		index = get_json(index_key(date))
+	except ClientError as e:
+		logger.info("No recorded plots for {}, computing from flows".format(date))
+	else:
+		if str(fatv) not in index:
+			return error_response(404, "No FATV {}".format(fatv))
+		offset, length = index[str(fatv)]
+		body = get_range(plot_key(date), offset, length)
+		return proxy_response(body.decode('utf-8'))
+
+	df_cfatv = get_cfatv()
+	if fatv not in df_cfatv.index:
+		return error_response(404, "No FATV {}".format(fatv))
 	fd_in, fd_out = df_cfatv.loc[fatv]
+
+	# Only the FATV's own detectors are decoded
+	df_piv = get_df('data/flows/' + date, columns = set(fd_in + fd_out)) # df_piv has ids as cols
+
 	in_data = df_piv[fd_in].sum(axis = 1, skipna = False)
 	out_data = df_piv[fd_out].sum(axis = 1, skipna = False)
 
-	miscount = out_data.sum() - in_data.sum()
-	volume = in_data.sum() + out_data.sum()
-	relerr = miscount / volume
-
-	body = {
-		'IN': {
-			'detectors': fd_in,
-			'data': {
-				'name': 'IN',
-				'mode': 'lines',
-				'x': [str(time) for time in in_data.index],
-				'y': [n if not np.isnan(n) else None for n in in_data.values]
-			}
-		},
-		'OUT': {
-			'detectors': fd_out,
-			'data': {
-				'name': 'OUT',
-				'mode': 'lines',
-				'x': [str(time) for time in out_data.index],
-				'y': [n if not np.isnan(n) else None for n in out_data.values]
-			}
-		},
-		'stats': {
-			'miscount': miscount,
-			'volume': volume,
-			'relerr': relerr
-		}
-	}
+	body = json.dumps(plot_body(fd_in, fd_out, in_data, out_data))
+	return proxy_response(body)
+
+# One character per detector per day in diagnosis ranges, where a detector
+# has many labels the last listed wins, as on the page
+LABELS = [
+	('unknown', 'u'),
+	('unobv', 'o'),
+	('error', 'e'),
+	('untracked', 't'),
+	('singleton', 's'),
+]
+UNLABELED, UNDIAGNOSED = '.', '?'
+
+def handle_diagnoses(path, query):
+	"""
+	Return the diagnosis labels of every detector for each date from `start`
+	through `end` (default the latest), as one character per date
+	"""
+	start = parse_day(query['start'])
+	if query.get("end", ""):
+		end = parse_day(query['end'])
+	else:
+		end = parse_day(manifest.latest('analyze'))
+	if not 0 <= (end - start).days < MAX_DAYS:
+		return error_response(400, "Diagnoses are served for 1 to {} days".format(MAX_DAYS))
+	dates = [start + dt.timedelta(days = n) for n in range((end - start).days + 1)]
+
+	diagnoses = []
+	for date in dates:
+		try:
+			diagnoses.append(get_json('data/balance/{:%Y-%m-%d}'.format(date)))
+		except ClientError as e:
+			diagnoses.append(None)
+	blank = [UNLABELED if diagnosis is not None else UNDIAGNOSED for diagnosis in diagnoses]
+
+	codes = {}
+	for n, diagnosis in enumerate(diagnoses):
+		for label, code in LABELS:
+			for det in (diagnosis or {}).get(label, []):
+				codes.setdefault(det, list(blank))[n] = code
 
-	body = json.dumps(body)
+	body = json.dumps({
+		'dates': ['{:%Y-%m-%d}'.format(date) for date in dates],
+		'codes': dict((code, label) for label, code in LABELS),
+		'detectors': dict((str(det), ''.join(days)) for det, days in codes.items()),
+	})
 	return proxy_response(body)
 
-def proxy_response(body):
+def handle_plots(path, query):
+	"""
+	Return JSON plot data for several FATVs at once, `fatvs` being a comma
+	separated list, as an object keyed by FATV. Unknown FATVs are left out.
+	"""
+	if query.get("date", ""):
+		date = query['date']
+	else:
+		date = manifest.latest('daily')
+	fatvs = [int(fatv) for fatv in query['fatvs'].split(',') if fatv]
+
+	# Plots recorded by fb-analyze are passed through
+	try:
+		index = get_json(index_key(date))
+	except ClientError as e:
+		logger.info("No recorded plots for {}, computing from flows".format(date))
+	else:
+		parts = []
+		for fatv in fatvs:
+			if str(fatv) not in index:
+				continue
+			offset, length = index[str(fatv)]
+			parts.append('"{}": {}'.format(fatv, get_range(plot_key(date), offset, length).decode('utf-8')))
+		return proxy_response('{' + ', '.join(parts) + '}')
+
+	df_cfatv = get_cfatv()
+	df_cfatv = df_cfatv.loc[[fatv for fatv in fatvs if fatv in df_cfatv.index]]
+
+	# Every FATV's detectors are decoded together
+	members = set(det for side in ['IN', 'OUT'] for dets in df_cfatv[side] for det in dets)
+	df_piv = get_df('data/flows/' + date, columns = members)
+
+	bodies = {}
+	for fatv, (fd_in, fd_out) in df_cfatv[['IN', 'OUT']].iterrows():
+		in_data = df_piv[fd_in].sum(axis = 1, skipna = False)
+		out_data = df_piv[fd_out].sum(axis = 1, skipna = False)
+		bodies[str(fatv)] = plot_body(fd_in, fd_out, in_data, out_data)
+
+	return proxy_response(json.dumps(bodies))
+
+def handle_history(path, query):
+	"""
+	Return JSON plot data over many days for a FATV (history/fatv/<id>) or a
+	detector (history/detector/<id>), four weeks to the latest date by default
+	"""
+	from flowbalance import history
+
+	if query.get("end", ""):
+		end = parse_day(query['end'])
+	else:
+		end = parse_day(manifest.latest('daily'))
+	if query.get("start", ""):
+		start = parse_day(query['start'])
+	else:
+		start = end - dt.timedelta(days = 27)
+	if not 0 <= (end - start).days < MAX_DAYS:
+		return error_response(400, "History is served for 1 to {} days".format(MAX_DAYS))
+
+	kind, ident = path[1], int(path[2])
+	if kind == 'fatv':
+		df_cfatv = get_cfatv()
+		if ident not in df_cfatv.index:
+			return error_response(404, "No FATV {}".format(ident))
+		fd_in, fd_out = df_cfatv.loc[ident]
+
+		# Only the FATV's own detectors are read from the store
+		df_piv = history.series(fd_in + fd_out, start, end)
+		in_data = df_piv[fd_in].sum(axis = 1, skipna = False)
+		out_data = df_piv[fd_out].sum(axis = 1, skipna = False)
+		body = plot_body(fd_in, fd_out, in_data, out_data, history.STEP)
+	elif kind == 'detector':
+		df_piv = history.series([ident], start, end)
+		body = {'detector': ident, 'data': trace(str(ident), df_piv[ident], history.STEP)}
+	else:
+		raise ValueError("Bad history request {}".format('/'.join(path)))
+
+	return proxy_response(json.dumps(body))
+
+def handle_health(path, query):
+	"""
+	Return the `count` worst detectors seen within the last `days` days, ranked by their health
+	"""
+	from flowbalance import health
+
+	count = int(query.get("count", 20))
+	days = int(query.get("days", 7))
+
+	df_health = health.worst(health.load(), count, days)
+	df_health.index.name = 'id'
+	body = df_health.reset_index().to_json(orient = 'records', date_format = 'iso')
+	return proxy_response(body)
+
+def parse_day(s):
+	from dateutil.parser import parse as parse_date
+	return parse_date(s).date()
+
+def proxy_response(body, status = 200):
 	# AWS apigateway CORS is broken AF for some reason... manually added ACAO header
 	return {
-		'statusCode': 200,
+		'statusCode': status,
 		'headers': {'access-control-allow-origin': '*'}, # dirty hack
 		'body': body
 	}
 
-def ls_key(key):
-	ls = s3.list_objects(Bucket = 'flow-balance', Prefix = key)
-	return [item['Key'] for item in ls['Contents']]
-
-def put_str(s, key):
-	store = io.BytesIO(s)
-	s3.upload_fileobj(store, 'flow-balance', key)
+def error_response(status, message):
+	return proxy_response(json.dumps({'error': message}), status)
 
-def get_df(key):
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', key, store)
-	store.seek(0)
-	df_store = pd.read_csv(store, index_col = 0)
-	return df_store
+def encode_response(response, headers):
+	"""
+	Gzip the response body for clients that accept it, unless it is too small
+	to be worth it. The compressed body is passed to API Gateway base64
+	encoded, which leaves it as binary (see its binary media types).
+	"""
+	accepted = dict((name.lower(), value) for name, value in headers.items()).get('accept-encoding', '')
+	body = response['body']
+	if 'gzip' not in accepted or len(body) < GZIP_MIN_BYTES:
+		return response
 
-def put_df(df, key):
+	if not isinstance(body, bytes):
+		body = body.encode('utf-8')
 	store = io.BytesIO()
-	df.to_csv(store)
-	store.seek(0)
-	s3.upload_fileobj(store, 'flow-balance', key)
+	with gzip.GzipFile(fileobj = store, mode = 'wb', compresslevel = 6) as file:
+		file.write(body)
 
-def get_cfatv():
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', 'info/fatvs.json', store)
-	store.seek(0)
-	df_cfatv = pd.read_json(store, orient = 'index').sort_index()
-	return df_cfatv
+	response['body'] = base64.b64encode(store.getvalue()).decode('ascii')
+	response['headers']['content-encoding'] = 'gzip'
+	response['isBase64Encoded'] = True
+	return response
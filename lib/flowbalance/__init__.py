@@ -0,0 +1,3 @@
+"""
+Shared flow-balance code, packaged alongside each lambda_function.py by build/build-pack.
+"""
@@ -0,0 +1,58 @@
+import json
+
+class Adjacency(object):
+	"""
+	Detector neighborhoods, built once by fb-model from the FATVs.
+
+	`detectors` maps each detector to (FATV IN, FATV OUT), the FATVs it is an
+	incoming and outgoing member of, either of which may be None. The FATVs
+	neighboring a FATV are those of its members.
+	"""
+	def __init__(self, detectors):
+		self.detectors = detectors
+
+	@classmethod
+	def from_fatvs(cls, df_cfatv):
+		detectors = {}
+		for half, side in enumerate(['IN', 'OUT']):
+			for fid, members in df_cfatv[side].items():
+				for det in members:
+					pair = detectors.setdefault(det, [None, None])
+					# A detector belongs to at most one FATV per side, keep the first
+					if pair[half] is None:
+						pair[half] = fid
+
+		return cls({det: tuple(pair) for det, pair in detectors.items()})
+
+	@classmethod
+	def from_json(cls, s):
+		# Files written before may also map FATVs to their neighbors, which nothing read
+		raw = json.loads(s)
+		return cls({int(det): tuple(pair) for det, pair in raw['detectors'].items()})
+
+	def to_json(self):
+		fid = lambda f: None if f is None else int(f)
+		return json.dumps({
+			'detectors': {str(det): [fid(f) for f in pair] for det, pair in self.detectors.items()},
+		})
+
+	def fatv_in(self, det):
+		"""
+		The FATV that `det` flows into, or None
+		"""
+		return self.detectors.get(det, (None, None))[0]
+
+	def fatv_out(self, det):
+		"""
+		The FATV that `det` flows out of, or None
+		"""
+		return self.detectors.get(det, (None, None))[1]
+
+	def frame(self):
+		"""
+		Return detector membership as a DataFrame with 'FATV IN' and 'FATV OUT' columns
+		"""
+		import pandas as pd
+		return pd.DataFrame.from_dict(
+			self.detectors, orient = 'index', columns = ['FATV IN', 'FATV OUT'], dtype = object
+		)
@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import datetime as dt
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Incidence(object):
+	"""
+	FATV x detector incidence over a fixed ordering of detectors.
+
+	Each FATV row has +1 for IN members and -1 for OUT members in `signed`.
+	Internally the IN and OUT halves are stacked into one (2F x D) matrix so
+	that every FATV's per-interval in/out series comes from a single product.
+	"""
+	def __init__(self, df_cfatv, stations):
+		self.fatvs = df_cfatv.index
+		self.stations = pd.Index(stations)
+
+		n = len(self.fatvs)
+		rows, cols = [], []
+		self.illformed = np.zeros(n, dtype = bool)
+		for half, side in enumerate(['IN', 'OUT']):
+			for pos, members in enumerate(df_cfatv[side]):
+				loc = self.stations.get_indexer(members)
+				if (loc < 0).any():
+					self.illformed[pos] = True
+				loc = loc[loc >= 0]
+				rows.append(np.full(len(loc), half * n + pos, dtype = int))
+				cols.append(loc)
+
+		rows = np.concatenate(rows) if rows else np.array([], dtype = int)
+		cols = np.concatenate(cols) if cols else np.array([], dtype = int)
+		# Duplicate members sum, just as repeated columns would in df_piv[members]
+		self.matrix = sparse.coo_matrix(
+			(np.ones(len(rows)), (rows, cols)),
+			shape = (2 * n, len(self.stations))
+		).tocsr()
+
+		for fid in self.fatvs[self.illformed]:
+			logger.debug("Cannot account FATV {}, illformed FATV or bad meta?".format(fid))
+
+	@property
+	def signed(self):
+		n = len(self.fatvs)
+		return self.matrix[:n] - self.matrix[n:]
+
+	def _product(self, df_piv):
+		"""
+		Return (T x 2F) member sums and member NaN counts for the pivoted flows.
+		"""
+		values = df_piv.reindex(columns = self.stations).values.astype(float)
+		mask = np.isnan(values)
+		values[mask] = 0
+		sums = np.asarray(self.matrix.dot(values.T)).T
+		nans = np.asarray(self.matrix.dot(mask.T.astype(float))).T
+		return sums, nans
+
+	def series(self, df_piv):
+		"""
+		Return (ins, outs) DataFrames of per-interval FATV flow sums, NaN wherever
+		any member reported NaN. Illformed FATVs are NaN throughout.
+		"""
+		n = len(self.fatvs)
+		sums, nans = self._product(df_piv)
+		sums[nans > 0] = np.nan
+		sums[:, np.concatenate([self.illformed, self.illformed])] = np.nan
+		ins = pd.DataFrame(sums[:, :n], index = df_piv.index, columns = self.fatvs)
+		outs = pd.DataFrame(sums[:, n:], index = df_piv.index, columns = self.fatvs)
+		return ins, outs
+
+	def running(self, df_piv):
+		"""
+		Return the Running balance of every FATV over the pivoted flows
+		"""
+		return Running(self, df_piv)
+
+	def account(self, df_piv, missing = 0.05):
+		"""
+		Return the whole-day DIF, VOL and ERR of every FATV. FATVs with any side
+		missing more than `missing` of its intervals are left NaN.
+		"""
+		return self.running(df_piv).account(0, len(df_piv.index), missing)
+
+	def member_totals(self, df_piv, running, spans, chunk = 2**14):
+		"""
+		Return a sparse (F x D) matrix per [start, stop) of `spans`: each member's
+		flow over the span, +IN and -OUT, counting only the intervals where its
+		FATV is valid in `running`. The row of a FATV sums to its DIF from
+		running.account, and its absolute values to its VOL.
+		"""
+		n = len(self.fatvs)
+		entries = self.matrix.tocoo()
+		fatv = entries.row % n
+		sign = np.where(entries.row < n, entries.data, -entries.data)
+		values = np.nan_to_num(df_piv.reindex(columns = self.stations).values.astype(float))
+		spans = np.asarray(spans, dtype = int).reshape(-1, 2)
+
+		# The running total of every (FATV, member) entry, a chunk of entries at a time
+		totals = np.empty((len(spans), len(fatv)))
+		for first in range(0, len(fatv), chunk):
+			part = slice(first, first + chunk)
+			flows = cumulative(np.where(running.valid[:, fatv[part]], values[:, entries.col[part]], 0))
+			totals[:, part] = flows[spans[:, 1]] - flows[spans[:, 0]]
+
+		shape = (n, len(self.stations))
+		return [sparse.csr_matrix((sign * total, (fatv, entries.col)), shape = shape) for total in totals]
+
+class Running(object):
+	"""
+	Running totals of every FATV's balance from the first interval of a pivot,
+	so that the balance over any span of intervals costs one difference.
+
+	Row t of each total covers intervals [0, t), `valid` marks the (T x F)
+	intervals where neither side of a FATV has a NaN member.
+	"""
+	def __init__(self, incidence, df_piv):
+		self.fatvs = incidence.fatvs
+		self.illformed = incidence.illformed
+
+		n = len(self.fatvs)
+		sums, nans = incidence._product(df_piv)
+		nan_in, nan_out = nans[:, :n] > 0, nans[:, n:] > 0
+
+		# Intervals where either side is NaN do not count toward the totals
+		self.valid = ~(nan_in | nan_out)
+		self.ins = cumulative(np.where(self.valid, sums[:, :n], 0))
+		self.outs = cumulative(np.where(self.valid, sums[:, n:], 0))
+		self.count = cumulative(self.valid)
+		self.missing_in = cumulative(nan_in)
+		self.missing_out = cumulative(nan_out)
+
+	def account(self, start, stop, missing = 0.05):
+		"""
+		Return the DIF, VOL and ERR of every FATV over intervals [start, stop),
+		as Incidence.account does for a whole day.
+		"""
+		ins = self.ins[stop] - self.ins[start]
+		outs = self.outs[stop] - self.outs[start]
+		vol = ins + outs
+		dif = ins - outs
+
+		samples = float(stop - start)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			bad = ((self.missing_in[stop] - self.missing_in[start]) / samples >= missing) \
+				| ((self.missing_out[stop] - self.missing_out[start]) / samples >= missing)
+		bad |= self.illformed | (samples == 0)
+		vol[bad] = np.nan
+		dif[bad] = np.nan
+
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			err = np.abs(dif) / vol
+
+		return pd.DataFrame({'ERR': err, 'VOL': vol, 'DIF': dif}, index = self.fatvs)
+
+def cumulative(values):
+	"""
+	Cumulative sums down the rows of `values`, starting from a row of zeros
+	"""
+	values = np.asarray(values, dtype = float)
+	total = np.zeros((len(values) + 1,) + values.shape[1:])
+	np.cumsum(values, axis = 0, out = total[1:])
+	return total
+
+def time_of_day(time):
+	"""
+	Seconds since midnight of a datetime.time, or of a time string as given to DataFrame.between_time
+	"""
+	if not isinstance(time, dt.time):
+		for format in ['%H:%M', '%H:%M:%S']:
+			try:
+				time = dt.datetime.strptime(time, format).time()
+				break
+			except ValueError:
+				pass
+		else:
+			raise ValueError("Cannot convert {!r} to a time".format(time))
+	return time.hour * 3600 + time.minute * 60 + time.second
+
+def window_bounds(index, windows):
+	"""
+	Return the interval positions [start, stop) in one day's sorted time `index`
+	of each (start, stop) time of day window. Like DataFrame.between_time, both
+	ends of a window are inclusive.
+	"""
+	index = pd.DatetimeIndex(pd.to_datetime(index))
+	seconds = np.asarray((index - index.normalize()).total_seconds())
+	if (np.diff(seconds) < 0).any():
+		raise ValueError("Windows need one day of intervals in order")
+
+	bounds = []
+	for start, stop in windows:
+		first, last = time_of_day(start), time_of_day(stop)
+		if last < first:
+			raise ValueError("Window {}-{} crosses midnight".format(start, stop))
+		bounds.append((
+			int(np.searchsorted(seconds, first, side = 'left')),
+			int(np.searchsorted(seconds, last, side = 'right'))
+		))
+	return bounds
@@ -0,0 +1,203 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import lsqr
+
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+# Thresholds of the implication heuristic, as (error, neighbor error, reduction):
+# FATVs with more than `error` are examined, neighbors with less than `neighbor
+# error` are not blamed, and a shared detector is blamed when accounting both
+# FATVs together leaves less than `reduction` of the error. scripts/sweep.py
+# compares the labels of other thresholds over many days.
+THRESHOLDS = (0.025, 0.01, 0.15)
+
+# Engines that label the detectors in error and the singletons: 'implicate'
+# blames detectors between two FATVs in error a pair at a time, 'calibrate'
+# finds a scale factor per detector that balances every FATV at once. The
+# event's 'engine' or FLOW_BALANCE_ENGINE chooses, 'implicate' by default.
+ENGINES = ['implicate', 'calibrate']
+
+# Calibration weighs moving a factor away from 1 as if DAMP of the volume of a
+# FATV were left unbalanced per unit moved, so factors move no further than
+# their FATVs need. Detectors between two accounted FATVs are in error where
+# their factor moves by more than MISCOUNT. The other members of their FATVs
+# take some of the blame, so a detector 30% over moves about 0.1.
+DAMP = 0.05
+MISCOUNT = 0.09
+
+def requested_engine(event = None):
+	"""
+	The engine asked for by the event or the environment
+	"""
+	chosen = (event or {}).get('engine') or os.environ.get('FLOW_BALANCE_ENGINE') or ENGINES[0]
+	if chosen not in ENGINES:
+		raise ValueError("Unknown engine {}, expected any of {}".format(chosen, ', '.join(ENGINES)))
+	return chosen
+
+def implicate(df_cfatv, adjacency, thresholds = THRESHOLDS):
+	"""
+	Blame detectors shared by FATVs in error, when accounting both FATVs together
+	mostly resolves the error. `df_cfatv` must have ERR, VOL and DIF per FATV,
+	as from Incidence.account.
+
+	Returns the implicated detectors, and the singleton detectors of FATVs in
+	error that belong to no other FATV.
+	"""
+	error, neighbor_error, reduction = thresholds
+
+	# Identify implicated detectors
+	singleton = set()
+	imp1, imp2 = [], []
+	for idx, fatv in df_cfatv[df_cfatv['ERR'] > error].iterrows():
+		neighbors = {}
+		for det in fatv['IN']:
+			nidx = adjacency.fatv_out(det)
+			if nidx is not None:
+				neighbors[det] = nidx
+			else:
+				singleton.add(det)
+		for det in fatv['OUT']:
+			nidx = adjacency.fatv_in(det)
+			if nidx is not None:
+				neighbors[det] = nidx
+			else:
+				singleton.add(det)
+
+		for det, neighbor in neighbors.items():
+			pair = df_cfatv.loc[[idx, neighbor]]
+			# Ignore fatvs with low error, unlikely to be the fault of multiple
+			if pair.loc[neighbor]['ERR'] < neighbor_error:
+				continue
+			temp = pair.sum()
+			temp['ERR'] = abs(temp['DIF'])/temp['VOL']
+			# If combining FATVs reduces error by >85%, blame the mutual neighbor
+			if temp['ERR'] < reduction * fatv['ERR']:
+				if det in imp1:
+					imp2.append(det)
+					singleton -= set(temp['IN']) | set(temp['OUT'])
+				imp1.append(det)
+				logger.info("{} implicates {} from {}".format(neighbor, det, idx))
+
+	return imp2, singleton
+
+def calibrate(df_account, totals, stations, error = THRESHOLDS[0], damp = DAMP, miscount = MISCOUNT):
+	"""
+	Scale each detector's flow by the factor that best balances every accounted
+	FATV at once, in the least squares sense with every factor damped toward 1.
+	`totals` has the signed flow of each member of the FATVs of `df_account`
+	over `stations`, as from Incidence.member_totals.
+
+	Returns the detectors in error, the singleton detectors of FATVs still in
+	error once those are scaled, and the factor of every detector with flow in
+	an accounted FATV.
+	"""
+	accounted = np.flatnonzero(np.isfinite(df_account['ERR'].values))
+	vol = df_account['VOL'].values[accounted]
+	dif = df_account['DIF'].values[accounted]
+
+	# Each row is a FATV's balance in shares of its volume, solved for the change of each factor
+	shares = sparse.diags(1 / vol).dot(totals[accounted]).tocsc()
+	shares.eliminate_zeros()
+	fatvs = np.diff(shares.indptr)
+	used = np.flatnonzero(fatvs)
+	change = lsqr(shares[:, used], -dif / vol, damp = damp)[0]
+
+	# Detectors of one FATV could each be the one at fault, so only those of two
+	# are blamed. Their factors are then fit again alone and undamped, to leave
+	# the error they do not explain.
+	wrong = (fatvs[used] >= 2) & (np.abs(change) > miscount)
+	blamed = used[wrong]
+	if len(blamed):
+		change[wrong] = lsqr(shares[:, blamed], -dif / vol)[0]
+	scaled = np.zeros(len(stations))
+	scaled[blamed] = change[wrong]
+	left = np.abs(dif + totals[accounted].dot(scaled)) / vol
+
+	# Members of no other FATV, of those still in error
+	lone = np.flatnonzero(np.diff(totals.tocsc().indptr) == 1)
+	remaining = totals[accounted[left > error]].indices
+	singleton = {int(det) for det in stations[np.intersect1d(remaining, lone)]}
+
+	factors = pd.Series(1 + change, index = stations[used])
+	for det in stations[blamed]:
+		logger.info("{} miscounts by {:.3f}".format(det, 1 / factors[det]))
+	return [int(det) for det in stations[blamed]], singleton, factors
+
+def unknown(df_cfatv):
+	"""
+	Members of the FATVs that could not be accounted
+	"""
+	unaccounted = df_cfatv[df_cfatv['ERR'].isnull()]
+	return {det for side in ['IN', 'OUT'] for members in unaccounted[side] for det in members}
+
+class Implications(object):
+	"""
+	The labels implicate() gives for many thresholds at once.
+
+	Every (FATV, member, neighbor) that implicate() could examine is found
+	once from the FATVs, then each day's accounts decide, for every threshold
+	at once, which of them implicate the member. A detector is in error where
+	both of its FATVs implicate it, and the singletons of FATVs in error are
+	cleared wherever a detector of their FATV is. implicate() may clear a
+	singleton before adding it only if the clearing comes from an earlier
+	FATV, which is never one of the singleton's own, so the order in which it
+	visits FATVs does not change the labels.
+	"""
+	def __init__(self, df_cfatv, adjacency):
+		self.fatvs = df_cfatv.index
+		owner, members, across = [], [], []
+		lone_owner, lone = [], []
+		for pos, (ins, outs) in enumerate(zip(df_cfatv['IN'], df_cfatv['OUT'])):
+			neighbors = {}
+			for det, nidx in [(det, adjacency.fatv_out(det)) for det in ins] + [(det, adjacency.fatv_in(det)) for det in outs]:
+				if nidx is not None:
+					neighbors[det] = nidx
+				else:
+					lone_owner.append(pos)
+					lone.append(det)
+			owner += [pos] * len(neighbors)
+			members += list(neighbors)
+			across += list(neighbors.values())
+
+		self.owner = np.array(owner, dtype = int)
+		self.across = self.fatvs.get_indexer(across)
+		self.detectors, member = np.unique(np.array(members, dtype = np.int64), return_inverse = True)
+		self.lone_owner = np.array(lone_owner, dtype = int)
+		self.singletons, single = np.unique(np.array(lone, dtype = np.int64), return_inverse = True)
+
+		# (pairs x detectors), (detectors x FATVs) and (lone members x singletons)
+		pairs = np.arange(len(self.owner))
+		ones = lambda n: np.ones(n, dtype = np.float32)
+		self.blames = sparse.csr_matrix((ones(len(pairs)), (pairs, member)), shape = (len(pairs), len(self.detectors)))
+		self.belongs = sparse.csr_matrix((ones(len(pairs)), (member, self.owner)), shape = (len(self.detectors), len(self.fatvs)))
+		self.lonely = sparse.csr_matrix((ones(len(lone)), (np.arange(len(lone)), single)), shape = (len(lone), len(self.singletons)))
+
+	def sweep(self, df_account, grid):
+		"""
+		Masks over `detectors` of those in error and over `singletons` of the
+		singletons, one row per (error, neighbor error, reduction) of `grid`,
+		from the ERR, VOL and DIF of each FATV in `df_account`
+		"""
+		grid = np.atleast_2d(np.asarray(grid, dtype = float))
+		error, neighbor_error, reduction = grid[:, 0:1], grid[:, 1:2], grid[:, 2:3]
+		df_account = df_account.reindex(self.fatvs)
+		err = df_account['ERR'].values.astype(float)
+		dif = np.nan_to_num(df_account['DIF'].values.astype(float))
+		vol = np.nan_to_num(df_account['VOL'].values.astype(float))
+
+		# Accounting both FATVs of each pair together, blanks count as nothing as in a sum
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			combined = np.abs(dif[self.owner] + dif[self.across]) / (vol[self.owner] + vol[self.across])
+			examined = err[None, :] > error
+			implicates = (examined[:, self.owner]
+				& ~(err[self.across][None, :] < neighbor_error)
+				& (combined[None, :] < reduction * err[self.owner][None, :]))
+
+		blamed = np.asarray(self.blames.T.dot(implicates.T.astype(np.float32))).T >= 2
+		cleared = np.asarray(self.belongs.T.dot(blamed.T.astype(np.float32))).T > 0
+		lone = examined[:, self.lone_owner] & ~cleared[:, self.lone_owner]
+		single = np.asarray(self.lonely.T.dot(lone.T.astype(np.float32))).T > 0
+		return blamed, single
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from flowbalance.history import STEP, SLOTS
+
+# Each day fb-daily pivots the 5 minute station_5min rows into data/flows, one
+# column per station blank where the station was not observed enough, and
+# records the mean percent observed of each station in data/observed.
+
+# Stations observed at most this percent of the day are blanked
+OBSERVED = 50
+
+# Rows of station_5min handled at a time
+CHUNK_ROWS = 2**18
+
+def chunks(df, rows):
+	"""
+	Consecutive slices of at most `rows` rows, at least one even if empty
+	"""
+	for start in range(0, max(len(df), 1), rows):
+		yield df.iloc[start:start + rows]
+
+def accumulate(chunks, stations, date):
+	"""
+	Gather the station_5min rows of `stations` on `date` from `chunks`, dropping
+	the rest as they are read. Flows are pivoted by 5 minute slot straight into
+	a preallocated float32 array, and percent observed is kept only as a
+	running sum per station, so memory grows with the stations kept and not
+	with the district.
+
+	Returns the kept rows, the pivoted flows over the slots that appear
+	in station_5min, and each station's mean percent observed.
+	"""
+	stations = pd.Index(stations, name = 'Station')
+	start = pd.Timestamp(date)
+	flows = np.full((SLOTS, len(stations)), np.nan, dtype = np.float32)
+	observed = np.zeros(len(stations))
+	counts = np.zeros(len(stations))
+	seen = np.zeros(SLOTS, dtype = bool)
+
+	kept = []
+	for chunk in chunks:
+		offsets = np.asarray((pd.to_datetime(chunk['Timestamp'].values) - start) / STEP)
+		slots = offsets.astype(int)
+		if ((slots != offsets) | (slots < 0) | (slots >= SLOTS)).any():
+			raise ValueError("station_5min times off the 5 minute slots of {:%Y-%m-%d}".format(start))
+		seen[slots] = True
+
+		cols = stations.get_indexer(chunk['Station'].values)
+		mine = cols >= 0
+		chunk, slots, cols = chunk[mine], slots[mine], cols[mine]
+		flows[slots, cols] = chunk['Flow'].values
+
+		percent = chunk['Observed'].values.astype(float)
+		valid = ~np.isnan(percent)
+		observed += np.bincount(cols[valid], weights = percent[valid], minlength = len(stations))
+		counts += np.bincount(cols[valid], minlength = len(stations))
+		kept.append(chunk)
+
+	df_kept = pd.concat(kept, ignore_index = True)
+	index = pd.DatetimeIndex(start + STEP * np.flatnonzero(seen), name = 'Timestamp')
+	df_flows = pd.DataFrame(flows[seen], index = index, columns = stations)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		obv = pd.Series(observed / counts, index = stations)
+	return df_kept, df_flows, obv
+
+def unobserved(obv):
+	"""
+	The stations not observed enough, given the mean percent observed of each
+	"""
+	return obv.index[~(obv > OBSERVED)]
@@ -0,0 +1,86 @@
+import numpy as np
+
+class Graph(object):
+	"""
+	Directed graph held as integer indexed NumPy edge arrays, enough of one
+	to find FATVs without networkx. Nodes may be any hashable, including None,
+	and parallel edges are kept.
+
+	`nodes` lists each node by its index, `src` and `dst` give the endpoint
+	indices of each edge in the order edges were given.
+	"""
+	def __init__(self, edges, nodes = ()):
+		self.nodes = []
+		self.index = {}
+		for node in nodes:
+			self._node(node)
+
+		ends = [(self._node(o), self._node(d)) for o, d in edges]
+		ends = np.array(ends, dtype = np.intp).reshape(-1, 2)
+		self.src = ends[:, 0]
+		self.dst = ends[:, 1]
+
+	def _node(self, node):
+		i = self.index.get(node)
+		if i is None:
+			i = self.index[node] = len(self.nodes)
+			self.nodes.append(node)
+		return i
+
+	def labels(self):
+		"""
+		Label each node with the least node index in its weakly connected component
+		"""
+		labels = np.arange(len(self.nodes))
+		src, dst = self.src, self.dst
+		while True:
+			# Hook the root of each edge's endpoints onto the lesser of the two.
+			# Roots only ever point to lesser roots, so no cycles can form.
+			low = np.minimum(labels[src], labels[dst])
+			np.minimum.at(labels, labels[src], low)
+			np.minimum.at(labels, labels[dst], low)
+
+			# Compress paths until every node points at its root
+			while True:
+				jumped = labels[labels]
+				if (jumped == labels).all():
+					break
+				labels = jumped
+
+			if (labels[src] == labels[dst]).all():
+				return labels
+
+	def components(self):
+		"""
+		Weakly connected components, as a list of sets of nodes
+		"""
+		return [set(self.nodes[i] for i in part) for part in split(self.labels())]
+
+	def boundary(self, member, count):
+		"""
+		Edges crossing into and out of each of `count` groups of nodes, where
+		`member` gives each node's group, or -1 for none.
+		Returns lists of incoming and outgoing edge indices per group.
+		"""
+		src, dst = member[self.src], member[self.dst]
+		cross = src != dst
+		ins = np.flatnonzero(cross & (dst >= 0))
+		outs = np.flatnonzero(cross & (src >= 0))
+		return bucket(ins, dst[ins], count), bucket(outs, src[outs], count)
+
+def split(labels):
+	"""
+	Indices sharing each distinct label, in order of label
+	"""
+	order = np.argsort(labels, kind = 'mergesort')
+	starts = np.flatnonzero(np.diff(labels[order])) + 1
+	return np.split(order, starts) if len(order) else []
+
+def bucket(items, keys, count):
+	"""
+	Split `items` by their integer `keys` in range(count), keeping their order
+	"""
+	order = np.argsort(keys, kind = 'mergesort')
+	bounds = np.searchsorted(keys[order], np.arange(count + 1))
+	items = items[order]
+	return [items[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+import json
+from botocore.exceptions import ClientError
+
+from flowbalance.storage import get_df, get_str, ls_key, put_df
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Per detector health across days, updated by fb-analyze as each day is diagnosed.
+# 'Error' is the exponentially decayed fraction of days diagnosed in error,
+# weighted by 'Weight', the decayed count of days the detector was in PeMS.
+# Streaks count consecutive days with each label, and 'Updated' is the last
+# day folded in. A day is folded onto the stored health only when it follows
+# the last day recorded, otherwise the health is rebuilt from every diagnosis
+# still under data/balance, so that a day diagnosed again, late or out of
+# order, and a record lost to two analyses writing at once, are set right.
+HEALTH_KEY = 'info/health'
+BALANCE_PREFIX = 'data/balance/'
+HALF_LIFE = 7 # days
+DECAY = 0.5 ** (1.0 / HALF_LIFE)
+
+STREAKS = {
+	'error': 'Error Streak',
+	'unobv': 'Unobv Streak',
+	'unknown': 'Unknown Streak',
+}
+COLUMNS = ['Error', 'Weight'] + list(STREAKS.values()) + ['Last Seen', 'Updated']
+
+def empty():
+	df_health = pd.DataFrame(columns = COLUMNS, index = pd.Index([], dtype = np.int64))
+	return df_health.astype({'Last Seen': 'datetime64[ns]', 'Updated': 'datetime64[ns]'})
+
+def load():
+	try:
+		return get_df(HEALTH_KEY)
+	except ClientError as e:
+		logger.info("No detector health recorded yet")
+		return empty()
+
+def update(df_health, date, present, diagnosis):
+	"""
+	Fold one day's diagnosis into the health of every detector, those `present`
+	in that day's PeMS meta and those seen before. Days must be given in order.
+	"""
+	date = pd.Timestamp(date)
+	present = pd.Index(present)
+	df = df_health.reindex(df_health.index.union(present))
+
+	new = df['Updated'].isnull()
+	df.loc[new, ['Error', 'Weight'] + list(STREAKS.values())] = 0
+
+	# Days since each detector was last updated
+	gap = (date - df['Updated']).dt.days.fillna(1).values
+	decay = DECAY ** gap
+	seen = df.index.isin(present)
+
+	# Decayed mean of the daily error verdicts, over days the detector was seen
+	weight = df['Weight'].values * decay
+	erred = df.index.isin(diagnosis['error']) & seen
+	total = df['Error'].values * weight + erred
+	df['Weight'] = weight + seen
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		df['Error'] = np.where(df['Weight'] > 0, total / df['Weight'], 0)
+
+	# Streaks continue only from the day before
+	for label, column in STREAKS.items():
+		labelled = df.index.isin(diagnosis[label]) & seen
+		df[column] = np.where(labelled, np.where(gap == 1, df[column] + 1, 1), 0).astype(int)
+
+	df.loc[seen, 'Last Seen'] = date
+	df['Updated'] = date
+	return df
+
+def diagnosed(date):
+	"""
+	The detectors present on `date` and its diagnosis, as stored
+	"""
+	key = '{:%Y-%m-%d}'.format(pd.Timestamp(date))
+	return get_df('data/detectors/' + key).index, json.loads(get_str(BALANCE_PREFIX + key))
+
+def rebuild(given = None):
+	"""
+	Recompute and store the detector health from every stored diagnosis, in
+	order. `given` maps dates to their (present, diagnosis) where known.
+	"""
+	given = given or {}
+	dates = set(pd.Timestamp(key[len(BALANCE_PREFIX):]) for key in ls_key(BALANCE_PREFIX) if '.' not in key[len(BALANCE_PREFIX):])
+	df_health = empty()
+	for date in sorted(dates | set(given)):
+		try:
+			present, diagnosis = given.get(date) or diagnosed(date)
+		except ClientError as e:
+			logger.warning("No detectors or diagnosis of {:%Y-%m-%d}, left out of health".format(date))
+			continue
+		df_health = update(df_health, date, present, diagnosis)
+	logger.info("Rebuilt detector health from {} days".format(len(dates)))
+	put_df(df_health, HEALTH_KEY)
+	return df_health
+
+def record(date, present = None, diagnosis = None):
+	"""
+	Update the stored detector health with the diagnosis of `date`, read from
+	data/detectors and data/balance unless given. Unless `date` follows the
+	last recorded day, the health is rebuilt.
+	"""
+	date = pd.Timestamp(date).normalize()
+	if present is None or diagnosis is None:
+		present, diagnosis = diagnosed(date)
+
+	df_health = load()
+	if not len(df_health) or df_health['Updated'].max() != date - pd.Timedelta(days = 1):
+		return rebuild({date: (present, diagnosis)})
+
+	df_health = update(df_health, date, present, diagnosis)
+	put_df(df_health, HEALTH_KEY)
+	return df_health
+
+def worst(df_health, count = 20, days = 7):
+	"""
+	Rank the detectors seen in the last `days` days by their decayed error
+	and then their error streak, worst first
+	"""
+	if not len(df_health):
+		return df_health
+	recent = df_health['Last Seen'] > df_health['Updated'].max() - pd.Timedelta(days = days)
+	ranked = df_health[recent].sort_values(['Error', 'Error Streak'], ascending = False)
+	return ranked.head(count)
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from multiprocessing.pool import ThreadPool
+from botocore.exceptions import ClientError
+
+from flowbalance.storage import get_range, put_str
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The historical flow store keeps one block per day under data/history/, so
+# that recording a day writes that day alone. A block starts with a header,
+# the number of stations and then their ids in ascending order, followed by
+# a float32 row per station holding every 5 minute slot of the day.
+# Unrecorded slots are NaN. Each block describes itself, so days recorded
+# concurrently never depend on a shared index.
+STEP = pd.Timedelta(minutes = 5)
+SLOTS = int(pd.Timedelta(days = 1) / STEP)
+DTYPE = np.dtype('<f4') # Counts are exact in float32
+ID = np.dtype('<i8')
+ROW = SLOTS * DTYPE.itemsize
+GAP = 16 # Rows read through rather than split into another request
+THREADS = 16
+
+def block_key(day):
+	return 'data/history/{:%Y-%m-%d}'.format(day)
+
+def append(df_piv):
+	"""
+	Record a day of pivoted flows as its block, replacing any recorded before
+	"""
+	if df_piv.empty:
+		return
+
+	index = pd.DatetimeIndex(pd.to_datetime(df_piv.index))
+	day = index[0].normalize()
+	cols = np.asarray((index - day) / STEP).astype(int)
+	if cols.max() >= SLOTS:
+		raise ValueError("History is recorded one day at a time")
+
+	stations = np.unique(np.asarray(df_piv.columns, dtype = ID))
+	block = np.full((len(stations), SLOTS), np.nan, dtype = DTYPE)
+	rows = pd.Index(stations).get_indexer(df_piv.columns)
+	block[np.ix_(rows, cols)] = df_piv.values.T
+
+	header = np.concatenate([[len(stations)], stations]).astype(ID)
+	put_str(header.tobytes() + block.tobytes(), block_key(day))
+	logger.info("Recorded {} stations into {}".format(len(stations), block_key(day)))
+
+def runs(rows):
+	"""
+	[first, last] spans of the sorted `rows`, joined where at most GAP apart
+	"""
+	spans = []
+	for row in rows:
+		if spans and row - spans[-1][1] <= GAP:
+			spans[-1][1] = row
+		else:
+			spans.append([row, row])
+	return spans
+
+def stations_of(day):
+	"""
+	The stations recorded on `day` in the order of its rows, None if not recorded
+	"""
+	key = block_key(day)
+	try:
+		count = int(np.frombuffer(get_range(key, 0, ID.itemsize), dtype = ID)[0])
+	except ClientError as e:
+		logger.debug("No history for {:%Y-%m-%d}".format(day))
+		return None
+	return np.frombuffer(get_range(key, ID.itemsize, count * ID.itemsize), dtype = ID)
+
+def series(stations, start, end):
+	"""
+	Return the recorded flows of `stations` from date `start` through date `end`,
+	as a pivot indexed by time with a column per station. Only the rows of the
+	requested stations are read, one range request per day for stations
+	recorded close together, concurrently.
+	"""
+	start = pd.Timestamp(start).normalize()
+	stop = pd.Timestamp(end).normalize() + pd.Timedelta(days = 1)
+	index = pd.date_range(start, periods = int((stop - start) / STEP), freq = STEP)
+	columns = sorted(set(stations))
+	values = np.full((len(index), len(columns)), np.nan)
+	days = list(pd.date_range(start, stop - pd.Timedelta(days = 1), freq = 'D'))
+
+	pool = ThreadPool(THREADS)
+	try:
+		headers = pool.map(stations_of, days)
+
+		# (day, first row, last row, (row, column) of each station) of each request
+		requests = []
+		for day, recorded in zip(days, headers):
+			if recorded is None:
+				continue
+			rows = pd.Index(recorded).get_indexer(columns)
+			wanted = sorted((row, col) for col, row in enumerate(rows) if row >= 0)
+			offset = ID.itemsize * (len(recorded) + 1)
+			for first, last in runs([row for row, col in wanted]):
+				requests.append((day, offset, first, last, [(row, col) for row, col in wanted if first <= row <= last]))
+
+		def read(request):
+			day, offset, first, last, wanted = request
+			data = get_range(block_key(day), offset + first * ROW, (last + 1 - first) * ROW)
+			return np.frombuffer(data, dtype = DTYPE).reshape(-1, SLOTS)
+
+		blocks = pool.map(read, requests)
+	finally:
+		pool.close()
+		pool.join()
+
+	for (day, offset, first, last, wanted), block in zip(requests, blocks):
+		at = int((day - start) / STEP)
+		for row, col in wanted:
+			values[at:at + SLOTS, col] = block[row - first]
+
+	return pd.DataFrame(values, index = index, columns = columns)
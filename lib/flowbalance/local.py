@@ -0,0 +1,94 @@
+from botocore.exceptions import ClientError
+
+import datetime as dt
+import hashlib, io, os, shutil, time
+
+class LocalClient(object):
+	"""
+	Directory backed stand-in for the parts of the boto3 S3 client that
+	flow-balance uses. Objects live at <root>/<bucket>/<key>.
+	Enable it for any lambda or script by setting FLOW_BALANCE_ROOT.
+	"""
+	def __init__(self, root):
+		self.root = root
+
+	def _path(self, bucket, key):
+		return os.path.join(self.root, bucket, *key.split('/'))
+
+	def _missing(self, key, operation):
+		return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key}}, operation)
+
+	def get_object(self, Bucket, Key, IfNoneMatch = None, Range = None):
+		path = self._path(Bucket, Key)
+		if not os.path.isfile(path):
+			raise self._missing(Key, 'GetObject')
+		with open(path, 'rb') as file:
+			if Range is not None:
+				# Only the range is read, as for S3
+				start, stop = Range.split('=')[1].split('-')
+				file.seek(int(start))
+				data = file.read(int(stop) + 1 - int(start) if stop else -1)
+				return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+			data = file.read()
+
+		etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+		if IfNoneMatch == etag:
+			raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+
+		return {'Body': io.BytesIO(data), 'ETag': etag, 'ContentLength': len(data)}
+
+	def put_object(self, Bucket, Key, Body):
+		path = self._path(Bucket, Key)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		data = Body.read() if hasattr(Body, 'read') else Body
+		with open(path, 'wb') as file:
+			file.write(data)
+		return {'ETag': '"{}"'.format(hashlib.md5(data).hexdigest())}
+
+	def download_fileobj(self, Bucket, Key, Fileobj):
+		shutil.copyfileobj(self.get_object(Bucket, Key)['Body'], Fileobj)
+
+	def upload_fileobj(self, Fileobj, Bucket, Key):
+		self.put_object(Bucket, Key, Fileobj.read())
+
+	def list_objects(self, Bucket, Prefix = '', Marker = '', MaxKeys = 1000):
+		top = os.path.join(self.root, Bucket)
+		objects = []
+		for path, dirs, files in os.walk(top):
+			for name in files:
+				key = os.path.relpath(os.path.join(path, name), top).replace(os.sep, '/')
+				if key.startswith(Prefix) and key > Marker:
+					modified = dt.datetime.utcfromtimestamp(os.path.getmtime(os.path.join(path, name)))
+					objects.append({'Key': key, 'LastModified': modified})
+		if not objects:
+			return {'IsTruncated': False} # As S3 does, without 'Contents'
+		objects.sort(key = lambda item: item['Key'])
+		return {'Contents': objects[:MaxKeys], 'IsTruncated': len(objects) > MaxKeys}
+
+class LocalPems(object):
+	"""
+	Directory backed stand-in for the PeMS downloader of ams-core, as used by
+	fb-daily. Each file is one download saved as <root>/<name>/<YYYY-MM-DD>,
+	in any format storage reads, and the meta releases are the dates under
+	<root>/meta. `latency` seconds are spent on every download, as if remote.
+	Enable it for fb-daily by setting FLOW_BALANCE_PEMS.
+	"""
+	def __init__(self, root, latency = 0):
+		self.root = root
+		self.latency = latency
+		self.meta = {}
+
+	def update_meta(self, name, years = None):
+		releases = {}
+		for fname in os.listdir(os.path.join(self.root, name)):
+			date = dt.datetime.strptime(fname, '%Y-%m-%d').date()
+			if years is None or date.year in years:
+				releases[date] = os.path.join(self.root, name, fname)
+		self.meta[name] = releases
+
+	def download(self, name, date):
+		from flowbalance.storage import read_frame
+		time.sleep(self.latency)
+		with open(os.path.join(self.root, name, '{:%Y-%m-%d}'.format(date)), 'rb') as file:
+			return date, read_frame(file.read())
@@ -0,0 +1,59 @@
+import datetime as dt
+import json
+from botocore.exceptions import ClientError
+
+from flowbalance.storage import get_json, ls_key, ls_objects, put_str
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The dates available under data/, as each stage finishes a day it writes a
+# marker, info/manifest/<date>.<stage>. Stages finishing days at once never
+# write the same object, and so cannot undo each other's records.
+# load() gathers them: {'latest': {stage: date}, 'dates': {date: {stage: finished at}}}
+MARKER_PREFIX = 'info/manifest/'
+
+# The single manifest object of before the markers, still read for its days
+MANIFEST_KEY = 'info/manifest.json'
+
+# Where each stage's output can be listed, should there be no manifest
+PREFIXES = {
+	'daily': 'data/detectors/',
+	'analyze': 'data/balance/',
+}
+
+def marker_key(date, stage):
+	return '{}{:%Y-%m-%d}.{}'.format(MARKER_PREFIX, date, stage)
+
+def load():
+	"""
+	The manifest, from one listing of the markers
+	"""
+	try:
+		manifest = json.loads(json.dumps(get_json(MANIFEST_KEY))) # A copy to add to
+	except ClientError as e:
+		manifest = {'latest': {}, 'dates': {}}
+
+	for item in ls_objects(MARKER_PREFIX):
+		date, stage = item['Key'][len(MARKER_PREFIX):].split('.')
+		manifest['dates'].setdefault(date, {})[stage] = '{:%Y-%m-%dT%H:%M:%S}Z'.format(item['LastModified'])
+		manifest['latest'][stage] = max(date, manifest['latest'].get(stage, date))
+	return manifest
+
+def record(date, stage):
+	"""
+	Note that `stage` has finished `date`
+	"""
+	put_str(dt.datetime.utcnow().isoformat() + 'Z', marker_key(date, stage))
+
+def latest(stage):
+	"""
+	The latest date `stage` has finished as YYYY-MM-DD, from the manifest if
+	it knows, else by listing the stage's output
+	"""
+	date = load()['latest'].get(stage)
+	if date is None:
+		logger.info("No {} date in the manifest, listing {}".format(stage, PREFIXES[stage]))
+		dates = [key.split('/')[-1] for key in ls_key(PREFIXES[stage])]
+		date = sorted(date for date in dates if '.' not in date)[-1] # Not the copies beside a day
+	return date
@@ -0,0 +1,188 @@
+import json, os, sys, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO) # Metrics are logged whatever the level of the rest
+
+# Each lambda times its stages with a Metrics, which logs one JSON line per stage:
+# {"metric": lambda, "stage", "seconds", "peak_rss_mb", "read_bytes", "written_bytes"}
+# along with the invocation's dimensions (the date, the route). The last line of an
+# invocation is the stage "total". See scripts/metrics.py to aggregate them from logs.
+
+# Profilers run for an invocation if listed in the event's 'profile', or in
+# FLOW_BALANCE_PROFILE separated by commas. Each writes what it finds under
+# PROFILE_PREFIX followed by the invocation's output key.
+PROFILERS = ['cprofile', 'tracemalloc']
+PROFILE_PREFIX = 'profiles/'
+TOP_ALLOCATIONS = 50 # Lines listed by tracemalloc
+
+# Bytes this process has read from and written to storage
+moved = {'read': 0, 'written': 0}
+_lock = threading.Lock()
+_local = threading.local() # The stages open on each thread
+
+def count(direction, size):
+	"""
+	Note `size` bytes 'read' or 'written' by storage, against the process and
+	the stages open on the calling thread
+	"""
+	with _lock:
+		moved[direction] += size
+	for record in getattr(_local, 'stages', ()):
+		record[direction] += size
+
+def peak_rss():
+	"""
+	Peak resident memory of the process so far in MB, None where unknown
+	"""
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / (2.0 ** 20 if sys.platform == 'darwin' else 2.0 ** 10) # bytes on macOS, KB elsewhere
+
+def requested(event):
+	"""
+	The profilers asked for by the event or the environment
+	"""
+	asked = (event or {}).get('profile') or os.environ.get('FLOW_BALANCE_PROFILE', '')
+	if asked is True:
+		return list(PROFILERS)
+	if not isinstance(asked, list):
+		asked = [name.strip() for name in str(asked).split(',') if name.strip()]
+	for name in set(asked) - set(PROFILERS):
+		logger.warning("Unknown profiler {}, expected any of {}".format(name, ', '.join(PROFILERS)))
+	return [name for name in PROFILERS if name in asked]
+
+class Metrics(object):
+	"""
+	Time, memory and storage traffic of the stages of one invocation of `name`.
+	`dims` are logged with every stage, to tell invocations apart.
+
+	Stages may run on several threads at once. Bytes are counted against the
+	stages open on the thread that moved them, and the peak RSS is that of the
+	whole process at the end of the stage.
+	"""
+	def __init__(self, name, **dims):
+		self.name = name
+		self.dims = dims
+		self.stages = OrderedDict()
+		self.lock = threading.Lock() # Guards stages, which pool threads record into
+		self.start = time.time()
+		with _lock:
+			self.moved = dict(moved)
+
+	@contextmanager
+	def stage(self, stage):
+		"""
+		Record the block as `stage`
+		"""
+		record = {'read': 0, 'written': 0}
+		if not hasattr(_local, 'stages'):
+			_local.stages = []
+		_local.stages.append(record)
+		start = time.time()
+		try:
+			yield
+		finally:
+			record['seconds'] = time.time() - start
+			record['peak_rss_mb'] = peak_rss()
+			_local.stages.pop() # Stages on a thread close in the reverse order they open
+			with self.lock:
+				self.stages[stage] = record
+
+	def timed(self, stage, func, *args, **kwds):
+		"""
+		Call func, recording it as `stage`
+		"""
+		with self.stage(stage):
+			return func(*args, **kwds)
+
+	def seconds(self):
+		"""
+		The seconds spent in each stage, which may overlap, and in all as 'total'
+		"""
+		with self.lock:
+			seconds = OrderedDict((stage, record['seconds']) for stage, record in self.stages.items())
+		seconds['total'] = time.time() - self.start
+		return seconds
+
+	def total(self):
+		with _lock:
+			record = dict((direction, moved[direction] - self.moved[direction]) for direction in moved)
+		record['seconds'] = time.time() - self.start
+		record['peak_rss_mb'] = peak_rss()
+		return record
+
+	def emit(self):
+		"""
+		Log a line per stage, then one for the invocation as a whole
+		"""
+		with self.lock:
+			stages = list(self.stages.items())
+		for stage, record in stages + [('total', self.total())]:
+			line = dict(self.dims)
+			line.update({
+				'metric': self.name,
+				'stage': stage,
+				'seconds': round(record['seconds'], 4),
+				'peak_rss_mb': record['peak_rss_mb'] and round(record['peak_rss_mb'], 1),
+				'read_bytes': record['read'],
+				'written_bytes': record['written'],
+			})
+			logger.info(json.dumps(line, sort_keys = True))
+
+	@contextmanager
+	def profiled(self, event, key):
+		"""
+		Run the block under the profilers requested by `event` or the environment,
+		if any, and record their findings under PROFILE_PREFIX + key:
+		'.pstats' from cProfile, which sees only the calling thread, and
+		'.tracemalloc' listing the allocations still held at the end and the
+		peak of those traced, in python 3 only.
+		"""
+		profilers = requested(event)
+		profile, tracemalloc = None, None
+		if 'tracemalloc' in profilers:
+			try:
+				import tracemalloc
+			except ImportError:
+				logger.warning("tracemalloc needs python 3, allocations are not traced")
+			else:
+				tracemalloc.start()
+		if 'cprofile' in profilers:
+			import cProfile
+			profile = cProfile.Profile()
+			profile.enable()
+
+		try:
+			yield
+		finally:
+			if profile is not None:
+				profile.disable()
+			try:
+				self.record_profiles(PROFILE_PREFIX + key, profile, tracemalloc)
+			except Exception as e:
+				logger.exception("Profiles of {} not recorded".format(key))
+			finally:
+				if tracemalloc is not None:
+					tracemalloc.stop()
+
+	def record_profiles(self, key, profile, tracemalloc):
+		import marshal
+		from flowbalance.storage import put_str
+
+		# Before anything else is allocated
+		if tracemalloc is not None:
+			current, peak = tracemalloc.get_traced_memory()
+			lines = ['Traced {:.1f} MB at the end, {:.1f} MB at peak'.format(current / 2.0 ** 20, peak / 2.0 ** 20)]
+			lines += [str(stat) for stat in tracemalloc.take_snapshot().statistics('lineno')[:TOP_ALLOCATIONS]]
+			put_str('\n'.join(lines) + '\n', key + '.tracemalloc')
+			logger.info("Recorded allocations as {}.tracemalloc".format(key))
+		if profile is not None:
+			profile.create_stats()
+			put_str(marshal.dumps(profile.stats), key + '.pstats') # Read with pstats.Stats(file)
+			logger.info("Recorded cProfile stats as {}.pstats".format(key))
@@ -0,0 +1,79 @@
+import json, math
+
+def plot_key(date):
+	return 'data/plots/{}'.format(date)
+
+def index_key(date):
+	return 'data/plots/{}.index'.format(date)
+
+def regular(data):
+	"""
+	Reindex a series or frame onto a regular time grid, gaps in the samples become NaN.
+	Returns the reindexed data and the grid step.
+	"""
+	import pandas as pd
+	index = pd.to_datetime(data.index)
+	step = pd.Series(index).diff().min() if len(index) > 1 else pd.Timedelta(minutes = 5)
+	grid = pd.date_range(index[0], index[-1], freq = step) if len(index) else index
+	data = data.copy()
+	data.index = index
+	return data.reindex(grid), step
+
+def trace(name, ser, step):
+	"""
+	Plotly trace for a regularly sampled series, timestamps are encoded as start + step
+	"""
+	return {
+		'name': name,
+		'mode': 'lines',
+		'x0': str(ser.index[0]) if len(ser) else None,
+		'dx': int(step.total_seconds() * 1000), # Plotly date axes step in ms
+		'y': [None if math.isnan(n) else int(n) if n.is_integer() else n for n in ser.values.tolist()] # Counts as ints
+	}
+
+def plot_body(fd_in, fd_out, in_data, out_data, step = None):
+	"""
+	The fb-proxy plot response for one FATV, given its per-interval IN and OUT sums.
+	Without `step` the sums are first put on a regular grid.
+	"""
+	if step is None:
+		in_data, step = regular(in_data)
+		out_data, step = regular(out_data)
+
+	miscount = out_data.sum() - in_data.sum()
+	volume = in_data.sum() + out_data.sum()
+	relerr = miscount / volume if volume else float('nan')
+
+	return {
+		'IN': {
+			'detectors': fd_in,
+			'data': trace('IN', in_data, step)
+		},
+		'OUT': {
+			'detectors': fd_out,
+			'data': trace('OUT', out_data, step)
+		},
+		'stats': {
+			'miscount': float(miscount),
+			'volume': float(volume),
+			'relerr': None if math.isnan(relerr) else float(relerr)
+		}
+	}
+
+def pack_plots(df_cfatv, ins, outs):
+	"""
+	Serialize every FATV's plot body into one blob, returned with an index of
+	{fid: [offset, length]} so a single FATV can be served by a byte range read.
+	"""
+	ins, step = regular(ins)
+	outs, step = regular(outs)
+
+	parts, index = [], {}
+	offset = 0
+	for fid, (fd_in, fd_out) in df_cfatv[['IN', 'OUT']].iterrows():
+		body = plot_body(list(fd_in), list(fd_out), ins[fid], outs[fid], step)
+		part = json.dumps(body).encode('utf-8')
+		index[str(fid)] = [offset, len(part)]
+		parts.append(part)
+		offset += len(part)
+	return b''.join(parts), json.dumps(index)
@@ -0,0 +1,298 @@
+import boto3, io, json, os, threading
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+
+from flowbalance.adjacency import Adjacency
+from flowbalance.metrics import count
+
+import logging
+logger = logging.getLogger(__name__)
+
+BUCKET = os.environ.get('FLOW_BALANCE_BUCKET', 'flow-balance')
+
+# numpy and pandas are imported only where frames are decoded, so that
+# callers passing stored objects through start without them (fb-proxy)
+
+# Frames are written as parquet, or arrow for wide pivots (parquet pays per column).
+# Objects written before either are CSV, and are recognized by lacking a magic number.
+FORMAT = 'parquet'
+MAGIC = {
+	b'PAR1': 'parquet',
+	b'ARROW1': 'arrow',
+}
+
+_client = None
+def client():
+	"""
+	The process wide S3 client, or a directory backed stand-in if FLOW_BALANCE_ROOT is set
+	"""
+	global _client
+	if _client is None:
+		root = os.environ.get('FLOW_BALANCE_ROOT')
+		if root:
+			from flowbalance.local import LocalClient
+			_client = LocalClient(root)
+		else:
+			_client = boto3.client('s3')
+	return _client
+
+class ObjectCache(object):
+	"""
+	Least recently used cache of S3 objects, bounded by bytes held.
+
+	Each entry keeps the object's ETag, its raw bytes, and anything parsed
+	from them. Entries are revalidated with If-None-Match on every access,
+	so a warm container only downloads and parses objects that changed.
+	"""
+	def __init__(self, limit):
+		self.limit = limit
+		self.size = 0
+		self.entries = OrderedDict()
+		self.lock = threading.Lock() # Guards bookkeeping only, never held during a request
+
+	def _entry(self, bucket, key):
+		with self.lock:
+			entry = self.entries.get((bucket, key))
+		kwds = {'IfNoneMatch': entry['etag']} if entry else {}
+		try:
+			response = client().get_object(Bucket = bucket, Key = key, **kwds)
+		except ClientError as e:
+			if entry and e.response['Error']['Code'] in ('304', 'NotModified'):
+				self._admit(bucket, key, entry) # Refresh its recency
+				return entry
+			self.invalidate(key, bucket)
+			raise
+
+		data = response['Body'].read()
+		count('read', len(data))
+		entry = {'etag': response['ETag'], 'data': data, 'parsed': {}, 'size': len(data)}
+		self._admit(bucket, key, entry)
+		return entry
+
+	def _admit(self, bucket, key, entry):
+		with self.lock:
+			old = self.entries.pop((bucket, key), None)
+			if old:
+				self.size -= old['size']
+			if entry['size'] > self.limit:
+				return
+			self.entries[bucket, key] = entry
+			self.size += entry['size']
+			self._evict()
+
+	def _evict(self):
+		# With the lock held
+		while self.size > self.limit:
+			(b, k), old = self.entries.popitem(last = False)
+			self.size -= old['size']
+			logger.debug("Evicted s3://{}/{} from cache".format(b, k))
+
+	def get(self, key, bucket = None):
+		return self._entry(bucket or BUCKET, key)['data']
+
+	def parsed(self, key, tag, parse, sizeof = None, bucket = None):
+		"""
+		Return parse(data) for the object at key, memoized under tag until the object changes
+		"""
+		bucket = bucket or BUCKET
+		entry = self._entry(bucket, key)
+		parsed = entry['parsed']
+		if tag not in parsed:
+			value = parse(entry['data'])
+			size = sizeof(value) if sizeof else 0
+			with self.lock:
+				if tag not in parsed: # Unless parsed meanwhile by another thread
+					parsed[tag] = value
+					entry['size'] += size
+					# Only counted while cached, it may have been evicted meanwhile
+					if self.entries.get((bucket, key)) is entry:
+						self.size += size
+						del self.entries[bucket, key]
+						if entry['size'] > self.limit:
+							self.size -= entry['size']
+						else:
+							self.entries[bucket, key] = entry
+							self._evict()
+		return parsed[tag]
+
+	def invalidate(self, key, bucket = None):
+		with self.lock:
+			entry = self.entries.pop((bucket or BUCKET, key), None)
+			if entry:
+				self.size -= entry['size']
+
+cache = ObjectCache(int(os.environ.get('FLOW_BALANCE_CACHE_BYTES', 256 * 2**20)))
+
+def frame_size(df):
+	return int(df.memory_usage(index = True).sum())
+
+def get_str(key):
+	return cache.get(key)
+
+def get_json(key):
+	"""
+	Retrieve a JSON object, shared between callers and so not to be modified
+	"""
+	return cache.parsed(key, 'json', json.loads)
+
+def get_range(key, start, length):
+	"""
+	Retrieve `length` bytes of the object at key from `start`, bypassing the cache
+	"""
+	byte_range = 'bytes={}-{}'.format(start, start + length - 1)
+	data = client().get_object(Bucket = BUCKET, Key = key, Range = byte_range)['Body'].read()
+	count('read', len(data))
+	return data
+
+def put_str(s, key):
+	if not isinstance(s, bytes):
+		s = s.encode('utf-8')
+	cache.invalidate(key)
+	client().upload_fileobj(io.BytesIO(s), BUCKET, key)
+	count('written', len(s))
+
+def put_file(file, key):
+	"""
+	Record the contents of an open binary file under key, from its current position
+	"""
+	start = file.tell()
+	file.seek(0, io.SEEK_END)
+	size = file.tell() - start
+	file.seek(start)
+	cache.invalidate(key)
+	client().upload_fileobj(file, BUCKET, key)
+	count('written', size)
+
+def get_file(key, file):
+	"""
+	Write the object at key to an open binary file, bypassing the cache
+	"""
+	start = file.tell()
+	client().download_fileobj(BUCKET, key, file)
+	file.seek(0, io.SEEK_END) # Not necessarily left at the end, parts may be written out of order
+	count('read', file.tell() - start)
+
+def get_df(key, columns = None):
+	"""
+	Retrieve a DataFrame stored under key, in any storage format.
+	Only `columns` are decoded if given, the index is always included.
+	The result is a copy, callers are free to modify it.
+	"""
+	tag = ('df', None if columns is None else tuple(sorted(columns)))
+	df = cache.parsed(key, tag, lambda data: read_frame(data, columns = columns), frame_size)
+	return df.copy()
+
+def put_df(df, key, format = FORMAT, dtype = None):
+	"""
+	Record a DataFrame under key. Columns may be stored narrowed to `dtype`.
+	"""
+	put_str(write_frame(df, format = format, dtype = dtype), key)
+
+def read_cfatv(data):
+	import numpy as np
+	import pandas as pd
+	# FATV ids are large enough that pandas would take them for epoch times
+	df_cfatv = pd.read_json(io.BytesIO(data), orient = 'index', convert_axes = False)
+	df_cfatv.index = df_cfatv.index.astype(np.int64)
+	return df_cfatv.sort_index()
+
+def get_cfatv():
+	return cache.parsed('info/fatvs.json', 'cfatv', read_cfatv, frame_size).copy()
+
+def get_adjacency():
+	return cache.parsed('info/adjacency.json', 'adjacency', Adjacency.from_json)
+
+def ls_objects(key):
+	"""
+	Every object under the prefix `key` as listed, with its Key and
+	LastModified, S3 lists at most 1000 per request
+	"""
+	objects, kwds = [], {}
+	while True:
+		ls = client().list_objects(Bucket = BUCKET, Prefix = key, **kwds)
+		objects += ls.get('Contents', [])
+		if not ls.get('IsTruncated'):
+			return objects
+		kwds['Marker'] = objects[-1]['Key']
+
+def ls_key(key):
+	"""
+	Every key under the prefix `key`
+	"""
+	return [item['Key'] for item in ls_objects(key)]
+
+def read_frame(data, columns = None):
+	import pandas as pd
+	for magic, format in MAGIC.items():
+		if data[:len(magic)] == magic:
+			break
+	else:
+		format = 'csv'
+
+	if columns is not None:
+		columns = [str(c) for c in columns]
+
+	if format == 'parquet':
+		df = pd.read_parquet(io.BytesIO(data), engine = 'pyarrow', columns = columns)
+	elif format == 'arrow':
+		df = read_arrow(data, columns)
+	else:
+		df = pd.read_csv(io.BytesIO(data), index_col = 0)
+		if columns is not None:
+			df = df[columns]
+
+	return restore(df)
+
+def write_frame(df, format = FORMAT, dtype = None):
+	if dtype is not None:
+		df = df.astype(dtype)
+
+	store = io.BytesIO()
+	if format == 'csv':
+		df.to_csv(store)
+		return store.getvalue()
+
+	# Column names must be strings
+	df = df.rename(columns = str)
+	if format == 'parquet':
+		df.to_parquet(store, engine = 'pyarrow', compression = 'snappy')
+	elif format == 'arrow':
+		# The IPC file writer rather than feather's, which drops the index and
+		# takes no options before pyarrow 0.17, the last for python 2.7 is 0.16
+		import pyarrow as pa
+		table = pa.Table.from_pandas(df, preserve_index = True)
+		writer = pa.RecordBatchFileWriter(store, table.schema)
+		writer.write_table(table)
+		writer.close()
+	else:
+		raise ValueError("Unknown storage format {!r}".format(format))
+	return store.getvalue()
+
+def read_arrow(data, columns = None):
+	import pyarrow as pa
+	table = pa.ipc.open_file(pa.BufferReader(data)).read_all()
+	if columns is not None:
+		# The index is stored as ordinary columns, it must be selected too
+		index = [c for c in table.schema.pandas_metadata['index_columns'] if not isinstance(c, dict)]
+		keep = [table.schema.get_field_index(name) for name in index + columns]
+		if min(keep) < 0:
+			raise KeyError("No columns {} stored".format([name for name, i in zip(index + columns, keep) if i < 0]))
+		schema = pa.schema([table.schema[i] for i in keep], metadata = table.schema.metadata)
+		table = pa.Table.from_arrays([table.column(i) for i in keep], schema = schema)
+	return table.to_pandas()
+
+def restore(df):
+	"""
+	Undo storage narrowing: station id columns are ints again, and narrowed floats
+	are widened so downstream arithmetic is unchanged.
+	"""
+	import numpy as np
+	if len(df.columns) and all(str(c).isdigit() for c in df.columns):
+		df.columns = df.columns.astype(int)
+
+	narrow = df.dtypes == np.float32
+	if narrow.all():
+		df = df.astype(float)
+	elif narrow.any():
+		df = df.astype(dict.fromkeys(df.columns[narrow.values], float))
+	return df
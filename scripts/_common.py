@@ -0,0 +1,26 @@
+import datetime as dt
+import importlib.util
+import os, sys
+
+import argparse
+
+# Helpers shared by the scripts, importing them also puts lib/ on the path
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, 'lib'))
+
+def datearg(date):
+	try:
+		return dt.datetime.strptime(date, "%Y-%m-%d").date()
+	except ValueError as exc:
+		raise argparse.ArgumentTypeError(f"Bad date {date}.") from exc
+
+def load_lambda(name):
+	"""
+	Import lambda/<name>/lambda_function.py, they cannot all be imported by the same name
+	"""
+	path = os.path.join(ROOT, 'lambda', name, 'lambda_function.py')
+	spec = importlib.util.spec_from_file_location(f'fb_{name}', path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
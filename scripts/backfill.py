@@ -0,0 +1,123 @@
+import datetime as dt
+import json, os, sys
+import multiprocessing
+
+import logging
+import argparse
+
+from _common import datearg, load_lambda
+from flowbalance import health, history, manifest, storage
+
+parser = argparse.ArgumentParser(
+	description = "Run fb-daily and fb-analyze over a range of dates",
+	epilog = "Set FLOW_BALANCE_ROOT to run against a local directory in place of the bucket."
+)
+parser.add_argument('-v', '--verbose', help = 'Verbose logging', action = 'count')
+parser.add_argument('start', help = 'First date (YYYY-MM-DD)', type = datearg)
+parser.add_argument('end', help = 'Last date, inclusive (YYYY-MM-DD)', type = datearg)
+parser.add_argument('-s', '--stage', help = 'Stages to run per day [default: daily analyze]',
+	choices = ['daily', 'analyze'], action = 'append')
+parser.add_argument('-j', '--jobs', help = 'Days processed concurrently [default: cpu count]', type = int,
+	default = os.cpu_count())
+parser.add_argument('-c', '--checkpoint', metavar = 'FILE', help = 'Record completed days here and skip them on resume',
+	default = 'backfill.checkpoint')
+
+def load_shared(stages):
+	"""
+	Inputs common to every day, loaded once and handed to each worker
+	"""
+	return {stage: load_lambda(stage).load_shared() for stage in stages}
+
+# Per worker state
+worker = {}
+
+def init_worker(stages, dates, shared):
+	# The parent's S3 client and its connections are not to be shared across the fork
+	storage._client = None
+	storage.cache = storage.ObjectCache(storage.cache.limit)
+
+	worker['stages'] = stages
+	worker['shared'] = shared
+	worker['lambdas'] = {stage: load_lambda(stage) for stage in stages}
+	if 'daily' in stages:
+		worker['pdr'] = worker['lambdas']['daily'].downloader(dates)
+
+def run_day(date):
+	try:
+		for stage in worker['stages']:
+			if stage == 'daily':
+				# Records shared between days are left to the parent, one day at a time
+				worker['lambdas']['daily'].ingest(date, worker['pdr'], worker['shared']['daily'], record_shared = False)
+			elif stage == 'analyze':
+				worker['lambdas']['analyze'].analyze(f"{date:%Y-%m-%d}", worker['shared']['analyze'], record_shared = False)
+	except Exception as e:
+		logging.exception(f"{date} failed")
+		return date, False
+	return date, True
+
+def record_shared(date, stages):
+	"""
+	Update the records shared between days that the stages would have
+	"""
+	if 'daily' in stages:
+		history.append(storage.get_df(f"data/flows/{date:%Y-%m-%d}"))
+		manifest.record(date, 'daily')
+	if 'analyze' in stages:
+		manifest.record(date, 'analyze') # Health is recorded in order at the end
+
+def read_checkpoint(path, stages):
+	done = set()
+	if os.path.exists(path):
+		with open(path) as file:
+			for line in file:
+				entry = json.loads(line)
+				if set(stages) <= set(entry['stages']):
+					done.add(datearg(entry['date']))
+	return done
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	log_levels = {
+		1: logging.INFO,
+		2: logging.DEBUG
+	}
+
+	logging.basicConfig(
+		level = log_levels.get(args.verbose, logging.WARNING),
+		format = "%(asctime)s.%(msecs)03d [%(levelname)s]: %(message)s",
+		datefmt = "%X"
+	)
+
+	stages = args.stage or ['daily', 'analyze']
+	dates = [args.start + dt.timedelta(days = n) for n in range((args.end - args.start).days + 1)]
+
+	done = read_checkpoint(args.checkpoint, stages)
+	todo = [date for date in dates if date not in done]
+	logging.info(f"{len(dates) - len(todo)} of {len(dates)} days already complete")
+
+	shared = load_shared(stages)
+	failed = []
+	with open(args.checkpoint, 'a') as checkpoint:
+		with multiprocessing.Pool(args.jobs, init_worker, (stages, todo, shared)) as pool:
+			for date, ok in pool.imap_unordered(run_day, todo):
+				if ok:
+					try:
+						record_shared(date, stages)
+					except Exception as e:
+						logging.exception(f"{date} shared records failed")
+						ok = False
+				if ok:
+					checkpoint.write(json.dumps({'date': f"{date:%Y-%m-%d}", 'stages': stages}) + '\n')
+					checkpoint.flush()
+					logging.info(f"{date} complete")
+				else:
+					failed.append(date)
+
+	# Once, from every diagnosis, failed days are folded in when they are analyzed again
+	if 'analyze' in stages:
+		health.rebuild()
+
+	if failed:
+		print("failed: " + " ".join(f"{date:%Y-%m-%d}" for date in sorted(failed)))
+		sys.exit(1)
@@ -0,0 +1,374 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import datetime as dt
+import io, json, os, platform, shutil, subprocess, tempfile, time
+from zipfile import ZipFile
+
+import logging
+import argparse
+
+from _common import ROOT, load_lambda
+
+parser = argparse.ArgumentParser(
+	description = "Time the flow-balance pipeline on synthetic networks against a local store",
+	epilog = "Results are written as JSON, pass an earlier file to --compare to see what changed."
+)
+parser.add_argument('-v', '--verbose', help = 'Verbose logging', action = 'count')
+parser.add_argument('-x', '--scale', help = 'Network scales to run, relative to the base grid [default: 1 10 100]',
+	type = int, action = 'append')
+parser.add_argument('-r', '--repeat', help = 'Runs of each stage, the best is kept [default: 3]', type = int, default = 3)
+parser.add_argument('-s', '--seed', help = 'Random seed [default: 0]', type = int, default = 0)
+parser.add_argument('-o', '--output', metavar = 'FILE', help = 'Write results here [default: bench.json]',
+	default = 'bench.json')
+parser.add_argument('-c', '--compare', metavar = 'FILE', help = 'Earlier results to compare against')
+
+# Junctions per side of the grid at scale 1
+BASE = 12
+DATE = dt.date(2019, 5, 1)
+
+# Detector ids, as in PeMS. Stations outside the model are in PeMS but not the corridor.
+FIRST_DETECTOR = 7200001
+FIRST_STATION = 7600001
+
+def synth_model(scale, rng):
+	"""
+	An Aimsun style model in the model.zip dump schema: a grid of junctions
+	joined by two way sections, some missing, with entries along the west edge
+	and exits along the east. Some sections carry one or more sets of lane
+	detectors. Returns the detectors, junctions and sections dumps, and the
+	(row, column) of each junction.
+	"""
+	n = int(round(BASE * scale ** 0.5))
+	junctions, sections, detectors, grid = {}, {}, {}, {}
+	for i in range(n):
+		for j in range(n):
+			jid = 1 + i * n + j
+			grid[jid] = (i, j)
+			junctions[str(jid)] = {
+				'ID': jid, 'Name': f'Junction {i} {j}', 'External ID': '',
+				'Signalized': bool(rng.random() < 0.5), 'Incoming': [], 'Outgoing': [], 'Turns': [],
+			}
+
+	def section(origin, destination):
+		sid = 100000 + len(sections)
+		sections[str(sid)] = {
+			'ID': sid, 'Origin': origin, 'Destination': destination, 'Lanes': 2,
+			'Name': f'Section {sid}', 'External ID': '',
+		}
+		if rng.random() < 0.35:
+			lanes = [(1, 1), (2, 2)] if rng.random() < 0.5 else [(1, 2)]
+			for k in range(rng.choice([1, 1, 2, 3])):
+				for first, last in lanes:
+					pid = FIRST_DETECTOR + len(detectors)
+					detectors[str(pid)] = {
+						'ID': 500000 + len(detectors), 'External ID': str(pid), 'Description': '',
+						'Section ID': sid, 'First Lane': first, 'Last Lane': last,
+						'Start Position': 10.0 * k + first * 0.1, 'Position': 10.0 * k, 'Final Position': 10.0 * k + 2,
+					}
+
+	for i in range(n):
+		for j in range(n):
+			here = 1 + i * n + j
+			if i + 1 < n:
+				section(here, here + n)
+				section(here + n, here)
+			if j + 1 < n and rng.random() < 0.7:
+				section(here, here + 1)
+				section(here + 1, here)
+	for i in range(n):
+		section(None, 1 + i * n)
+		section(n + i * n, None)
+
+	return detectors, junctions, sections, grid
+
+def model_zip(detectors, junctions, sections):
+	store = io.BytesIO()
+	with ZipFile(store, 'w') as zm:
+		zm.writestr('detectors.json', json.dumps(detectors))
+		zm.writestr('junctions.json', json.dumps(junctions))
+		zm.writestr('sections.json', json.dumps(sections))
+	store.seek(0)
+	return store
+
+def synth_routes(sections, grid, rng, count):
+	"""
+	Vehicle routes from entry to exit sections, as lists of section ids.
+	Routes wander but lean east, those that do not reach an exit are dropped.
+	"""
+	outgoing = {}
+	for feature in sections.values():
+		outgoing.setdefault(feature['Origin'], []).append((feature['ID'], feature['Destination']))
+	n = int(round(len(grid) ** 0.5))
+
+	routes = []
+	for _ in range(count):
+		sid, here = outgoing[None][rng.integers(len(outgoing[None]))]
+		route = [sid]
+		for step in range(4 * n):
+			options = outgoing.get(here, [])
+			east = [option for option in options if option[1] is None or grid[option[1]][1] > grid[here][1]]
+			choices = east if east and rng.random() < 0.6 else options
+			sid, here = choices[rng.integers(len(choices))]
+			route.append(sid)
+			if here is None:
+				routes.append(route)
+				break
+	return routes
+
+def synth_day(detectors, sections, grid, rng, bad = 0.01, extra = 0.5):
+	"""
+	A station_5min day for the model's detectors, plus `extra` as many PeMS
+	stations outside the model. Flows follow routes through the grid, so every
+	FATV balances until `bad` of the detectors are made to miscount.
+	Returns the day, with times as datetimes, and the miscounting detectors.
+	"""
+	times = pd.date_range(DATE, periods = 288, freq = '5min')
+	hours = np.arange(288) / 12
+	shape = 0.2 + np.exp(-(hours - 8) ** 2 / 2) + np.exp(-(hours - 17) ** 2 / 3)
+
+	# Section flows are the sum of the routes through them
+	routes = synth_routes(sections, grid, rng, count = int(20 * len(grid) ** 0.5))
+	column = {int(sid): pos for pos, sid in enumerate(sections)}
+	rows = np.concatenate([np.full(len(route), r) for r, route in enumerate(routes)])
+	cols = np.array([column[sid] for route in routes for sid in route])
+	through = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape = (len(routes), len(sections))).tocsr()
+	demand = rng.poisson(rng.uniform(1, 6, (len(routes), 1)) * shape)
+	flows = np.asarray(through.T.dot(demand))
+
+	# Each set of detectors splits its section's flow between lanes
+	ids = np.array([int(pid) for pid in detectors])
+	counts = np.zeros((len(ids), len(times)))
+	split = {}
+	for pos, (pid, feature) in enumerate(detectors.items()):
+		section = flows[column[feature['Section ID']]]
+		key = feature['Section ID'], feature['Start Position'] // 10
+		if feature['First Lane'] != feature['Last Lane']:
+			counts[pos] = section
+		elif key not in split:
+			split[key] = rng.binomial(section.astype(int), 0.5)
+			counts[pos] = split[key]
+		else:
+			counts[pos] = section - split[key]
+
+	wrong = rng.choice(ids, int(bad * len(ids)), replace = False)
+	counts[np.isin(ids, wrong)] *= 1.3
+
+	others = np.arange(FIRST_STATION, FIRST_STATION + int(extra * len(ids)))
+	stations = np.concatenate([ids, others])
+	counts = np.vstack([counts, rng.poisson(100 * shape, (len(others), len(times)))]).round()
+	observed = np.where(rng.random(len(stations)) < 0.03, 0, 100)
+
+	# Narrow types where PeMS columns are constant here, so that 100x fits in memory
+	size = len(stations) * len(times)
+	df_day = pd.DataFrame({
+		'Timestamp': np.tile(times, len(stations)),
+		'Station': np.repeat(stations, len(times)),
+		'District': np.full(size, 7, dtype = np.int8),
+		'Fwy': np.full(size, 210, dtype = np.int16),
+		'Direction': pd.Categorical.from_codes(np.zeros(size, dtype = np.int8), ['E']),
+		'Lane Type': pd.Categorical.from_codes(np.zeros(size, dtype = np.int8), ['ML']),
+		'Samples': np.full(size, 20, dtype = np.int8),
+		'Observed': np.repeat(observed, len(times)).astype(float),
+		'Flow': counts.ravel(),
+		'Occupancy': rng.uniform(0, 0.2, size).astype(np.float32),
+		'Speed': rng.uniform(20, 70, size).astype(np.float32),
+	})
+	df_day.loc[rng.random(size) < 0.002, 'Flow'] = np.nan
+	return df_day, wrong
+
+def synth_meta(detectors, sections, grid, adjacency):
+	"""
+	data/detectors as fb-daily records it, detectors placed along their sections
+	"""
+	ids = [int(pid) for pid in detectors]
+	where = []
+	for feature in detectors.values():
+		section = sections[str(feature['Section ID'])]
+		ends = [grid[j] for j in (section['Origin'], section['Destination']) if j is not None]
+		where.append(np.mean(ends, axis = 0))
+	where = np.array(where)
+
+	df_meta = pd.DataFrame({
+		'Fwy': 210, 'Dir': 'E', 'District': 7, 'County': 37, 'City': np.nan,
+		'State PM': [f'{pm:.3f}' for pm in where[:, 1]], 'Abs PM': where[:, 1],
+		'Latitude': 34 + where[:, 0] / 100, 'Longitude': -118.5 + where[:, 1] / 100,
+		'Length': 0.5, 'Type': 'Mainline', 'Lanes': 2,
+		'Name': [f'Detector {pid}' for pid in ids], 'Exact': False,
+	}, index = pd.Index(ids, name = 'ID'))
+	membership = adjacency.frame().reindex(df_meta.index)
+	df_meta['FATV IN'] = membership['FATV IN']
+	df_meta['FATV OUT'] = membership['FATV OUT']
+	return df_meta
+
+class Bench(object):
+	"""
+	Runs stages at one scale, keeping the best time of each
+	"""
+	def __init__(self, scale, repeat):
+		self.scale = scale
+		self.repeat = repeat
+		self.results = []
+
+	def time(self, stage, func, *args, setup = None, **kwds):
+		best = None
+		for run in range(self.repeat):
+			if setup:
+				setup()
+			start = time.perf_counter()
+			value = func(*args, **kwds)
+			seconds = time.perf_counter() - start
+			best = seconds if best is None else min(best, seconds)
+		self.results.append({'scale': self.scale, 'stage': stage, 'seconds': best})
+		logging.info(f"{self.scale}x {stage}: {best:.4f}s")
+		return value
+
+def run_scale(scale, args, store):
+	from flowbalance import history, manifest, storage
+	from flowbalance.adjacency import Adjacency
+	from flowbalance.balance import Incidence, window_bounds
+	from flowbalance.diagnosis import calibrate, implicate, unknown
+	from flowbalance.flows import CHUNK_ROWS, accumulate, chunks, unobserved
+	from flowbalance.plots import pack_plots
+
+	# Each scale starts from an empty store and a cold cache
+	shutil.rmtree(store, ignore_errors = True)
+	cold = lambda: storage.cache.entries.clear() or setattr(storage.cache, 'size', 0)
+	cold()
+
+	rng = np.random.default_rng(args.seed)
+	bench = Bench(scale, args.repeat)
+	key = f"{DATE:%Y-%m-%d}"
+
+	# fb-model
+	model = load_lambda('model')
+	dumps = synth_model(scale, rng)
+	detectors, junctions, sections, grid = dumps
+	djs = bench.time('model.get_djs', lambda: model.get_djs(model_zip(detectors, junctions, sections)))
+	df_cfatv = bench.time('model.get_fatvs', model.get_fatvs, *djs)
+	adjacency = bench.time('model.adjacency', Adjacency.from_fatvs, df_cfatv)
+	storage.put_str(df_cfatv.to_json(orient = 'index'), 'info/fatvs.json')
+	storage.put_str(adjacency.to_json(), 'info/adjacency.json')
+	storage.put_str(json.dumps(djs[0].index.tolist()), 'info/tracked.json')
+
+	# fb-daily, from the downloaded day on
+	df_day, wrong = synth_day(detectors, sections, grid, rng)
+	df_meta = synth_meta(detectors, sections, grid, adjacency)
+	stations = df_meta.index.append(pd.Index(sorted(set(adjacency.detectors) - set(df_meta.index))))
+	df_raw, df_piv, obv = bench.time('daily.accumulate', lambda: accumulate(chunks(df_day, CHUNK_ROWS), stations, DATE))
+	df_piv[unobserved(obv)] = np.nan
+	bench.time('daily.write_flows', storage.write_frame, df_piv, format = 'arrow', dtype = np.float32)
+	bench.time('daily.history', history.append, df_piv, setup = lambda: shutil.rmtree(os.path.join(store, 'data', 'history'), True))
+	storage.put_df(df_meta, f'data/detectors/{key}')
+	storage.put_str(df_meta.to_json(orient = 'index'), f'data/detectors/{key}.json')
+	storage.put_df(df_raw, f'data/raw/{key}')
+	storage.put_df(df_piv, f'data/flows/{key}', format = 'arrow', dtype = np.float32)
+	storage.put_df(obv.to_frame('Observed'), f'data/observed/{key}')
+	manifest.record(DATE, 'daily')
+
+	# fb-analyze, phase by phase and then as a whole
+	df_piv = storage.get_df(f'data/flows/{key}')
+	incidence = bench.time('analyze.incidence', Incidence, df_cfatv, df_piv.columns)
+	running = bench.time('analyze.running', incidence.running, df_piv)
+	df_account = df_cfatv.join(running.account(0, len(df_piv.index)))
+	bench.time('analyze.implicate', implicate, df_account, adjacency)
+	bench.time('analyze.unknown', unknown, df_account)
+	analyze = load_lambda('analyze')
+	def windows():
+		for first, last in window_bounds(df_piv.index, analyze.WINDOWS):
+			implicate(df_cfatv[['IN', 'OUT']].join(running.account(first, last)), adjacency)
+	bench.time('analyze.windows', windows)
+	def calibrated():
+		spans = [(0, len(df_piv.index))] + window_bounds(df_piv.index, analyze.WINDOWS)
+		totals = incidence.member_totals(df_piv, running, spans)
+		for (first, last), members in zip(spans, totals):
+			calibrate(df_cfatv[['IN', 'OUT']].join(running.account(first, last)), members, incidence.stations)
+	bench.time('analyze.calibrate', calibrated)
+	bench.time('analyze.plots', lambda: pack_plots(df_account, *incidence.series(df_piv)))
+	bench.time('analyze.total', analyze.analyze, key, record_shared = False, setup = cold)
+	manifest.record(DATE, 'analyze')
+
+	# fb-proxy, warm as a container serving the page would be
+	proxy = load_lambda('proxy')
+	def request(path, query = None):
+		event = {
+			'pathParameters': {'proxy': path}, 'requestContext': {'httpMethod': 'GET'},
+			'queryStringParameters': query, 'headers': {'Accept-Encoding': 'gzip'},
+		}
+		return lambda: proxy.lambda_handler(event, None)
+	fatvs = [str(fid) for fid in df_cfatv.index[:10]]
+	bench.time('proxy.latest', request('latest'))
+	bench.time('proxy.detectors', request('detectors', {'date': key, 'fields': 'lat,lon,fatv_in,fatv_out,Name'}))
+	bench.time('proxy.diagnosis', request('diagnosis', {'date': key}))
+	bench.time('proxy.diagnoses', request('diagnosis', {'start': key, 'end': key}))
+	bench.time('proxy.plot', request(f'plot/{fatvs[0]}', {'date': key}))
+	bench.time('proxy.plots', request('plot', {'date': key, 'fatvs': ','.join(fatvs)}))
+	bench.time('proxy.history', request(f'history/fatv/{fatvs[0]}', {'start': key, 'end': key}))
+
+	sizes = {
+		'scale': scale, 'junctions': len(junctions), 'sections': len(sections),
+		'detectors': len(detectors), 'fatvs': len(df_cfatv), 'rows': len(df_day), 'miscounting': len(wrong),
+	}
+	return sizes, bench.results
+
+def compare(results, path):
+	"""
+	Print each stage's time against that of an earlier run
+	"""
+	with open(path) as file:
+		earlier = {(r['scale'], r['stage']): r['seconds'] for r in json.load(file)['results']}
+	for result in results:
+		before = earlier.get((result['scale'], result['stage']))
+		if before:
+			print(f"{result['scale']:>4}x {result['stage']:<20} {before:10.4f}s -> {result['seconds']:10.4f}s {result['seconds'] / before:6.2f}x")
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	log_levels = {
+		1: logging.INFO,
+		2: logging.DEBUG
+	}
+
+	logging.basicConfig(
+		level = log_levels.get(args.verbose, logging.WARNING),
+		format = "%(asctime)s.%(msecs)03d [%(levelname)s]: %(message)s",
+		datefmt = "%X"
+	)
+	if not args.verbose:
+		logging.getLogger('flowbalance.metrics').setLevel(logging.WARNING) # The stages are timed here
+
+	try:
+		commit = subprocess.check_output(['git', '-C', ROOT, 'rev-parse', 'HEAD'], stderr = subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		commit = None
+
+	with tempfile.TemporaryDirectory() as root:
+		os.environ['FLOW_BALANCE_ROOT'] = root # Never the bucket
+		os.environ.pop('FLOW_BALANCE_BUCKET', None)
+		store = os.path.join(root, 'flow-balance')
+
+		scales, results = [], []
+		for scale in args.scale or [1, 10, 100]:
+			sizes, timings = run_scale(scale, args, store)
+			scales.append(sizes)
+			results += timings
+
+	with open(args.output, 'w') as file:
+		json.dump({
+			'started': dt.datetime.utcnow().isoformat() + 'Z',
+			'commit': commit,
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'repeat': args.repeat,
+			'seed': args.seed,
+			'scales': scales,
+			'results': results,
+		}, file, indent = 1)
+
+	if args.compare:
+		compare(results, args.compare)
+	else:
+		for result in results:
+			print(f"{result['scale']:>4}x {result['stage']:<20} {result['seconds']:10.4f}s")
@@ -0,0 +1,70 @@
+import json, sys
+from collections import defaultdict
+
+import argparse
+
+parser = argparse.ArgumentParser(
+	description = "Summarize the stage metrics logged by the lambdas",
+	epilog = "Reads log lines as exported from CloudWatch or printed locally, one JSON metric per line after any prefix. "
+		"Other lines are skipped."
+)
+parser.add_argument('logs', metavar = 'LOG', help = 'Log files [default: stdin]', nargs = '*')
+parser.add_argument('-m', '--metric', help = 'Only this lambda (fb-daily, fb-analyze, ...)', action = 'append')
+parser.add_argument('-b', '--by', metavar = 'DIM', help = 'Also group by this dimension (date, route, ...)', action = 'append',
+	default = [])
+
+def read_metrics(lines):
+	"""
+	The metric logged on each line that has one
+	"""
+	for line in lines:
+		start = line.find('{"')
+		if start < 0:
+			continue
+		try:
+			metric = json.loads(line[start:])
+		except ValueError:
+			continue
+		if isinstance(metric, dict) and 'metric' in metric and 'stage' in metric:
+			yield metric
+
+def quantile(values, q):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarize(metrics, by):
+	"""
+	Per group of lambda, stage and the `by` dimensions: the count of
+	invocations, median, 90th percentile and max seconds, the largest peak
+	RSS and the mean MB read and written
+	"""
+	groups = defaultdict(list)
+	for metric in metrics:
+		groups[(metric['metric'], *(str(metric.get(dim)) for dim in by), metric['stage'])].append(metric)
+
+	rows = []
+	for group, members in groups.items():
+		seconds = [member['seconds'] for member in members]
+		rss = [member['peak_rss_mb'] for member in members if member.get('peak_rss_mb') is not None]
+		rows.append((*group, len(members), quantile(seconds, 0.5), quantile(seconds, 0.9), max(seconds),
+			max(rss) if rss else float('nan'),
+			sum(member['read_bytes'] for member in members) / len(members) / 2**20,
+			sum(member['written_bytes'] for member in members) / len(members) / 2**20))
+	# Slowest stages first, and the whole invocation last
+	return sorted(rows, key = lambda row: (row[:-8], row[-8] == 'total', -row[-6]))
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	files = [open(path) for path in args.logs] or [sys.stdin]
+	metrics = [metric for file in files for metric in read_metrics(file)]
+	if args.metric:
+		metrics = [metric for metric in metrics if metric['metric'] in args.metric]
+
+	header = ['lambda', *args.by, 'stage', 'count', 'p50 s', 'p90 s', 'max s', 'peak MB', 'read MB', 'written MB']
+	rows = summarize(metrics, args.by)
+	widths = [max([len(header[n])] + [len(str(row[n])) for row in rows]) for n in range(len(header) - 7)]
+	print('  '.join(f"{name:<{width}}" for name, width in zip(header, widths)) + ''.join(f"{name:>11}" for name in header[-7:]))
+	for row in rows:
+		print('  '.join(f"{str(value):<{width}}" for value, width in zip(row, widths))
+			+ f"{row[-7]:>11}" + ''.join(f"{value:>11.3f}" for value in row[-6:-3]) + ''.join(f"{value:>11.1f}" for value in row[-3:]))
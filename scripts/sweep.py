@@ -0,0 +1,130 @@
+import datetime as dt
+import itertools, os, sys
+import multiprocessing
+from botocore.exceptions import ClientError
+
+import numpy as np
+import pandas as pd
+
+import logging
+import argparse
+
+from _common import datearg, load_lambda
+from flowbalance import storage
+from flowbalance.balance import Incidence
+from flowbalance.diagnosis import Implications, THRESHOLDS
+from flowbalance.metrics import Metrics
+
+def thresholdarg(spec):
+	"""
+	Thresholds separated by commas, or START:STOP:STEP including STOP
+	"""
+	try:
+		if ':' in spec:
+			start, stop, step = map(float, spec.split(':'))
+			return [round(value, 10) for value in np.arange(start, stop + step / 2, step)]
+		return [float(value) for value in spec.split(',')]
+	except ValueError as exc:
+		raise argparse.ArgumentTypeError(f"Bad thresholds {spec}.") from exc
+
+parser = argparse.ArgumentParser(
+	description = "Compare the daily diagnosis over a grid of implication thresholds",
+	epilog = "Thresholds are given as A,B,C or START:STOP:STEP. The labels of every setting are those fb-analyze would give for the whole day."
+)
+parser.add_argument('-v', '--verbose', help = 'Verbose logging', action = 'count')
+parser.add_argument('start', help = 'First date (YYYY-MM-DD)', type = datearg)
+parser.add_argument('end', help = 'Last date, inclusive (YYYY-MM-DD)', type = datearg)
+parser.add_argument('-e', '--error', help = 'FATV errors to examine above [default: 0.01:0.05:0.005]', type = thresholdarg,
+	default = '0.01:0.05:0.005')
+parser.add_argument('-n', '--neighbor', help = 'Neighbor errors to blame from [default: 0:0.02:0.005]', type = thresholdarg,
+	default = '0:0.02:0.005')
+parser.add_argument('-r', '--reduction', help = 'Error left by combining to blame under [default: 0.05:0.3:0.05]', type = thresholdarg,
+	default = '0.05:0.3:0.05')
+parser.add_argument('-j', '--jobs', help = 'Days processed concurrently [default: cpu count]', type = int,
+	default = os.cpu_count())
+parser.add_argument('-o', '--output', metavar = 'FILE', help = 'Write the summary of each setting here [default: sweep.csv]',
+	default = 'sweep.csv')
+
+# Per worker state
+worker = {}
+
+def init_worker(grid):
+	worker['grid'] = grid
+	worker['analyze'] = load_lambda('analyze')
+	worker['cfatv'] = storage.get_cfatv()
+	worker['implications'] = Implications(worker['cfatv'], storage.get_adjacency())
+	worker['incidence'] = {} # By the stations of the day's pivot
+
+def sweep_day(date):
+	"""
+	The detectors in error and the singletons of `date` under every setting
+	of the grid, as masks over those of the Implications
+	"""
+	key = f"{date:%Y-%m-%d}"
+	try:
+		df_piv, unobv = worker['analyze'].get_flows(key, date, Metrics('sweep', date = key))
+	except ClientError as e:
+		logging.error(f"No flows for {key}")
+		return date, None
+
+	stations = tuple(df_piv.columns)
+	if stations not in worker['incidence']:
+		worker['incidence'][stations] = Incidence(worker['cfatv'], df_piv.columns)
+	df_account = worker['incidence'][stations].running(df_piv).account(0, len(df_piv.index))
+	return date, worker['implications'].sweep(df_account, worker['grid'])
+
+def summarize(grid, days):
+	"""
+	Per setting of the grid, the mean and deviation of the daily count of
+	detectors in error and of singletons, the mean overlap (intersection over
+	union) of the detectors in error on consecutive days, and the count of
+	detectors in error on at least half the days
+	"""
+	errors = np.stack([blamed for blamed, single in days]) # (days x settings x detectors)
+	singles = np.stack([single for blamed, single in days])
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		overlap = (errors[1:] & errors[:-1]).sum(axis = 2) / (errors[1:] | errors[:-1]).sum(axis = 2)
+		overlap = np.nanmean(overlap, axis = 0) if len(days) > 1 else np.full(len(grid), np.nan)
+
+	df_sweep = pd.DataFrame(grid, columns = ['Error', 'Neighbor Error', 'Reduction'])
+	df_sweep['Days'] = len(days)
+	df_sweep['Errors'] = errors.sum(axis = 2).mean(axis = 0)
+	df_sweep['Errors SD'] = errors.sum(axis = 2).std(axis = 0)
+	df_sweep['Singletons'] = singles.sum(axis = 2).mean(axis = 0)
+	df_sweep['Singletons SD'] = singles.sum(axis = 2).std(axis = 0)
+	df_sweep['Overlap'] = overlap
+	df_sweep['Recurring'] = (2 * errors.sum(axis = 0) >= len(days)).sum(axis = 1)
+	return df_sweep
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	log_levels = {
+		1: logging.INFO,
+		2: logging.DEBUG
+	}
+
+	logging.basicConfig(
+		level = log_levels.get(args.verbose, logging.WARNING),
+		format = "%(asctime)s.%(msecs)03d [%(levelname)s]: %(message)s",
+		datefmt = "%X"
+	)
+
+	grid = np.array(list(itertools.product(args.error, args.neighbor, args.reduction)))
+	dates = [args.start + dt.timedelta(days = n) for n in range((args.end - args.start).days + 1)]
+	logging.info(f"{len(grid)} settings over {len(dates)} days")
+
+	with multiprocessing.Pool(args.jobs, init_worker, (grid,)) as pool:
+		results = sorted(pool.imap_unordered(sweep_day, dates), key = lambda result: result[0])
+	days = [labels for date, labels in results if labels is not None]
+	if not days:
+		sys.exit(1)
+
+	df_sweep = summarize(grid, days)
+	df_sweep.to_csv(args.output, index = False)
+
+	print(df_sweep.to_string(index = False, float_format = lambda value: f"{value:.4g}"))
+	current = (df_sweep[['Error', 'Neighbor Error', 'Reduction']].values == THRESHOLDS).all(axis = 1)
+	if current.any():
+		row = df_sweep[current].iloc[0].drop(['Error', 'Neighbor Error', 'Reduction', 'Days'])
+		print(f"current {THRESHOLDS}: " + ", ".join(f"{name} {value:.4g}" for name, value in row.items()))
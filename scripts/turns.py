@@ -1,95 +1,32 @@
 import numpy as np
 import pandas as pd
 import datetime as dt
-import boto3, io, json
+import json
+from itertools import groupby
+from operator import attrgetter
 from botocore.exceptions import ClientError
 
+from _common import datearg
+from flowbalance import storage
+from flowbalance.balance import Incidence, cumulative, window_bounds
+
 import logging
 import argparse
 
-def datearg(date):
-	try:
-		return dt.datetime.strptime(date, "%Y-%m-%d").date()
-	except ValueError as exc:
-		raise argparse.ArgumentTypeError(f"Bad date {date}.") from exc
-
 parser = argparse.ArgumentParser(
-	description = "Turn ratio candidates and estimates"
+	description = "Turn ratio candidates and estimates",
+	epilog = "Without -o the report is printed, a table written as .parquet is parquet and CSV otherwise."
 )
 parser.add_argument('-v', '--verbose', help = 'Verbose logging', action = 'count')
 parser.add_argument('-d', '--date', help = 'Date to analyze (YYYY-MM-DD) [default: yesterday]', type = datearg,
 	default = dt.date.today() - dt.timedelta(days = 1))
+parser.add_argument('-e', '--end', help = 'Last date to analyze, inclusive (YYYY-MM-DD) [default: the date]', type = datearg)
 parser.add_argument('--time', metavar = 'INTERVAL', help = 'Time interval to analyze', nargs = '*')
+parser.add_argument('-o', '--output', metavar = 'FILE', help = 'Write the turn ratios here as a table, one row per sink')
+parser.add_argument('-r', '--report', help = 'Print the report even with -o', action = 'store_true')
 
-args = parser.parse_args()
-
-log_levels = {
-	1: logging.INFO,
-	2: logging.DEBUG
-}
-
-logging.basicConfig(
-	level = log_levels.get(args.verbose, logging.WARNING),
-	format = "%(asctime)s.%(msecs)03d [%(levelname)s]: %(message)s",
-	datefmt = "%X"
-)
-
-# Extra argparsing
-intervals = []
-if not args.time:
-	intervals = [('0:00', '23:59')]
-else:
-	for interval in args.time:
-		if '-' in interval:
-			start, stop = interval.split('-')
-		else:
-			hour, minute = interval.split(':')
-			carry, minute = divmod(int(minute) + 55, 60)
-			hour = int(hour) + carry
-			start, stop = interval, f"{hour:02d}:{minute:02d}", 
-		
-		if not stop:
-			stop = '23:59'
-		
-		interval = start, stop
-		intervals.append(interval)
-		
-# Util
-def get_df(s3, key, **kwds):
-	if 'index_col' not in kwds:
-		kwds['index_col'] = 0
-	
-	try:
-		store = io.BytesIO()
-		s3.download_fileobj('flow-balance', key, store)
-		store.seek(0)
-		df_store = pd.read_csv(store, **kwds)
-	except ClientError as e:
-		logging.error(f"No data for {key!r}")
-		exit(1)
-	finally:
-		store.close()
-	
-	return df_store
-
-def get_cfatv(s3):
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', 'info/fatvs.json', store)
-	store.seek(0)
-	df_cfatv = pd.read_json(store, orient = 'index').sort_index()
-	store.close()
-	return df_cfatv
-
-def get_balance(s3, key):
-	store = io.BytesIO()
-	s3.download_fileobj('flow-balance', key, store)
-	store.seek(0)
-	labels = json.load(store)
-	store.close()
-	return labels
-
-def has_all(idx, target):
-	return np.all(pd.Series(idx).isin(target))
+# Columns of the turn ratio table, one row per date, FATV, interval and sink
+COLUMNS = ['Date', 'FATV', 'Name', 'Dir', 'Start', 'Stop', 'Quality', 'Incoming', 'Outgoing', 'Sink', 'Type', 'Volume', 'Share']
 
 lane_types = {
 	'Coll/Dist'           : 'CD',
@@ -100,68 +37,163 @@ lane_types = {
 	'Mainline'            : 'ML',
 	'On Ramp'             : 'OR',
 }
-typecode = lambda det: lane_types.get(detectors.loc[det, 'Type'])
-
-# Load data
-s3 = boto3.client('s3')
-logging.info("Get FATV info")
-fatvs = get_cfatv(s3)
-
-logging.info("Get flows info")
-flows = get_df(s3, f'data/flows/{args.date:%Y-%m-%d}', parse_dates = ['Timestamp'])
-flows.rename(columns = int, inplace = True)
-
-logging.info("Get detector meta info")
-detectors = get_df(s3, f'data/detectors/{args.date:%Y-%m-%d}')
-
-logging.info("Get balance labels info")
-labels = get_balance(s3, f'data/balance/{args.date:%Y-%m-%d}')
 
-# ignore fatvs with error or singleton detectors
-bad = labels['error'] + labels['singleton']
-flows[bad] = np.nan
-
-# Evaluate
-off = detectors.index[detectors['Type'] == 'Off Ramp']
-turns = fatvs['OUT'].apply(lambda out: np.any([off.contains(det) for det in out]))
-turns = pd.Series(turns.index[turns])
-
-print(f"date: {args.date:%Y-%m-%d (%A)}")
-for turn in turns:
-	inset = fatvs.loc[turn, 'IN']
-	outset = fatvs.loc[turn, 'OUT']
+def parse_intervals(times):
+	"""
+	(start, stop) of each interval given as START-STOP, START- or a 5 minute START
+	"""
+	intervals = []
+	for interval in times or ['0:00-23:59']:
+		if '-' in interval:
+			start, stop = interval.split('-')
+		else:
+			hour, minute = interval.split(':')
+			carry, minute = divmod(int(minute) + 55, 60)
+			hour = int(hour) + carry
+			start, stop = interval, f"{hour:02d}:{minute:02d}"
 
-	if not has_all(inset + outset, flows):
-		logging.debug(f"Some FATV {turn} members are absent.")
-		continue
+		if not stop:
+			stop = '23:59'
 
-	header = False
-	for interval in intervals:
+		interval = start, stop
 		try:
-			flow = flows.between_time(*interval)
+			window_bounds(pd.DatetimeIndex([]), [interval])
 		except ValueError as e:
 			msg, = e.args
 			logging.error(msg)
 			continue
-
-		samples = len(flow)
-		flow = flow[inset + outset].dropna()
-		quality = 100 * len(flow) / samples
-
-		incoming = flow[inset].values.sum()
-		outgoing = flow[outset].values.sum()
-		sinks = [(sink, flow[sink].values.sum()) for sink in outset]
-
-		offdet = next(det for det in outset if detectors.loc[det, 'Type'] == 'Off Ramp')
-		title = ' | '.join(detectors.loc[offdet, ['Name', 'Dir']])
-
-		if quality > 0:
-			if not header:
-				print(f"FATV {turn}: {title}")
-				print(f"start-finish quality incoming outgoing " + " ".join(f"[{typecode(sink)}]{sink}" for sink in outset))
-				header = True
-			print(f" {interval[0]:>05s}-{interval[1]:>05s} {quality:7.1f} {incoming:8.0f} {outgoing:8.0f} ", end = '')
-			print(" ".join(f"{volume / outgoing:10.2%}" for sink, volume in sinks))
-	if header:
-		print()
-
+		if interval not in intervals:
+			intervals.append(interval)
+	return intervals
+
+def turn_ratios(date, intervals, fatvs, adjacency):
+	"""
+	How the outgoing flow of every off-ramp FATV splits between its sinks over
+	each interval of `date`, as a table of COLUMNS. Every FATV, interval and sink
+	comes from the same running totals, intervals where a member of the FATV is
+	blank or labelled 'error' or 'singleton' do not count.
+	"""
+	key = f'{date:%Y-%m-%d}'
+	flows = storage.get_df(f'data/flows/{key}')
+	flows.index = pd.to_datetime(flows.index)
+	detectors = storage.get_df(f'data/detectors/{key}')
+	labels = json.loads(storage.get_str(f'data/balance/{key}'))
+
+	# ignore fatvs with error or singleton detectors
+	bad = labels['error'] + labels['singleton']
+	flows[bad] = np.nan
+
+	off = detectors.index[detectors['Type'] == 'Off Ramp']
+	turns = sorted({adjacency.fatv_out(det) for det in off} - {None})
+	incidence = Incidence(fatvs.loc[turns], flows.columns)
+	for turn in incidence.fatvs[incidence.illformed]:
+		logging.debug(f"Some FATV {turn} members are absent.")
+	keep = np.flatnonzero(~incidence.illformed)
+
+	# One column per sink of each turn, in the order of the turns
+	outsets = fatvs.loc[incidence.fatvs[keep], 'OUT']
+	owner = np.repeat(keep, [len(outset) for outset in outsets])
+	sinks = np.array([sink for outset in outsets for sink in outset], dtype = int)
+	types = detectors['Type'].reindex(sinks)
+	# Each turn is titled by its first off-ramp sink
+	ramps = (types == 'Off Ramp').values
+	offdets = pd.Series(sinks[ramps]).groupby(owner[ramps]).first().reindex(owner).values
+	titles = detectors.loc[offdets, ['Name', 'Dir']].values
+	types = types.map(lane_types).values
+
+	running = incidence.running(flows)
+	volumes = cumulative(np.where(running.valid[:, owner], flows.reindex(columns = sinks).values, 0))
+
+	# (intervals x sinks) from the differences of the running totals
+	bounds = np.array(window_bounds(flows.index, intervals), dtype = int).reshape(-1, 2)
+	start, stop = bounds[:, 0], bounds[:, 1]
+	samples = (stop - start)[:, None]
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		quality = np.where(samples > 0, 100 * (running.count[stop] - running.count[start])[:, owner] / samples, 0)
+		incoming = (running.ins[stop] - running.ins[start])[:, owner]
+		outgoing = (running.outs[stop] - running.outs[start])[:, owner]
+		volume = volumes[stop] - volumes[start]
+		share = volume / outgoing
+
+	# Rows by turn, then interval, then sink
+	n, s = np.meshgrid(np.arange(len(intervals)), np.arange(len(sinks)), indexing = 'ij')
+	order = np.lexsort((s.ravel(), n.ravel(), owner[s.ravel()]))
+	n, s = n.ravel()[order], s.ravel()[order]
+	flat = lambda values: values.ravel()[order]
+	return pd.DataFrame({
+		'Date': key,
+		'FATV': incidence.fatvs[owner[s]],
+		'Name': titles[s, 0],
+		'Dir': titles[s, 1],
+		'Start': [intervals[i][0] for i in n],
+		'Stop': [intervals[i][1] for i in n],
+		'Quality': flat(quality),
+		'Incoming': flat(incoming),
+		'Outgoing': flat(outgoing),
+		'Sink': sinks[s],
+		'Type': types[s],
+		'Volume': flat(volume),
+		'Share': flat(share),
+	}, columns = COLUMNS)
+
+def report(table, dates):
+	"""
+	Print the turn ratios of each of `dates`, for the FATVs and intervals with any good quality samples
+	"""
+	rows = table[table['Quality'] > 0].itertuples(index = False)
+	days = {date: list(day) for date, day in groupby(rows, attrgetter('Date'))}
+	for date in dates:
+		print(f"date: {date:%Y-%m-%d (%A)}")
+		for turn, rows in groupby(days.get(f'{date:%Y-%m-%d}', []), attrgetter('FATV')):
+			intervals = [list(sinks) for _, sinks in groupby(rows, attrgetter('Start', 'Stop'))]
+			first = intervals[0][0]
+			print(f"FATV {turn}: {first.Name} | {first.Dir}")
+			print(f"start-finish quality incoming outgoing " + " ".join(
+				f"[{row.Type if isinstance(row.Type, str) else None}]{row.Sink}" for row in intervals[0]))
+			for sinks in intervals:
+				row = sinks[0]
+				print(f" {row.Start:>05s}-{row.Stop:>05s} {row.Quality:7.1f} {row.Incoming:8.0f} {row.Outgoing:8.0f} ", end = '')
+				print(" ".join(f"{row.Share:10.2%}" for row in sinks))
+			print()
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	log_levels = {
+		1: logging.INFO,
+		2: logging.DEBUG
+	}
+
+	logging.basicConfig(
+		level = log_levels.get(args.verbose, logging.WARNING),
+		format = "%(asctime)s.%(msecs)03d [%(levelname)s]: %(message)s",
+		datefmt = "%X"
+	)
+
+	intervals = parse_intervals(args.time)
+	end = args.end or args.date
+	dates = [args.date + dt.timedelta(days = n) for n in range((end - args.date).days + 1)]
+
+	logging.info("Get FATV info")
+	fatvs = storage.get_cfatv()
+	adjacency = storage.get_adjacency()
+
+	tables, found = [], []
+	for date in dates:
+		logging.info(f"Turn ratios of {date}")
+		try:
+			tables.append(turn_ratios(date, intervals, fatvs, adjacency))
+		except ClientError as e:
+			logging.error(f"No data for {date}")
+			continue
+		found.append(date)
+	if not found:
+		exit(1)
+	table = pd.concat(tables, ignore_index = True)
+
+	if args.output and args.output.endswith('.parquet'):
+		table.to_parquet(args.output, index = False)
+	elif args.output:
+		table.to_csv(args.output, index = False)
+	if args.report or not args.output:
+		report(table, found)
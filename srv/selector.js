@@ -128,7 +128,8 @@ var Selector = {
 	'createMarkers': function() {
 		this.detectors = {};
 		var self = this;
-		var target = root_api + 'data/detectors' + '?date=' + window.date;
+		var target = root_api + 'data/detectors' + '?date=' + window.date +
+			'&fields=lat,lon,fatv_in,fatv_out,Name,Fwy,Type,Dir,Lanes,City';
 		$.ajax({
 			dataType: 'json',
 			url: target,
@@ -410,72 +411,57 @@ var Selector = {
 			});
 		}
 
-		if (detector.info.fatv_in !== null) {
-			var target = root_api + 'data/plot/' + detector.info.fatv_in + '?date=' + window.date;
-			$.ajax({
-				url: target,
-				dataType: 'json',
-				beforeSend: function (xhr) {
-					xhr.setRequestHeader('Authorization', ID_TOKEN)
+		function draw(plot, cell, fatv, flows) {
+			Plotly.newPlot(plot, [flows['IN']['data'], flows['OUT']['data']], {
+				'title': 'FATV ' + fatv + '<br>' +
+				'IN: ' + titleize(flows['IN']['detectors']).join(', ') + '<br>' +
+				'OUT: ' + titleize(flows['OUT']['detectors']).join(', '),
+
+				'xaxis': {
+					'title': 'Time'
 				},
-				success: function(flows) {
-					// Plotly.purge('plot-1');
-					if (self.selected == detector) {
-						Plotly.newPlot('plot-1', [flows['IN']['data'], flows['OUT']['data']], {
-							'title': 'FATV ' + detector.info.fatv_in + '<br>' +
-							'IN: ' + titleize(flows['IN']['detectors']).join(', ') + '<br>' +
-							'OUT: ' + titleize(flows['OUT']['detectors']).join(', '),
-
-							'xaxis': {
-								'title': 'Time'
-							},
-							'yaxis': {
-								'title': 'Vehicles / 5min'
-							}
-						});
-						var relerr = flows['stats']['relerr'] * 100
-						$('#det-fatv-in').text(
-							flows['stats']['miscount'] + " (" + relerr.toFixed(3) + "%)"
-						);
-					};
+				'yaxis': {
+					'title': 'Vehicles / 5min'
 				}
-			}).fail(function (jqxhr, textStatus, errorThrown) {console.log(textStatus, errorThrown)});
-		} else {
-			Plotly.purge('plot-1');
-		};
+			});
+			var relerr = flows['stats']['relerr'] * 100
+			$(cell).text(
+				flows['stats']['miscount'] + " (" + relerr.toFixed(3) + "%)"
+			);
+		}
 
-		if (detector.info.fatv_out !== null) {
-			var target = root_api + 'data/plot/' + detector.info.fatv_out + '?date=' + window.date;
+		// Both FATVs are fetched in one request
+		var plots = [
+			['plot-1', '#det-fatv-in', detector.info.fatv_in],
+			['plot-2', '#det-fatv-out', detector.info.fatv_out]
+		];
+		var fatvs = [];
+		$.each(plots, function(idx, plot) {
+			if (plot[2] !== null) {
+				fatvs.push(plot[2]);
+			} else {
+				Plotly.purge(plot[0]);
+			}
+		});
+
+		if (fatvs.length) {
+			var target = root_api + 'data/plot' + '?fatvs=' + fatvs.join(',') + '&date=' + window.date;
 			$.ajax({
 				url: target,
 				dataType: 'json',
 				beforeSend: function (xhr) {
 					xhr.setRequestHeader('Authorization', ID_TOKEN)
 				},
-				success: function(flows) {
-					// Plotly.purge('plot-2');
+				success: function(bodies) {
 					if (self.selected == detector) {
-						Plotly.newPlot('plot-2', [flows['IN']['data'], flows['OUT']['data']], {
-							'title': 'FATV ' + detector.info.fatv_out + '<br>' +
-							'IN: ' + titleize(flows['IN']['detectors']).join(', ') + '<br>' +
-							'OUT: ' + titleize(flows['OUT']['detectors']).join(', '),
-
-							'xaxis': {
-								'title': 'Time'
-							},
-							'yaxis': {
-								'title': 'Vehicles / 5min'
+						$.each(plots, function(idx, plot) {
+							if (plot[2] !== null) {
+								draw(plot[0], plot[1], plot[2], bodies[plot[2]]);
 							}
 						});
-						var relerr = flows['stats']['relerr'] * 100
-						$('#det-fatv-out').text(
-							flows['stats']['miscount'] + " (" + relerr.toFixed(3) + "%)"
-						);
 					};
 				}
-			});
-		} else {
-			Plotly.purge('plot-2')
+			}).fail(function (jqxhr, textStatus, errorThrown) {console.log(textStatus, errorThrown)});
 		};
 	},
 
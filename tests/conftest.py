@@ -0,0 +1,17 @@
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib'))
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+	"""
+	An empty local store in place of S3, with a cold cache
+	"""
+	from flowbalance import storage
+	from flowbalance.local import LocalClient
+	monkeypatch.setenv('FLOW_BALANCE_ROOT', str(tmp_path))
+	monkeypatch.setattr(storage, '_client', LocalClient(str(tmp_path)))
+	monkeypatch.setattr(storage, 'cache', storage.ObjectCache(storage.cache.limit))
+	return tmp_path
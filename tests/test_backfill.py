@@ -0,0 +1,88 @@
+import json, os, subprocess, sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flowbalance import manifest, storage
+from flowbalance.adjacency import Adjacency
+
+BACKFILL = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts', 'backfill.py')
+
+@pytest.fixture
+def day(store):
+	"""
+	A day recorded by fb-daily on a small network, where 102 counts half again
+	its flow and 106 is not observed enough
+	"""
+	df_cfatv = pd.DataFrame({
+		'IN': [[101], [102], [103], [105]],
+		'OUT': [[102, 103], [104], [105], [106]],
+	}, index = [1, 2, 3, 4])
+	adjacency = Adjacency.from_fatvs(df_cfatv)
+	storage.put_str(df_cfatv.to_json(orient = 'index'), 'info/fatvs.json')
+	storage.put_str(adjacency.to_json(), 'info/adjacency.json')
+	storage.put_str(json.dumps([101, 102, 103, 104, 105]), 'info/tracked.json')
+
+	times = pd.date_range('2018-03-01', periods = 288, freq = '5min')
+	flows = {101: 100., 102: 60. * 1.5, 103: 40., 104: 60., 105: 40., 106: 40.}
+	df_piv = pd.DataFrame({det: np.full(len(times), flow) for det, flow in flows.items()}, index = times)
+	df_piv[106] = np.nan
+	obv = pd.Series(100., index = df_piv.columns)
+	obv[106] = 0
+
+	df_meta = adjacency.frame().reindex(df_piv.columns)
+	df_meta.index.name = 'ID'
+	storage.put_df(df_meta, 'data/detectors/2018-03-01')
+	storage.put_df(df_piv, 'data/flows/2018-03-01', format = 'arrow', dtype = np.float32)
+	storage.put_df(obv.to_frame('Observed'), 'data/observed/2018-03-01')
+	return '2018-03-01'
+
+def test_backfill_analyze(store, day, tmp_path):
+	checkpoint = str(tmp_path / 'backfill.checkpoint')
+	subprocess.check_call([sys.executable, BACKFILL, day, day, '-s', 'analyze', '-j', '1', '-c', checkpoint],
+		env = dict(os.environ, FLOW_BALANCE_ROOT = str(store)))
+
+	diagnosis = json.loads(storage.get_str('data/balance/' + day))
+	assert diagnosis['error'] == [102]
+	assert diagnosis['unobv'] == [106]
+	assert sorted(diagnosis['untracked']) == [106]
+	assert set(json.loads(storage.get_str('data/windows/' + day))) >= {'00:00-00:59', '06:00-09:59'}
+	assert manifest.latest('analyze') == day
+	assert storage.get_df('info/health').loc[102, 'Error'] == 1
+
+	with open(checkpoint) as file:
+		assert [json.loads(line) for line in file] == [{'date': day, 'stages': ['analyze']}]
+
+def test_backfill_windows(store, day, tmp_path):
+	# 102 counts right but for a burst in the last slot of the first hour, and 03:00-03:59 is missing
+	df_piv = storage.get_df('data/flows/' + day)
+	df_piv[102] = 60.
+	df_piv.loc[df_piv.index[11], 102] = 1000.
+	df_piv = df_piv[df_piv.index.hour != 3]
+	storage.put_df(df_piv, 'data/flows/' + day, format = 'arrow', dtype = np.float32)
+
+	subprocess.check_call([sys.executable, BACKFILL, day, day, '-s', 'analyze', '-j', '1', '-c', str(tmp_path / 'ckpt')],
+		env = dict(os.environ, FLOW_BALANCE_ROOT = str(store)))
+
+	assert json.loads(storage.get_str('data/balance/' + day))['error'] == []
+	windows = json.loads(storage.get_str('data/windows/' + day))
+	assert windows['00:00-00:59']['error'] == [102]
+	assert windows['01:00-01:59']['error'] == []
+	assert windows['03:00-03:59'] == {'error': [], 'unknown': [101, 102, 103, 104, 105, 106]}
+
+def test_backfill_health_takes_failed_day_later(store, day, tmp_path):
+	# The day before has no data at first and fails, the day itself is analyzed
+	checkpoint = str(tmp_path / 'backfill.checkpoint')
+	command = [sys.executable, BACKFILL, '2018-02-28', day, '-s', 'analyze', '-j', '2', '-c', checkpoint]
+	env = dict(os.environ, FLOW_BALANCE_ROOT = str(store))
+	run = subprocess.run(command, env = env, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+	assert run.returncode == 1
+	assert run.stdout.decode().split() == ['failed:', '2018-02-28']
+	assert manifest.latest('analyze') == day
+	assert storage.get_df('info/health').loc[102, 'Error Streak'] == 1
+
+	for prefix in ['data/detectors/', 'data/flows/', 'data/observed/']:
+		storage.put_str(storage.get_str(prefix + day), prefix + '2018-02-28')
+	subprocess.check_call(command, env = env)
+	assert storage.get_df('info/health').loc[102, 'Error Streak'] == 2
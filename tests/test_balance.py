@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from flowbalance.balance import Incidence, window_bounds
+
+def reference_account(df_cfatv, df_piv):
+	"""
+	The per FATV loop fb-analyze accounted with before Incidence
+	"""
+	df = pd.DataFrame(np.nan, index = df_cfatv.index, columns = ['ERR', 'VOL', 'DIF'])
+	missing = lambda ser: ser.isna().sum() / float(len(ser))
+	for idx in df_cfatv.index:
+		ins, outs = df_cfatv.loc[idx, ['IN', 'OUT']]
+		try:
+			ins = df_piv[ins].sum(axis = 1, skipna = False)
+			outs = df_piv[outs].sum(axis = 1, skipna = False)
+		except KeyError as e:
+			continue
+		if missing(ins) < 0.05 and missing(outs) < 0.05:
+			vol = (ins + outs).sum()
+			dif = (ins - outs).sum()
+			df.loc[idx] = [abs(dif) / float(vol), vol, dif]
+	return df
+
+def random_day(rng, stations, fatvs):
+	"""
+	A day of flows with scattered and long NaN runs, and FATVs over them,
+	some with members absent from the flows or repeated
+	"""
+	times = pd.date_range('2018-03-01', periods = 288, freq = '5min')
+	df_piv = pd.DataFrame(rng.integers(0, 300, (len(times), stations)).astype(float),
+		index = times, columns = 1000 + np.arange(stations))
+	scattered = df_piv.columns[rng.random(stations) < 0.3]
+	df_piv[scattered] = df_piv[scattered].mask(rng.random((len(times), len(scattered))) < 0.03)
+	for column in df_piv.columns[rng.random(stations) < 0.1]:
+		start = rng.integers(len(times))
+		df_piv.loc[df_piv.index[start:start + int(rng.integers(1, 60))], column] = np.nan
+
+	members = lambda: [int(m) for m in rng.choice(stations + 5, int(rng.integers(1, 4))) + 1000] # Some absent
+	df_cfatv = pd.DataFrame({
+		'IN': [members() for _ in range(fatvs)],
+		'OUT': [members() for _ in range(fatvs)],
+	}, index = 5000 + np.arange(fatvs))
+	df_cfatv.loc[5000, 'IN'] = df_cfatv.loc[5000, 'IN'] * 2 # Repeated
+	return df_cfatv, df_piv
+
+@pytest.mark.parametrize('seed', range(10))
+def test_account_matches_loop(seed):
+	rng = np.random.default_rng(seed)
+	df_cfatv, df_piv = random_day(rng, 40, 60)
+	df = Incidence(df_cfatv, df_piv.columns).account(df_piv)
+
+	expected = reference_account(df_cfatv, df_piv)
+	assert df['VOL'].notnull().any() and df['VOL'].isnull().any()
+	pd.testing.assert_frame_equal(df[['ERR', 'VOL', 'DIF']], expected, check_names = False)
+
+def test_account_edges():
+	times = pd.date_range('2018-03-01', periods = 100, freq = '5min')
+	df_piv = pd.DataFrame({1: 10., 2: 8., 3: 0., 4: 0.}, index = times)
+	df_piv.loc[times[:4], 2] = np.nan # Under 5% missing
+	df_cfatv = pd.DataFrame({
+		'IN': [[1], [1], [3], [1]],
+		'OUT': [[2], [2, 9], [4], [2, 2]],
+	}, index = [1, 2, 3, 4])
+	df = Incidence(df_cfatv, df_piv.columns).account(df_piv)
+
+	assert df.loc[1, 'VOL'] == 96 * 18 and df.loc[1, 'DIF'] == 96 * 2
+	assert df.loc[2].isnull().all() # 9 is not in the flows
+	assert df.loc[3, 'VOL'] == 0 and np.isnan(df.loc[3, 'ERR'])
+	assert df.loc[4, 'DIF'] == 96 * -6
+
+	df_piv.loc[times[:5], 2] = np.nan # 5% is too many
+	assert Incidence(df_cfatv, df_piv.columns).account(df_piv).loc[[1, 4]].isnull().all().all()
+
+def test_window_bounds_match_between_time():
+	windows = [('{:02d}:00'.format(hour), '{:02d}:59'.format(hour)) for hour in range(24)] + [('06:00', '09:59'), ('00:55', '00:55')]
+	index = pd.date_range('2018-03-01', periods = 288, freq = '5min')
+	index = index.delete([40, 41, 100]) # Slots missing
+	ser = pd.Series(np.arange(len(index)), index = index)
+	for (start, stop), (first, last) in zip(windows, window_bounds(index, windows)):
+		assert list(ser.iloc[first:last]) == list(ser.between_time(start, stop))
+
+	# An hour includes its last slot, and the last hour the day's last
+	bounds = window_bounds(pd.date_range('2018-03-01', periods = 288, freq = '5min'), [('00:00', '00:59'), ('23:00', '23:59')])
+	assert bounds == [(0, 12), (276, 288)]
+
+def test_window_without_samples():
+	index = pd.date_range('2018-03-01', periods = 288, freq = '5min')
+	index = index[(index.hour != 3)]
+	(first, last), = window_bounds(index, [('03:00', '03:59')])
+	assert first == last == 36
+
+	df_piv = pd.DataFrame({1: 10., 2: 10.}, index = index)
+	df_cfatv = pd.DataFrame({'IN': [[1]], 'OUT': [[2]]}, index = [1])
+	assert Incidence(df_cfatv, df_piv.columns).running(df_piv).account(first, last).isnull().all().all()
+
+def test_window_bounds_refuse():
+	index = pd.date_range('2018-03-01', periods = 288, freq = '5min')
+	with pytest.raises(ValueError):
+		window_bounds(index, [('23:00', '01:00')])
+	with pytest.raises(ValueError):
+		window_bounds(index[::-1], [('00:00', '00:59')])
@@ -0,0 +1,100 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flowbalance.adjacency import Adjacency
+from flowbalance.balance import Incidence
+from flowbalance.diagnosis import MISCOUNT, THRESHOLDS, Implications, calibrate, implicate
+
+def random_network(rng, fatvs, shared, lone):
+	"""
+	FATVs joined by `shared` detectors, each flowing out of one FATV and into
+	another, and with `lone` detectors of one FATV only
+	"""
+	ins, outs = [[] for _ in range(fatvs)], [[] for _ in range(fatvs)]
+	for det in range(shared):
+		a, b = rng.choice(fatvs, 2, replace = False)
+		outs[a].append(100 + det)
+		ins[b].append(100 + det)
+	for det in range(lone):
+		(ins if rng.random() < 0.5 else outs)[rng.integers(fatvs)].append(10000 + det)
+	return pd.DataFrame({'IN': ins, 'OUT': outs}, index = 1000 + np.arange(fatvs))
+
+def random_account(rng, df_cfatv, bad):
+	"""
+	Balances with a little noise, where `bad` shared detectors miscount, and
+	some FATVs are not accounted
+	"""
+	vol = rng.uniform(1000, 5000, len(df_cfatv))
+	dif = rng.normal(0, 10, len(df_cfatv))
+	position = {fid: pos for pos, fid in enumerate(df_cfatv.index)}
+	shared = [(det, pos) for pos, members in enumerate(df_cfatv['OUT']) for det in members if det < 10000]
+	for det, a in [shared[n] for n in rng.choice(len(shared), bad, replace = False)]:
+		b = next(position[fid] for fid, members in df_cfatv['IN'].items() if det in members)
+		x = rng.uniform(50, 400)
+		dif[a] -= x # One of its outs
+		dif[b] += x # One of its ins
+	df_account = pd.DataFrame({'ERR': np.abs(dif) / vol, 'VOL': vol, 'DIF': dif}, index = df_cfatv.index)
+	df_account.loc[df_account.index[rng.random(len(df_cfatv)) < 0.05]] = np.nan
+	return df_account
+
+GRID = list(itertools.product([0.01, 0.05], [0.005, 0.05], [0.15, 0.5])) + [THRESHOLDS]
+
+@pytest.mark.parametrize('seed', range(4))
+def test_sweep_matches_implicate(seed):
+	rng = np.random.default_rng(seed)
+	df_cfatv = random_network(rng, 80, 150, 40)
+	adjacency = Adjacency.from_fatvs(df_cfatv)
+	implications = Implications(df_cfatv, adjacency)
+
+	for day in range(2):
+		df_account = random_account(rng, df_cfatv, 12)
+		blamed, single = implications.sweep(df_account, GRID)
+		for n, thresholds in enumerate(GRID):
+			error, singleton = implicate(df_cfatv.join(df_account), adjacency, thresholds)
+			assert set(implications.detectors[blamed[n]]) == set(error)
+			assert set(implications.singletons[single[n]]) == singleton
+
+def calibrated(scale):
+	"""
+	calibrate() over a day of a network that splits and joins again, where
+	each detector's flow is scaled by `scale`
+	"""
+	df_cfatv = pd.DataFrame({'IN': [[1], [2], [3], [4, 5]], 'OUT': [[2, 3], [4], [5], [6]]}, index = [1, 2, 3, 4])
+	times = pd.date_range('2018-03-01', periods = 288, freq = '5min')
+	rng = np.random.default_rng(0)
+	a, b = rng.integers(20, 80, len(times)).astype(float), rng.integers(20, 80, len(times)).astype(float)
+	df_piv = pd.DataFrame({1: a + b, 2: a, 3: b, 4: a, 5: b, 6: a + b}, index = times)
+	df_piv = df_piv * pd.Series(scale).reindex(df_piv.columns).fillna(1)
+
+	incidence = Incidence(df_cfatv, df_piv.columns)
+	running = incidence.running(df_piv)
+	totals, = incidence.member_totals(df_piv, running, [(0, len(times))])
+	return calibrate(df_cfatv.join(running.account(0, len(times))), totals, incidence.stations)
+
+def test_calibrate_recovers_miscount():
+	# 4 is between two FATVs, and counts 30% over
+	error, singleton, factors = calibrated({4: 1.3})
+	assert error == [4]
+	assert factors[4] == pytest.approx(1 / 1.3)
+	assert (abs(factors.drop(4) - 1) < MISCOUNT).all()
+	assert singleton == set()
+
+def test_calibrate_lone_miscount():
+	# 6 is of one FATV only, and could be any of its members' fault
+	error, singleton, factors = calibrated({6: 1.2})
+	assert error == []
+	assert singleton == {6}
+
+def test_calibrate_nothing_accounted():
+	# As for a window without samples, or where every FATV is missing too many
+	df_cfatv = pd.DataFrame({'IN': [[1], [2]], 'OUT': [[2], [3]]}, index = [1, 2])
+	df_piv = pd.DataFrame(np.nan, index = pd.date_range('2018-03-01', periods = 4, freq = '5min'), columns = [1, 2, 3])
+	incidence = Incidence(df_cfatv, df_piv.columns)
+	running = incidence.running(df_piv)
+	totals, = incidence.member_totals(df_piv, running, [(0, 4)])
+
+	error, singleton, factors = calibrate(df_cfatv.join(running.account(0, 4)), totals, incidence.stations)
+	assert error == [] and singleton == set() and factors.empty
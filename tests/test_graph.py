@@ -0,0 +1,63 @@
+from collections import defaultdict, deque
+
+import numpy as np
+import pytest
+
+from flowbalance.graph import Graph
+
+def reference_components(nodes, edges):
+	"""
+	Weakly connected components by breadth first search
+	"""
+	neighbors = defaultdict(set)
+	for o, d in edges:
+		neighbors[o].add(d)
+		neighbors[d].add(o)
+
+	seen, components = set(), []
+	for start in list(nodes) + [node for edge in edges for node in edge]:
+		if start in seen:
+			continue
+		seen.add(start)
+		component, queue = {start}, deque([start])
+		while queue:
+			for node in neighbors[queue.popleft()] - seen:
+				seen.add(node)
+				component.add(node)
+				queue.append(node)
+		components.append(component)
+	return components
+
+def random_graph(rng, count, degree):
+	"""
+	Nodes, including None, and directed edges with self loops and parallel edges
+	"""
+	nodes = [None] + list(range(1, count))
+	edges = [(nodes[o], nodes[d]) for o, d in rng.integers(0, count, (int(degree * count), 2))]
+	edges += edges[:count // 10] # Parallel
+	return nodes, edges
+
+def canonical(components):
+	return sorted((frozenset(component) for component in components), key = lambda c: sorted(map(repr, c)))
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('degree', [0.2, 0.5, 1, 3])
+def test_components_match_bfs(seed, degree):
+	rng = np.random.default_rng(seed)
+	nodes, edges = random_graph(rng, int(rng.integers(1, 300)), degree)
+	G = Graph(edges, nodes)
+
+	expected = reference_components(nodes, edges)
+	assert canonical(G.components()) == canonical(expected)
+
+	# Each node is labelled with the least index in its component
+	labels = G.labels()
+	for component in expected:
+		indices = [G.index[node] for node in component]
+		assert set(labels[indices]) == {min(indices)}
+
+def test_components_edge_order():
+	# Long chains given back to front need many rounds of hooking
+	chain = [(n + 1, n) for n in reversed(range(1000))]
+	assert Graph(chain).components() == [set(range(1001))]
+	assert Graph([], nodes = [3, 1, 2]).components() == [{3}, {1}, {2}]
@@ -0,0 +1,55 @@
+import json
+
+import pandas as pd
+
+from flowbalance import health, storage
+
+DIAGNOSES = {
+	'2018-03-01': {'error': [101], 'unobv': [], 'unknown': [102]},
+	'2018-03-02': {'error': [101, 103], 'unobv': [102], 'unknown': []},
+	'2018-03-03': {'error': [103], 'unobv': [], 'unknown': [102]},
+	'2018-03-05': {'error': [101], 'unobv': [103], 'unknown': []},
+}
+
+def diagnose(date, diagnosis):
+	"""
+	Store a day's detectors and diagnosis as fb-daily and fb-analyze would
+	"""
+	storage.put_df(pd.DataFrame({'Type': 'ML'}, index = pd.Index([101, 102, 103], name = 'ID')), 'data/detectors/' + date)
+	storage.put_str(json.dumps(diagnosis), 'data/balance/' + date)
+
+def in_order():
+	df_health = health.empty()
+	for date, diagnosis in sorted(DIAGNOSES.items()):
+		df_health = health.update(df_health, date, [101, 102, 103], diagnosis)
+	return df_health
+
+def test_days_in_order_fold_in(store):
+	for date, diagnosis in sorted(DIAGNOSES.items()):
+		diagnose(date, diagnosis)
+		health.record(date)
+	pd.testing.assert_frame_equal(health.load(), in_order(), check_dtype = False)
+
+def test_days_out_of_order_rebuild(store):
+	for date in ['2018-03-05', '2018-03-02', '2018-03-01', '2018-03-03']:
+		diagnose(date, DIAGNOSES[date])
+		health.record(date)
+	pd.testing.assert_frame_equal(health.load(), in_order(), check_dtype = False)
+
+def test_lost_record_set_right(store):
+	for date, diagnosis in sorted(DIAGNOSES.items()):
+		diagnose(date, diagnosis)
+	health.record('2018-03-01')
+	health.record('2018-03-02')
+	# 03-03 was diagnosed but its record overwritten, 03-05 rebuilds
+	health.record('2018-03-05')
+	pd.testing.assert_frame_equal(health.load(), in_order(), check_dtype = False)
+
+def test_day_diagnosed_again(store):
+	for date, diagnosis in sorted(DIAGNOSES.items()):
+		diagnose(date, diagnosis)
+		health.record(date)
+	diagnose('2018-03-02', {'error': [], 'unobv': [], 'unknown': []})
+	health.record('2018-03-02')
+	assert health.load().loc[101, 'Error'] < in_order().loc[101, 'Error']
+	assert health.load()['Updated'].max() == pd.Timestamp('2018-03-05')
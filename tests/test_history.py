@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from flowbalance import history, storage
+
+def day(date, stations, seed):
+	times = pd.date_range(date, periods = history.SLOTS, freq = history.STEP)
+	values = np.random.default_rng(seed).integers(0, 400, (len(times), len(stations))).astype(float)
+	values[:5, 0] = np.nan
+	return pd.DataFrame(values, index = times, columns = stations)
+
+def test_series_joins_days(store):
+	days = [
+		day('2018-03-30', [101, 102], 0),
+		day('2018-03-31', [101, 102, 103], 1), # 103 is new
+		day('2018-04-02', [102, 103], 2), # After a day not recorded, in the next month
+	]
+	for df_piv in days:
+		history.append(df_piv)
+
+	df = history.series([103, 101, 104], '2018-03-30', '2018-04-02')
+	assert list(df.columns) == [101, 103, 104]
+	assert len(df) == 4 * history.SLOTS and df.index[0] == pd.Timestamp('2018-03-30')
+
+	expected = pd.concat(days).reindex(index = df.index, columns = df.columns)
+	pd.testing.assert_frame_equal(df, expected, check_freq = False)
+
+def test_append_writes_the_day(store):
+	history.append(day('2018-03-01', list(range(100, 150)), 0))
+	history.append(day('2018-03-02', list(range(100, 160)), 1))
+	rerun = day('2018-03-02', list(range(100, 160)), 2)
+	history.append(rerun)
+
+	# Each day is its own block, a header of its stations and a row each
+	assert len(storage.get_str(history.block_key(pd.Timestamp('2018-03-01')))) == 51 * 8 + 50 * history.SLOTS * 4
+	assert len(storage.get_str(history.block_key(pd.Timestamp('2018-03-02')))) == 61 * 8 + 60 * history.SLOTS * 4
+	df = history.series(range(100, 160), '2018-03-02', '2018-03-02')
+	pd.testing.assert_frame_equal(df, rerun, check_freq = False, check_column_type = False)
+
+def test_days_describe_their_rows(store):
+	# Days of a month recorded in any order, each with stations the other lacks
+	later = day('2018-03-02', [105, 101, 103], 0)
+	earlier = day('2018-03-01', [104, 101, 102], 1)
+	history.append(later)
+	history.append(earlier)
+
+	assert list(history.stations_of(pd.Timestamp('2018-03-02'))) == [101, 103, 105]
+	assert history.stations_of(pd.Timestamp('2018-03-03')) is None
+	df = history.series([102, 103, 104, 105], '2018-03-01', '2018-03-02')
+	expected = pd.concat([earlier, later]).reindex(index = df.index, columns = df.columns)
+	pd.testing.assert_frame_equal(df, expected, check_freq = False)
@@ -0,0 +1,33 @@
+import datetime as dt
+import json
+from multiprocessing.pool import ThreadPool
+
+from flowbalance import manifest, storage
+
+def test_stages_record_days_at_once(store):
+	days = [dt.date(2018, 3, 1) + dt.timedelta(days = n) for n in range(20)]
+	pool = ThreadPool(8)
+	pool.starmap(manifest.record, [(day, stage) for day in days for stage in ['daily', 'analyze']])
+	pool.close()
+
+	loaded = manifest.load()
+	assert sorted(loaded['dates']) == ['{:%Y-%m-%d}'.format(day) for day in days]
+	assert all(set(stages) == {'daily', 'analyze'} for stages in loaded['dates'].values())
+	assert loaded['latest'] == {'daily': '2018-03-20', 'analyze': '2018-03-20'}
+
+def test_earlier_manifest_is_read(store):
+	storage.put_str(json.dumps({
+		'latest': {'daily': '2018-02-28', 'analyze': '2018-02-28'},
+		'dates': {'2018-02-28': {'daily': '2018-03-01T01:00:00Z', 'analyze': '2018-03-01T02:00:00Z'}},
+	}), manifest.MANIFEST_KEY)
+	manifest.record(dt.date(2018, 3, 1), 'daily')
+
+	loaded = manifest.load()
+	assert sorted(loaded['dates']) == ['2018-02-28', '2018-03-01']
+	assert manifest.latest('daily') == '2018-03-01'
+	assert manifest.latest('analyze') == '2018-02-28'
+
+def test_latest_lists_output_without_manifest(store):
+	storage.put_str('{}', 'data/balance/2018-03-02')
+	storage.put_str('{}', 'data/balance/2018-03-03')
+	assert manifest.latest('analyze') == '2018-03-03'
@@ -0,0 +1,33 @@
+import threading
+
+from flowbalance import metrics
+from flowbalance.metrics import Metrics
+
+def test_nested_stages_count_their_bytes():
+	m = Metrics('test')
+	with m.stage('outer'):
+		metrics.count('read', 10)
+		with m.stage('inner'):
+			metrics.count('read', 5)
+			with m.stage('innermost'):
+				pass
+		metrics.count('written', 3)
+	assert metrics._local.stages == []
+	assert [(stage, record['read'], record['written']) for stage, record in m.stages.items()] \
+		== [('innermost', 0, 0), ('inner', 5, 0), ('outer', 15, 3)]
+
+def test_stages_from_threads():
+	m = Metrics('test')
+	def run(n):
+		for i in range(50):
+			with m.stage('{}.{}'.format(n, i)):
+				metrics.count('read', n)
+
+	threads = [threading.Thread(target = run, args = (n,)) for n in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert len(m.seconds()) == 8 * 50 + 1
+	assert all(record['read'] == int(stage.split('.')[0]) for stage, record in m.stages.items())
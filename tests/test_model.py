@@ -0,0 +1,175 @@
+import importlib.util, io, json, os
+from collections import Counter, defaultdict
+from operator import itemgetter
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+
+MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lambda', 'model', 'lambda_function.py')
+
+@pytest.fixture(scope = 'module')
+def model():
+	pytest.importorskip('ijson')
+	spec = importlib.util.spec_from_file_location('fb_model', MODEL)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def synth_model(rng, n):
+	"""
+	An n x n grid of junctions in the model.zip dump schema, with sections
+	missing at random, some parallel, and entries and exits on every edge.
+	Detectors are placed on some sections, in one or several spanning sets.
+	"""
+	junctions = {str(1 + k): {'ID': 1 + k, 'Name': ''} for k in range(n * n)}
+	sections, detectors = {}, {}
+
+	def section(origin, destination):
+		sid = 100000 + len(sections)
+		sections[str(sid)] = {'ID': sid, 'Origin': origin, 'Destination': destination, 'Name': ''}
+		if rng.random() < 0.4:
+			lanes = [(1, 1), (2, 2)] if rng.random() < 0.5 else [(1, 2)]
+			for k in range(int(rng.integers(1, 4))):
+				for first, last in lanes:
+					pid = 7200001 + len(detectors)
+					detectors[str(pid)] = {
+						'ID': 500000 + len(detectors), 'External ID': str(pid), 'Section ID': sid,
+						'First Lane': first, 'Last Lane': last, 'Start Position': 10.0 * k + first * 0.1,
+					}
+
+	for i in range(n):
+		for j in range(n):
+			here = 1 + i * n + j
+			for there in ([here + n] if i + 1 < n else []) + ([here + 1] if j + 1 < n else []):
+				if rng.random() < 0.8:
+					section(here, there)
+				if rng.random() < 0.8:
+					section(there, here)
+				if rng.random() < 0.05:
+					section(here, there) # Parallel
+		if rng.random() < 0.5:
+			section(None, 1 + i * n)
+		if rng.random() < 0.5:
+			section(n + i * n, None)
+	return detectors, junctions, sections
+
+def model_zip(detectors, junctions, sections):
+	store = io.BytesIO()
+	with ZipFile(store, 'w') as zm:
+		zm.writestr('detectors.json', json.dumps(detectors))
+		zm.writestr('junctions.json', json.dumps(junctions))
+		zm.writestr('sections.json', json.dumps(sections))
+	store.seek(0)
+	return store
+
+def networkx_fatvs(detectors, junctions, sections):
+	"""
+	get_fatvs as it was on networkx, before the union-find graph core, as
+	(IN, OUT) lists. Given the dumps with integer ids. The exterior, None in the
+	dumps, is a node of its own name, as networkx no longer takes None.
+	"""
+	nx = pytest.importorskip('networkx')
+
+	s2det = defaultdict(list)
+	for pid, det in detectors.items():
+		s2det[det['Section ID']].append(det)
+
+	sfatvs = []
+	get_track = itemgetter('First Lane', 'Last Lane')
+	for s, dets in s2det.items():
+		tracks = defaultdict(list)
+		for d in sorted(dets, key = itemgetter('Start Position')):
+			tracks[get_track(d)].append(d)
+		dsets = [[int(d['External ID']) for d in dset] for dset in zip(*tracks.values())]
+		s2det[s] = dsets
+		sfatvs += [(fin, fout) for fin, fout in zip(dsets, dsets[1:])]
+
+	G = nx.DiGraph()
+	G.add_nodes_from(junctions.keys())
+	node = lambda j: 'exterior' if j is None else j
+	edges = [(node(s['Origin']), node(s['Destination']), {'ID': mid, 'detectors': s2det[mid]}) for mid, s in sections.items()]
+	G.add_edges_from(e for e in edges if not e[2]['detectors'])
+	groups = [wcc for wcc in nx.weakly_connected_components(G) if 'exterior' not in wcc]
+	G.add_edges_from(edges)
+
+	fatvs = []
+	for group in groups:
+		fatv_in = [G.edges[start, end]['detectors'][-1] for start, end in G.in_edges(group) if start not in group]
+		fatv_out = [G.edges[start, end]['detectors'][0] for start, end in G.out_edges(group) if end not in group]
+		fatvs.append(([n for dset in fatv_in for n in dset], [n for dset in fatv_out for n in dset]))
+	return fatvs + sfatvs
+
+def canonical(fatvs):
+	return Counter((tuple(sorted(ins)), tuple(sorted(outs))) for ins, outs in fatvs)
+
+@pytest.mark.parametrize('seed', range(12))
+def test_fatvs_match_networkx(model, seed):
+	rng = np.random.default_rng(seed)
+	dumps = synth_model(rng, int(rng.integers(2, 15)))
+	df_cfatv = model.get_fatvs(*model.get_djs(model_zip(*dumps)))
+
+	detectors, junctions, sections = ({int(id): feature for id, feature in dump.items()} for dump in dumps)
+	expected = networkx_fatvs(detectors, junctions, sections)
+	assert canonical(zip(df_cfatv['IN'], df_cfatv['OUT'])) == canonical(expected)
+
+def edit_model(rng, detectors, junctions, sections, count):
+	"""
+	Copies of the dumps with `count` random edits: sections removed, added,
+	or rerouted, detectors removed, added or moved, and junctions added or removed
+	"""
+	detectors, junctions, sections = (dict((id, dict(feature)) for id, feature in dump.items()) for dump in (detectors, junctions, sections))
+	nodes = [feature['ID'] for feature in junctions.values()] + [None]
+	for _ in range(count):
+		kind = rng.integers(8)
+		sids = sorted(sections)
+		if kind == 0 and sids:
+			del sections[sids[rng.integers(len(sids))]]
+		elif kind == 1:
+			sid = 200000 + len(sections)
+			o, d = rng.choice(len(nodes), 2)
+			sections[str(sid)] = {'ID': sid, 'Origin': nodes[o], 'Destination': nodes[d], 'Name': ''}
+		elif kind == 2 and sids:
+			end = 'Origin' if rng.random() < 0.5 else 'Destination'
+			sections[sids[rng.integers(len(sids))]][end] = nodes[rng.integers(len(nodes))]
+		elif kind == 3 and detectors:
+			del detectors[sorted(detectors)[rng.integers(len(detectors))]]
+		elif kind == 4 and sids:
+			pid = 7300001 + len(detectors)
+			detectors[str(pid)] = {
+				'ID': 600000 + len(detectors), 'External ID': str(pid), 'Section ID': int(sids[rng.integers(len(sids))]),
+				'First Lane': 1, 'Last Lane': 2, 'Start Position': float(rng.integers(40)),
+			}
+		elif kind == 5 and detectors and sids:
+			detectors[sorted(detectors)[rng.integers(len(detectors))]]['Section ID'] = int(sids[rng.integers(len(sids))])
+		elif kind == 6:
+			jid = 90000 + len(junctions)
+			junctions[str(jid)] = {'ID': jid, 'Name': ''}
+			nodes.append(jid)
+		elif kind == 7 and junctions:
+			del junctions[sorted(junctions)[rng.integers(len(junctions))]]
+	return detectors, junctions, sections
+
+def fatv_sets(df_cfatv):
+	return {fid: (sorted(ins), sorted(outs)) for fid, (ins, outs) in df_cfatv[['IN', 'OUT']].iterrows()}
+
+@pytest.mark.parametrize('seed', range(12))
+def test_incremental_matches_full(model, seed):
+	rng = np.random.default_rng(seed)
+	dumps = synth_model(rng, int(rng.integers(2, 12)))
+	df_cfatv, state, changes = model.update_fatvs(None, *model.get_djs(model_zip(*dumps)))
+
+	# Several updates in turn, each from the state recorded by the last
+	for count in [1, 3, 10]:
+		before = set(df_cfatv.index)
+		dumps = edit_model(rng, *dumps, count = count)
+		parsed = model.get_djs(model_zip(*dumps))
+		state = model.load_state(model.dump_state(state))
+		df_cfatv, state, changes = model.update_fatvs(state, *parsed)
+
+		full = model.get_fatvs(*parsed)
+		assert fatv_sets(df_cfatv) == fatv_sets(full)
+		assert changes == {
+			'added': sorted(set(full.index) - before),
+			'removed': sorted(before - set(full.index)),
+		}
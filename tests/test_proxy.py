@@ -0,0 +1,55 @@
+import importlib.util, json, os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flowbalance import storage
+from flowbalance.plots import index_key, plot_key
+
+PROXY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lambda', 'proxy', 'lambda_function.py')
+
+@pytest.fixture
+def proxy(store):
+	spec = importlib.util.spec_from_file_location('fb_proxy', PROXY)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def get(proxy, path, **query):
+	return proxy.route(path.split('/'), query)
+
+@pytest.fixture
+def flows(store):
+	df_cfatv = pd.DataFrame({'IN': [[101], [102]], 'OUT': [[102], [103]]}, index = [1, 2])
+	storage.put_str(df_cfatv.to_json(orient = 'index'), 'info/fatvs.json')
+	times = pd.date_range('2018-03-01', periods = 288, freq = '5min')
+	df_piv = pd.DataFrame({det: np.full(len(times), 10.) for det in [101, 102, 103]}, index = times)
+	storage.put_df(df_piv, 'data/flows/2018-03-01', format = 'arrow')
+	return '2018-03-01'
+
+def test_diagnoses_span_is_limited(proxy, store):
+	storage.put_str(json.dumps({'error': [102]}), 'data/balance/2018-03-01')
+	response = get(proxy, 'diagnosis', start = '2018-03-01', end = '2018-03-31')
+	assert response['statusCode'] == 200
+	assert json.loads(response['body'])['detectors'] == {'102': 'e' + '?' * 30}
+
+	for start, end in [('2018-03-01', '2018-04-01'), ('2018-03-02', '2018-03-01')]:
+		response = get(proxy, 'diagnosis', start = start, end = end)
+		assert response['statusCode'] == 400
+
+def test_unknown_fatv_computed(proxy, flows):
+	assert get(proxy, 'plot/3', date = flows)['statusCode'] == 404
+	response = get(proxy, 'plot', date = flows, fatvs = '2,3')
+	assert response['statusCode'] == 200
+	assert list(json.loads(response['body'])) == ['2']
+
+def test_unknown_fatv_recorded(proxy, flows):
+	body = json.dumps({'stats': {}}).encode('utf-8')
+	storage.put_str(body, plot_key(flows))
+	storage.put_str(json.dumps({'1': [0, len(body)]}), index_key(flows))
+
+	assert get(proxy, 'plot/2', date = flows)['statusCode'] == 404
+	assert json.loads(get(proxy, 'plot/1', date = flows)['body']) == {'stats': {}}
+	response = get(proxy, 'plot', date = flows, fatvs = '1,2')
+	assert json.loads(response['body']) == {'1': {'stats': {}}}
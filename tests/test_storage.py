@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError
+
+from flowbalance import metrics, storage
+
+def flows():
+	"""
+	A day of pivoted flows, as fb-daily writes them to data/flows
+	"""
+	times = pd.date_range('2018-03-01', periods = 288, freq = '5min', name = 'Timestamp')
+	values = np.arange(288 * 3, dtype = float).reshape(288, 3)
+	values[10:20, 1] = np.nan
+	return pd.DataFrame(values, index = times, columns = [715119, 715120, 715121])
+
+def test_arrow_keeps_index(store):
+	df = flows()
+	storage.put_df(df, 'data/flows/2018-03-01', format = 'arrow', dtype = np.float32)
+	assert storage.get_str('data/flows/2018-03-01')[:6] == b'ARROW1'
+
+	pd.testing.assert_frame_equal(storage.get_df('data/flows/2018-03-01'), df, check_freq = False)
+	pd.testing.assert_frame_equal(storage.get_df('data/flows/2018-03-01', columns = [715120]), df[[715120]], check_freq = False)
+	with pytest.raises(KeyError):
+		storage.get_df('data/flows/2018-03-01', columns = [1])
+
+def held(cache):
+	return sum(entry['size'] for entry in cache.entries.values())
+
+def test_cache_counts_parsed(store):
+	storage.put_df(flows(), 'data/flows/2018-03-01', format = 'arrow', dtype = np.float32)
+	raw = len(storage.get_str('data/flows/2018-03-01'))
+	df = storage.get_df('data/flows/2018-03-01')
+	assert storage.cache.size == held(storage.cache) == raw + storage.frame_size(df)
+
+	part = storage.get_df('data/flows/2018-03-01', columns = [715119])
+	assert storage.cache.size == held(storage.cache) == raw + storage.frame_size(df) + storage.frame_size(part)
+
+def test_cache_bound_counts_parsed(store, monkeypatch):
+	storage.put_df(flows(), 'data/flows/2018-03-01', format = 'arrow', dtype = np.float32)
+	storage.put_df(flows(), 'data/flows/2018-03-02', format = 'arrow', dtype = np.float32)
+	raw = len(storage.get_str('data/flows/2018-03-01'))
+	parsed = raw + storage.frame_size(storage.get_df('data/flows/2018-03-01'))
+
+	# Room for one parsed object, the older is evicted for the newer
+	monkeypatch.setattr(storage, 'cache', storage.ObjectCache(parsed + raw // 2))
+	storage.get_df('data/flows/2018-03-01')
+	storage.get_df('data/flows/2018-03-02')
+	assert list(storage.cache.entries) == [(storage.BUCKET, 'data/flows/2018-03-02')]
+	assert storage.cache.size == held(storage.cache) == parsed
+
+	# Room for the raw bytes alone, the object is dropped once parsed
+	monkeypatch.setattr(storage, 'cache', storage.ObjectCache(parsed - 1))
+	storage.get_str('data/flows/2018-03-01')
+	storage.get_df('data/flows/2018-03-01')
+	assert storage.cache.size == held(storage.cache) == 0
+
+def test_cache_revalidates(store):
+	storage.put_str('{"a": 1}', 'info/tracked.json')
+	read = lambda: metrics.moved['read']
+
+	before = read()
+	assert storage.get_json('info/tracked.json') == {'a': 1}
+	assert read() - before == 8
+
+	# Unchanged, the store answers 304 and nothing is downloaded or parsed again
+	parsed = storage.get_json('info/tracked.json')
+	assert read() - before == 8
+	assert storage.get_json('info/tracked.json') is parsed
+
+	# Rewritten behind the cache's back, as by another process
+	storage.client().put_object(Bucket = storage.BUCKET, Key = 'info/tracked.json', Body = b'{"a": 22}')
+	assert storage.get_json('info/tracked.json') == {'a': 22}
+	assert read() - before == 8 + 9
+	assert storage.cache.size == held(storage.cache) == 9
+
+def test_cache_forgets_deleted(store):
+	storage.put_str('{}', 'info/tracked.json')
+	storage.get_json('info/tracked.json')
+	os.remove(str(store / storage.BUCKET / 'info' / 'tracked.json'))
+	with pytest.raises(ClientError):
+		storage.get_json('info/tracked.json')
+	assert not storage.cache.entries and storage.cache.size == 0